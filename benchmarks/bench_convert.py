@@ -0,0 +1,108 @@
+"""
+End-to-end RAW -> analysis benchmark on any OS, using the stand-in converter (pepwiz.fakeconvert).
+
+    python benchmarks/bench_convert.py                                # 8 files, 0.5 s simulated latency
+    python benchmarks/bench_convert.py --files 16 --latency 2 --workers 1,4,8
+    python benchmarks/bench_convert.py --fail-rate 0.2                # with injected failures
+
+Synthetic RAW descriptions (one peptide eluting per file) are converted with FakeConverter via
+run_msconvert(), so the real command line, provenance caching and event paths are exercised. It
+reports, per worker count: conversion wall time (convert_many, reuse off), a cached rerun (every
+file a provenance hit), and convert-then-analyze vs pipelined (analyze each mzML as soon as its
+conversion finishes). A temporary provenance database is used unless --provenance is given.
+"""
+from __future__ import annotations
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+SEQ = "PEPTIDEKLMNR"
+
+
+def _analyze(mzml: Path, precursor_mz: float):
+    from pepwiz.pipeline import analyze
+    return analyze(mzml, SEQ, [1, 2], 10.0, precursor_mz, log_fn=lambda m: None)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--files", type=int, default=8)
+    ap.add_argument("--cycles", type=int, default=100, help="MS1 cycles per synthetic run")
+    ap.add_argument("--latency", type=float, default=0.5, help="simulated converter seconds per file")
+    ap.add_argument("--jitter", type=float, default=0.0)
+    ap.add_argument("--fail-rate", type=float, default=0.0)
+    ap.add_argument("--workers", default="1,2,4", help="comma-separated conversion worker counts")
+    ap.add_argument("--profile", default="default")
+    ap.add_argument("--out-dir", type=Path, default=None, help="keep the generated files here")
+    ap.add_argument("--provenance", type=Path, default=None, help="provenance database (default: temporary)")
+    args = ap.parse_args(argv)
+
+    tmp = None
+    out_dir = args.out_dir
+    if out_dir is None:
+        tmp = tempfile.TemporaryDirectory(prefix="pepwiz-conv-")
+        out_dir = Path(tmp.name)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    # before the first conversion: the store is opened once per process
+    os.environ["PEPWIZ_PROVENANCE"] = str(args.provenance or out_dir / "provenance.sqlite")
+
+    from pepwiz.composition import PROTON, peptide_mass
+    from pepwiz.msconvert_utils import FakeConverter, convert_many
+    from pepwiz.synthetic import write_raw_description
+
+    try:
+        raws = [write_raw_description(out_dir / f"run{i:03d}.raw", cycles=args.cycles, seed=i,
+                                      peptides=[{"sequence": SEQ, "charge": 2, "rt": [1.3, 1.8]}])
+                for i in range(args.files)]
+        precursor_mz = (peptide_mass(SEQ) + 2 * PROTON) / 2
+        backend = FakeConverter(latency=args.latency, jitter=args.jitter, fail_rate=args.fail_rate, seed=1)
+
+        print(f"{args.files} files, {args.cycles} cycles each, latency {args.latency:g} s"
+              f"{f', fail rate {args.fail_rate:g}' if args.fail_rate else ''}")
+        print(f"{'workers':>7} {'convert s':>10} {'files/s':>8} {'failed':>7} {'cached s':>9} "
+              f"{'conv+anl s':>11} {'pipelined s':>12} {'saved':>6}")
+        for workers in [int(w) for w in args.workers.split(",") if w.strip()]:
+            dest = out_dir / f"w{workers}"
+            kw = dict(workers=workers, dest_dir=dest, backend=backend, profile=args.profile, overwrite=True)
+
+            t0 = time.perf_counter()
+            done = list(convert_many(raws, reuse=False, **kw))
+            t_convert = time.perf_counter() - t0
+            failed = sum(1 for _r, m, _e in done if m is None)
+
+            t0 = time.perf_counter()
+            list(convert_many(raws, reuse=True, **kw))
+            t_cached = time.perf_counter() - t0
+
+            # convert everything, then analyze
+            t0 = time.perf_counter()
+            for _raw, mzml, _err in list(convert_many(raws, reuse=False, **kw)):
+                if mzml is not None:
+                    _analyze(mzml, precursor_mz)
+            t_serial = time.perf_counter() - t0
+
+            # analyze each file while the others are still converting
+            t0 = time.perf_counter()
+            matched = []
+            for _raw, mzml, _err in convert_many(raws, reuse=False, **kw):
+                if mzml is not None:
+                    matched.append(len(_analyze(mzml, precursor_mz)["rows"]))
+            t_pipe = time.perf_counter() - t0
+
+            print(f"{workers:>7} {t_convert:>10.2f} {args.files / t_convert:>8.2f} {failed:>7} {t_cached:>9.3f} "
+                  f"{t_serial:>11.2f} {t_pipe:>12.2f} {1 - t_pipe / t_serial:>6.0%}")
+        if matched:
+            print(f"matched ions per analyzed file: {min(matched)}-{max(matched)}")
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
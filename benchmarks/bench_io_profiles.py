@@ -0,0 +1,128 @@
+"""
+Conversion-profile I/O benchmark: mzML size vs parse throughput for each msconvert profile.
+
+    python benchmarks/bench_io_profiles.py                     # synthetic run, every profile
+    python benchmarks/bench_io_profiles.py --mzml run.mzML     # re-encode the spectra of a real mzML
+    python benchmarks/bench_io_profiles.py --raw run.raw       # convert with msconvert once per profile
+
+Synthetic and re-encoded files use the same binary encodings and cvParams msconvert writes for
+each profile in msconvert_utils.CONVERSION_PROFILES. For each file it reports the size, the time to
+decode every MS2 scan (iter_ms2_scans), the time for one gated pass (iter_filtered_ms2_peaks) and
+the largest m/z error against the 64-bit default. Numpress profiles need `pip install pynumpress`.
+"""
+from __future__ import annotations
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from pepwiz.msconvert_utils import CONVERSION_PROFILES, run_msconvert  # noqa: E402
+from pepwiz.mzml_utils import iter_ms2_scans, iter_filtered_ms2_peaks, open_reader, peak_array  # noqa: E402
+from pepwiz.synthetic import synthetic_run, write_mzml  # noqa: E402
+
+# (name, profile, ms2_only)
+CASES = [(p, p, False) for p in CONVERSION_PROFILES] + [("compact, MS2 only", "compact", True)]
+
+
+def spectra_from_mzml(path: Path):
+    out = []
+    from pepwiz.mzml_utils import spectrum_rt, precursor_mz_from_spec
+    with open_reader(path) as reader:
+        for spec in reader:
+            level = int(spec.get("ms level") or 0)
+            if level not in (1, 2):
+                continue
+            out.append({"level": level, "rt": spectrum_rt(spec) or 0.0,
+                        "mz": peak_array(spec["m/z array"]), "intensity": peak_array(spec["intensity array"]),
+                        "precursor_mz": precursor_mz_from_spec(spec) if level == 2 else None})
+    return out
+
+
+def _best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def measure(path: Path, gate_mz: float, repeat: int, reference=None):
+    size_mb = path.stat().st_size / 1e6
+    scans = list(iter_ms2_scans(path))
+    t_full = _best_of(lambda: sum(1 for _ in iter_ms2_scans(path)), repeat)
+    t_gate = _best_of(lambda: sum(1 for _ in iter_filtered_ms2_peaks(path, gate_mz, 20.0, None, None)), repeat)
+    err = None
+    if reference is not None and len(reference) == len(scans):
+        err = max((float(np.max(np.abs(s["mz"] - r["mz"]) / r["mz"]) * 1e6) if len(r["mz"]) else 0.0)
+                  for s, r in zip(scans, reference))
+    return {"size_mb": size_mb, "n_ms2": len(scans), "t_full": t_full, "t_gate": t_gate,
+            "max_ppm": err, "scans": scans}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    src = ap.add_mutually_exclusive_group()
+    src.add_argument("--mzml", type=Path, help="re-encode the spectra of this mzML/mzXML")
+    src.add_argument("--raw", type=Path, help="convert this RAW with msconvert for every profile")
+    ap.add_argument("--cycles", type=int, default=400, help="synthetic run length (MS1 cycles)")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--out-dir", type=Path, default=None, help="keep the generated files here")
+    args = ap.parse_args(argv)
+
+    tmp = None
+    out_dir = args.out_dir
+    if out_dir is None:
+        tmp = tempfile.TemporaryDirectory(prefix="pepwiz-io-")
+        out_dir = Path(tmp.name)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    spectra = None
+    if args.raw is None:
+        spectra = spectra_from_mzml(args.mzml) if args.mzml else synthetic_run(args.cycles)
+        ms2 = [s for s in spectra if s["level"] == 2]
+        gate_mz = ms2[0]["precursor_mz"] if ms2 else 500.0
+    try:
+        results, reference = [], None
+        for name, profile, ms2_only in CASES:
+            stem = name.replace(", ", "-").replace(" ", "_")
+            try:
+                if args.raw is not None:
+                    sub = out_dir / stem
+                    path = run_msconvert(args.raw, dest_dir=sub, overwrite=True, reuse=False,
+                                         profile=profile, ms2_only=ms2_only)
+                else:
+                    path = out_dir / f"{stem}.mzML"
+                    write_mzml(spectra, path, profile, ms2_only)
+                if args.raw is not None and reference is None:
+                    first = next(iter(iter_ms2_scans(path)), None)
+                    gate_mz = first["precursor_mz"] if first and first["precursor_mz"] else 500.0
+                res = measure(path, gate_mz, args.repeat, reference)
+            except (ImportError, RuntimeError) as e:
+                print(f"{name}: skipped ({str(e).splitlines()[0]})")
+                continue
+            if reference is None:
+                reference = res["scans"]
+            results.append((name, res))
+
+        print(f"{'profile':20} {'size MB':>8} {'MS2':>6} {'decode s':>9} {'MB/s':>7} {'scans/s':>8} "
+              f"{'gate s':>7} {'max ppm':>8}")
+        for name, r in results:
+            ppm = "ref" if r["max_ppm"] is None and r["scans"] is reference else (
+                "NA" if r["max_ppm"] is None else f"{r['max_ppm']:.4f}")
+            print(f"{name:20} {r['size_mb']:>8.2f} {r['n_ms2']:>6} {r['t_full']:>9.3f} "
+                  f"{r['size_mb'] / r['t_full']:>7.1f} {r['n_ms2'] / r['t_full']:>8.0f} "
+                  f"{r['t_gate']:>7.3f} {ppm:>8}")
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""
+Startup-time benchmark: wall time of fresh interpreters importing PepWiz.
+
+    python benchmarks/bench_startup.py                 # report
+    python benchmarks/bench_startup.py --max-ms 150    # exit 1 if `import pepwiz` median exceeds 150 ms
+
+Each case runs in a new process so nothing is cached between repeats. The bare interpreter
+start-up is measured too and subtracted, so numbers reflect PepWiz's own cost.
+"""
+from __future__ import annotations
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+
+CASES = {
+    "python (baseline)": "pass",
+    "import pepwiz": "import pepwiz",
+    "pepwiz.calc_fragments": "import pepwiz; pepwiz.calc_fragments",
+    "import pepwiz.gui": "import pepwiz.gui",
+}
+
+
+def _time_once(code: str) -> float:
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import sys; sys.path.insert(0, {str(SRC)!r}); {code}"],
+                   check=True)
+    return (time.perf_counter() - t0) * 1000.0
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--repeat", type=int, default=7)
+    ap.add_argument("--max-ms", type=float, default=None,
+                    help="fail if `import pepwiz` (minus baseline) is slower than this")
+    args = ap.parse_args(argv)
+
+    medians = {}
+    for name, code in CASES.items():
+        times = [_time_once(code) for _ in range(args.repeat)]
+        medians[name] = statistics.median(times)
+
+    base = medians["python (baseline)"]
+    print(f"{'case':28} {'median ms':>10} {'over baseline':>14}")
+    for name, ms in medians.items():
+        print(f"{name:28} {ms:>10.1f} {ms - base:>14.1f}")
+
+    if args.max_ms is not None:
+        cost = medians["import pepwiz"] - base
+        if cost > args.max_ms:
+            print(f"FAIL: import pepwiz costs {cost:.1f} ms (> {args.max_ms} ms)")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,43 +3,96 @@
 # Version
 __version__ = "0.1.0"
 
-# Public API (lightweight import surface)
-from .match_engine import (
-    calc_fragments,
-    generate_theoretical_by,
-    legacy_summary_from_spectrum,
-    nearest_match,
-    ion_meta,
-    ppm_error,
-    PROTON,
-    WATER,
-)
+# Public API (lightweight import surface).
+# Submodules are imported on first attribute access (PEP 562), so `import pepwiz`
+# doesn't pay for numpy/pyteomics/matplotlib until something actually needs them.
+_LAZY = {
+    # match_engine
+    "calc_fragments": "match_engine",
+    "generate_theoretical_by": "match_engine",
+    "legacy_summary_from_spectrum": "match_engine",
+    "legacy_summary_from_neutral": "match_engine",
+    "neutral_fragments": "match_engine",
+    "decoy_sequences": "match_engine",
+    "decoy_match_stats": "match_engine",
+    "mass_shift_search": "match_engine",
+    "peptide_neutral_mass": "match_engine",
+    "nearest_match": "match_engine",
+    "ion_meta": "match_engine",
+    "ppm_error": "match_engine",
+    "PROTON": "match_engine",
+    "WATER": "match_engine",
+    # composition
+    "ion_table": "composition",
+    "isotope_envelopes": "composition",
+    "parse_formula": "composition",
+    # mzml_utils
+    "open_reader": "mzml_utils",
+    "precursor_mz_from_spec": "mzml_utils",
+    "list_precursors_with_counts": "mzml_utils",
+    "precursor_inventory": "mzml_utils",
+    "precursor_density": "mzml_utils",
+    "average_spectrum": "mzml_utils",
+    "average_spectrum_streaming": "mzml_utils",
+    "average_spectrum_grid": "mzml_utils",
+    "GridAccumulator": "mzml_utils",
+    "accumulate_ms2_grid": "mzml_utils",
+    "deisotope_spectrum": "mzml_utils",
+    "extract_xics": "mzml_utils",
+    "suggest_rt_window": "mzml_utils",
+    "format_cluster_columns": "mzml_utils",
+    # calibration
+    "fit_ppm_calibration": "calibration",
+    "calibrate_peaks": "calibration",
+    # pipeline
+    "AnalysisCache": "pipeline",
+    "analyze": "pipeline",
+    "analyze_replicates": "pipeline",
+    "rematch": "pipeline",
+    # events
+    "EventEmitter": "events",
+    "stream": "events",
+    # selection
+    "ScanIndex": "selection",
+    "ScanSelection": "selection",
+    # batch
+    "BatchRunner": "batch",
+    "JobLedger": "batch",
+    # library
+    "SpectralLibrary": "library",
+    # msconvert_utils
+    "find_msconvert": "msconvert_utils",
+    "run_msconvert": "msconvert_utils",
+    "convert_many": "msconvert_utils",
+    "FakeConverter": "msconvert_utils",
+    # provenance
+    "ProvenanceStore": "provenance",
+    "converted_mzml_for": "provenance",
+    # visualization & legacy writer
+    "export_fragment_image": "visualize",
+    "export_annotated_spectrum": "visualize",
+    "export_xic": "visualize",
+    "decimate_peaks": "visualize",
+    "SpectrumView": "visualize",
+    "RenderQueue": "render",
+    "coverage_tensor": "coverage",
+    "export_coverage_heatmap": "visualize",
+    "export_precursor_map": "visualize",
+    "write_legacy_out": "io_legacy",
+}
 
-from .mzml_utils import (
-    open_reader,
-    precursor_mz_from_spec,
-    list_precursors_with_counts,
-    average_spectrum,
-)
+__all__ = list(_LAZY) + ["__version__"]
 
-from .msconvert_utils import (
-    find_msconvert,
-    run_msconvert,
-)
 
-# Optional: visualization & legacy writer if you want them importable too
-try:
-    from .visualize import export_fragment_image, export_annotated_spectrum
-    from .io_legacy import write_legacy_out
-except Exception:
-    # These modules might be moved/renamed later; don't break imports if missing.
-    pass
+def __getattr__(name):
+    mod = _LAZY.get(name)
+    if mod is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from importlib import import_module
+    value = getattr(import_module(f".{mod}", __name__), name)
+    globals()[name] = value  # later lookups skip __getattr__
+    return value
 
-__all__ = [
-    "calc_fragments", "generate_theoretical_by", "legacy_summary_from_spectrum",
-    "nearest_match", "ion_meta", "ppm_error", "PROTON", "WATER",
-    "open_reader", "precursor_mz_from_spec", "list_precursors_with_counts", "average_spectrum",
-    "find_msconvert", "run_msconvert",
-    "export_fragment_image", "export_annotated_spectrum", "write_legacy_out",
-    "__version__",
-]
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
@@ -0,0 +1,364 @@
+"""
+Resumable batch runs: many (file, peptide, parameters) jobs with a job ledger.
+
+The ledger is an append-only JSON-lines file; every state change of a job is one line
+({"job", "state", "attempt", ...}) and the last line for a job wins, so a batch killed mid-run
+(bad file, msconvert crash, machine sleep) loses at most the jobs that were running. Rerunning
+the same batch:
+
+  * skips jobs that finished, as long as their input file is unchanged and every output still
+    has the sha256 recorded in the ledger,
+  * retries failed jobs, with exponential backoff between attempts, up to max_attempts in total
+    (counted across runs),
+  * runs everything else in a process pool.
+
+Outputs are written atomically (temp file + os.replace), so an interrupted job never leaves a
+half-written .out behind. Figures are rendered once at the end through RenderQueue, and a
+coverage table/heatmap is written for the whole batch.
+
+Jobs CSV (one row per job; header names as in analysis_kwargs(), plus path and optional name):
+    path,sequence,charges,ppm,precursor_mz,rt_min,rt_max,top_n
+    runs/a.mzML,PEPTIDEK,"1,2",10,466.73,,,200
+
+    python -m pepwiz.batch jobs.csv --out-dir results --workers 4
+"""
+from __future__ import annotations
+import argparse
+import csv
+import hashlib
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Dict, List
+
+from .pipeline import AnalysisCache, analyze, analysis_kwargs, file_key, output_paths, write_result_out
+
+LEDGER_NAME = "pepwiz-batch.ledger.jsonl"
+
+
+def sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def job_id(job: Dict) -> str:
+    """Stable id of a job: resolved input path + normalized analysis parameters."""
+    kw = analysis_kwargs(job)
+    ident = {"path": str(Path(job["path"]).expanduser().resolve()), **kw}
+    return hashlib.sha256(json.dumps(ident, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def read_jobs(path: Path) -> List[Dict]:
+    """Jobs from a CSV (header row) or JSON-lines file; relative paths are taken from the jobs file's folder."""
+    path = Path(path)
+    with open(path, encoding="utf-8", newline="") as fh:
+        if path.suffix.lower() in (".jsonl", ".json"):
+            jobs = [json.loads(line) for line in fh if line.strip()]
+        else:
+            jobs = [{k.strip(): v for k, v in row.items() if k and v not in (None, "")} for row in csv.DictReader(fh)]
+    for job in jobs:
+        p = Path(job["path"]).expanduser()
+        job["path"] = str(p if p.is_absolute() else path.parent / p)
+    return jobs
+
+
+class JobLedger:
+    """Append-only JSON-lines log of job states; the latest record per job is its current state."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.state: Dict[str, Dict] = {}
+        self.failures: Dict[str, int] = {}       # consecutive failures on failed_input[job]
+        self.failed_input: Dict[str, list] = {}
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as fh:
+                for line in fh:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line from a crash
+                    self._apply(rec)
+
+    def _apply(self, rec: Dict):
+        job = rec["job"]
+        self.state[job] = rec
+        if rec["state"] == "failed":
+            inp = None if rec.get("input") is None else list(rec["input"])
+            if self.failed_input.get(job) != inp:
+                self.failures[job] = 0   # a replaced input file starts over
+            self.failed_input[job] = inp
+            self.failures[job] = self.failures.get(job, 0) + 1
+        elif rec["state"] == "done":
+            self.failures.pop(job, None)
+            self.failed_input.pop(job, None)
+
+    def record(self, job: str, state: str, **fields) -> Dict:
+        rec = {"job": job, "state": state, "time": time.time(), **fields}
+        with open(self.path, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps(rec, default=str) + "\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+        self._apply(rec)
+        return rec
+
+    def failure_count(self, job: str, input_key) -> int:
+        """Failures recorded for this job on this exact input (0 once the input file has changed)."""
+        if self.failed_input.get(job) != list(input_key):
+            return 0
+        return self.failures.get(job, 0)
+
+    def is_done(self, job: str, input_key) -> bool:
+        """Finished on this exact input, with every recorded output present and unchanged."""
+        rec = self.state.get(job)
+        if rec is None or rec["state"] != "done" or rec.get("input") != list(input_key):
+            return False
+        try:
+            return all(sha256_file(Path(p)) == digest for p, digest in rec.get("outputs", {}).items())
+        except OSError:
+            return False
+
+
+# ---- worker side ----
+
+_WORKER_CACHE = None
+
+
+def _analyze_job(job: Dict, source: str) -> Dict:
+    global _WORKER_CACHE
+    if _WORKER_CACHE is None:
+        _WORKER_CACHE = AnalysisCache(max_files=2)
+    t0 = time.perf_counter()
+    kw = analysis_kwargs(job)
+    seq, charges, ppm = kw.pop("seq"), kw.pop("charges"), kw.pop("ppm")
+    result = analyze(Path(job["path"]), seq, charges, ppm, kw.pop("precursor_mz"),
+                     cache=_WORKER_CACHE, log_fn=lambda _msg: None, **kw)
+    if not result["scans_count"]:
+        raise RuntimeError("no MS2 scans passed the precursor/RT filters")
+    out = output_paths(Path(source), charges)["out"]
+    tmp = out.with_name(f".{out.name}.{os.getpid()}.tmp")
+    try:
+        write_result_out(tmp, seq, charges, result, ppm=ppm, rt_min=kw["rt_min"], rt_max=kw["rt_max"],
+                         term_mod=kw["term_mod"])
+        os.replace(tmp, out)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return {
+        "seconds": time.perf_counter() - t0, "outputs": {str(out): sha256_file(out)},
+        "scans": result["scans_count"], "matched": len(result["rows"]),
+        "rows": result["rows"], "avg_spec": result["avg_spec"], "seq": seq,
+        "hits": [[r["itype"], r["idx"], r.get("inten") or 0.0] for r in result["rows"]
+                 if r.get("obs") is not None and r.get("itype") in ("b", "y")],
+    }
+
+
+def _run_job(job: Dict, source: str) -> Dict:
+    """Analyze one job and write its .out atomically; returns the result summary for the ledger."""
+    try:
+        return _analyze_job(job, source)
+    except Exception as e:
+        # parser errors (lxml) don't always pickle; send the message back instead
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+
+
+# ---- driver ----
+
+class BatchRunner:
+    """
+    Run jobs [{path, sequence, charges, ppm, precursor_mz, ...}] against a ledger in out_dir.
+    figures: subset of ("fragments", "spectrum") rendered for finished jobs; coverage: write the
+    batch coverage tables and heatmap.
+    """
+
+    def __init__(self, out_dir: Path, *, ledger: Path | None = None, workers: int | None = None,
+                 max_attempts: int = 3, backoff_s: float = 5.0, figures=(), coverage: bool = True,
+                 log_fn=print):
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.ledger = JobLedger(ledger or self.out_dir / LEDGER_NAME)
+        self.workers = max(1, int(workers or os.cpu_count() or 1))
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff_s = float(backoff_s)
+        self.figures = tuple(figures)
+        self.coverage = coverage
+        self.log_fn = log_fn
+
+    def _source(self, job: Dict, jid: str, taken: set) -> Path:
+        """Where the input would sit in out_dir so output_paths() names this job's outputs."""
+        src = Path(job["path"])
+        stem = job.get("name") or f"{src.stem}.{str(job['sequence']).strip().upper()}"
+        if stem in taken:
+            stem = f"{stem}.{jid[:8]}"  # same file + peptide with other parameters
+        taken.add(stem)
+        return self.out_dir / f"{stem}{src.suffix or '.mzML'}"
+
+    def run(self, jobs: List[Dict]) -> Dict:
+        """Returns {"done", "skipped", "failed", "gave_up", "results", "durations"} (lists of job ids / dicts)."""
+        t0 = time.perf_counter()
+        todo, skipped, gave_up, invalid, meta = [], [], [], [], {}
+        taken = set()
+        for job in jobs:
+            try:
+                jid = job_id(job)
+                input_key = file_key(job["path"])
+            except (ValueError, OSError, KeyError) as e:
+                invalid.append({"job": job, "error": f"{type(e).__name__}: {e}"})
+                continue
+            if jid in meta:
+                continue  # duplicate row
+            meta[jid] = {"job": job, "input": input_key, "source": self._source(job, jid, taken)}
+            if self.ledger.is_done(jid, input_key):
+                skipped.append(jid)
+            elif self.ledger.failure_count(jid, input_key) >= self.max_attempts:
+                gave_up.append(jid)
+            else:
+                todo.append(jid)
+        self.log_fn(f"Batch: {len(meta)} jobs | {len(skipped)} already done | {len(todo)} to run | "
+                    f"{len(gave_up)} failed {self.max_attempts}x (skipped) | {len(invalid)} invalid")
+        for bad in invalid:
+            self.log_fn(f"  invalid job {bad['job'].get('path')}: {bad['error']}")
+
+        results, failed = self._execute(todo, meta)
+
+        durations = sorted(((r["seconds"], jid) for jid, r in results.items()), reverse=True)
+        summary = {"done": sorted(results), "skipped": skipped, "failed": failed, "gave_up": gave_up,
+                   "invalid": invalid, "results": results, "durations": durations}
+        self._report(summary, meta, time.perf_counter() - t0)
+        self._postprocess(results, skipped, meta)
+        return summary
+
+    def _execute(self, todo, meta):
+        results, failed = {}, []
+        queue = [(0.0, jid) for jid in todo]   # (not before, job id)
+        running, pool = {}, None
+        try:
+            while queue or running:
+                if pool is None:
+                    pool = ProcessPoolExecutor(max_workers=min(self.workers, len(queue) + len(running)))
+                now = time.monotonic()
+                for ready, jid in sorted(queue):
+                    if len(running) >= self.workers or ready > now:
+                        continue
+                    queue.remove((ready, jid))
+                    attempt = self.ledger.failure_count(jid, meta[jid]["input"]) + 1
+                    self.ledger.record(jid, "running", attempt=attempt, path=meta[jid]["job"]["path"],
+                                       input=meta[jid]["input"])
+                    running[pool.submit(_run_job, meta[jid]["job"], str(meta[jid]["source"]))] = (jid, attempt)
+                if not running:
+                    time.sleep(max(0.0, min(r for r, _ in queue) - time.monotonic()))
+                    continue
+                timeout = max(0.05, min(r for r, _ in queue) - now) if queue else None
+                finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    jid, attempt = running.pop(fut)
+                    job = meta[jid]["job"]
+                    try:
+                        res = fut.result()
+                    except BrokenProcessPool as e:
+                        # a worker died (segfault, OOM kill); every running job fails, the pool is rebuilt
+                        self._failed(jid, attempt, f"worker crashed: {e}", queue, failed)
+                        if pool is not None:
+                            pool.shutdown(wait=False, cancel_futures=True)
+                            pool = None
+                        continue
+                    except RuntimeError as e:
+                        self._failed(jid, attempt, str(e), queue, failed)
+                        continue
+                    self.ledger.record(jid, "done", attempt=attempt, path=job["path"], input=meta[jid]["input"],
+                                       seconds=res["seconds"], scans=res["scans"], matched=res["matched"],
+                                       outputs=res["outputs"], hits=res["hits"])
+                    results[jid] = res
+                    self.log_fn(f"  done {Path(job['path']).name} {res['seq']}: {res['matched']} ions, "
+                                f"{res['scans']} scans, {res['seconds']:.1f} s")
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        return results, failed
+
+    def _failed(self, jid, attempt, err, queue, failed):
+        running = self.ledger.state[jid]  # the "running" record
+        path = running.get("path")
+        self.ledger.record(jid, "failed", attempt=attempt, error=err, path=path, input=running.get("input"))
+        label = f"{path} (attempt {attempt}/{self.max_attempts})"
+        if attempt < self.max_attempts:
+            delay = self.backoff_s * 2 ** (attempt - 1)
+            self.log_fn(f"  failed: {label}: {err}; retrying in {delay:g} s")
+            queue.append((time.monotonic() + delay, jid))
+        else:
+            self.log_fn(f"  failed: {label}: {err}; giving up")
+            failed.append(jid)
+
+    def _report(self, summary, meta, wall):
+        self.log_fn(f"Batch finished in {wall:.1f} s: {len(summary['done'])} run, {len(summary['skipped'])} skipped, "
+                    f"{len(summary['failed'])} failed, {len(summary['gave_up'])} given up.")
+        durs = [d for d, _ in summary["durations"]]
+        if len(durs) >= 2:
+            med = statistics.median(durs)
+            p90 = statistics.quantiles(durs, n=10, method="inclusive")[-1]
+            self.log_fn(f"Job time: median {med:.1f} s, p90 {p90:.1f} s, max {durs[0]:.1f} s, "
+                        f"total {sum(durs):.1f} s. Slowest:")
+            for d, jid in summary["durations"][:5]:
+                job = meta[jid]["job"]
+                flag = "  <- slow" if d > 2 * med else ""
+                self.log_fn(f"  {d:>7.1f} s  {Path(job['path']).name}  {job.get('sequence')}{flag}")
+
+    def _postprocess(self, results, skipped, meta):
+        """Figures for the jobs run now (deduplicated, parallel); coverage over every finished job."""
+        if self.figures and results:
+            from .render import RenderQueue
+            queue = RenderQueue(workers=self.workers, log_fn=self.log_fn)
+            for jid, res in results.items():
+                paths = output_paths(meta[jid]["source"], analysis_kwargs(meta[jid]["job"])["charges"])
+                if "fragments" in self.figures and res["rows"]:
+                    queue.add_fragments(res["seq"], res["rows"], paths["fragments"])
+                if "spectrum" in self.figures and res["avg_spec"] and res["rows"]:
+                    queue.add_spectrum(res["avg_spec"], res["rows"], paths["spectrum"])
+            queue.run()
+        done = sorted(set(results) | set(skipped), key=lambda jid: str(meta[jid]["source"]))
+        if self.coverage and done:
+            from .coverage import coverage_tensor, write_coverage_tables
+            from .visualize import export_coverage_heatmap
+            jobs = []
+            for jid in done:
+                rec = self.ledger.state[jid]   # skipped jobs: matched cuts kept in the ledger
+                rows = [{"itype": it, "idx": idx, "inten": inten, "obs": True} for it, idx, inten in rec["hits"]]
+                jobs.append({"label": meta[jid]["source"].stem,
+                             "seq": analysis_kwargs(meta[jid]["job"])["seq"], "rows": rows})
+            cov = coverage_tensor(jobs)
+            paths = write_coverage_tables(cov, self.out_dir / "batch")
+            self.log_fn(f"Coverage tables: {paths['jobs']}, {paths['cuts']}")
+            export_coverage_heatmap(cov, self.out_dir / "batch.coverage.svg", log_fn=self.log_fn)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Resumable PepWiz batch run (jobs CSV or JSON-lines).")
+    ap.add_argument("jobs", type=Path)
+    ap.add_argument("--out-dir", type=Path, default=None, help="default: <jobs file>.results/")
+    ap.add_argument("--ledger", type=Path, default=None, help=f"default: <out-dir>/{LEDGER_NAME}")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--max-attempts", type=int, default=3)
+    ap.add_argument("--backoff", type=float, default=5.0, help="seconds before the first retry (doubles)")
+    ap.add_argument("--figures", default="", help="comma list: fragments,spectrum")
+    ap.add_argument("--no-coverage", action="store_true")
+    args = ap.parse_args(argv)
+
+    jobs = read_jobs(args.jobs)
+    out_dir = args.out_dir or args.jobs.parent / f"{args.jobs.stem}.results"
+    runner = BatchRunner(out_dir, ledger=args.ledger, workers=args.workers, max_attempts=args.max_attempts,
+                         backoff_s=args.backoff, figures=[f for f in args.figures.split(",") if f.strip()],
+                         coverage=not args.no_coverage)
+    summary = runner.run(jobs)
+    return 1 if summary["failed"] or summary["gave_up"] or summary["invalid"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+from __future__ import annotations
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+def fit_ppm_calibration(rows, degree: int = 1, min_points: int = 5, n_iter: int = 20) -> Dict | None:
+    """
+    Robust polynomial fit of signed ppm error vs observed m/z from matched rows.
+    Tukey-biweight IRLS on a MAD scale, so wide-tolerance false hits get zero weight.
+    Returns {degree, coeffs (np.polyval order), n_points, n_inliers, mad_ppm, mz_range} or None.
+    """
+    pts = [(r["obs"], r["theo"]) for r in rows if r.get("obs") is not None and r.get("theo")]
+    if len(pts) < max(min_points, degree + 2):
+        return None
+    obs, theo = np.asarray(pts, dtype=float).T
+    ppm = (obs - theo) / theo * 1e6
+
+    w = np.ones_like(ppm)
+    for _ in range(max(1, n_iter)):
+        coeffs = np.polyfit(obs, ppm, degree, w=np.sqrt(w))
+        resid = ppm - np.polyval(coeffs, obs)
+        scale = 1.4826 * np.median(np.abs(resid - np.median(resid)))
+        if scale <= 1e-9:
+            break
+        u = resid / (4.685 * scale)
+        w_new = np.where(np.abs(u) < 1.0, (1.0 - u ** 2) ** 2, 0.0)
+        if np.count_nonzero(w_new) < degree + 2 or np.allclose(w_new, w):
+            break
+        w = w_new
+
+    resid = ppm - np.polyval(coeffs, obs)
+    inliers = w > 0
+    return {
+        "degree": int(degree),
+        "coeffs": [float(c) for c in coeffs],
+        "n_points": int(len(ppm)),
+        "n_inliers": int(np.count_nonzero(inliers)),
+        "mad_ppm": float(1.4826 * np.median(np.abs(resid[inliers]))),
+        "mz_range": [float(obs.min()), float(obs.max())],
+    }
+
+def ppm_correction_at(calibration: Dict, mzs):
+    """Fitted ppm offset at the given m/z values (clamped to the fitted m/z range)."""
+    lo, hi = calibration["mz_range"]
+    return np.polyval(calibration["coeffs"], np.clip(np.asarray(mzs, dtype=float), lo, hi))
+
+def calibrate_peaks(peaks, calibration: Dict | None) -> List[Tuple[float, float]]:
+    """Apply a fitted correction to one peak list: mz -> mz / (1 + ppm(mz)·1e-6)."""
+    if not calibration or len(peaks) == 0:
+        return list(peaks)
+    arr = np.asarray(peaks, dtype=float)
+    mz = arr[:, 0] / (1.0 + ppm_correction_at(calibration, arr[:, 0]) * 1e-6)
+    return list(zip(mz.tolist(), arr[:, 1].tolist()))
+
+def format_calibration(calibration: Dict) -> str:
+    """Human-readable correction, e.g. 'ppm(m/z) = 4.912 - 0.0003·m/z'."""
+    coeffs = calibration["coeffs"]
+    deg = len(coeffs) - 1
+    out = ""
+    for p in range(deg + 1):  # constant term first
+        c = coeffs[deg - p]
+        var = "" if p == 0 else ("·m/z" if p == 1 else f"·(m/z)^{p}")
+        if not out:
+            out = f"{c:.4g}{var}"
+        else:
+            out += f" {'-' if c < 0 else '+'} {abs(c):.4g}{var}"
+    return "ppm(m/z) = " + out
+
+
+# ---- per-file cache (sidecar JSON next to the source file) ----
+# One sidecar per source file holds several fits, each under the key of the inputs it was fitted
+# from (calibration_fit_key); the whole sidecar is dropped when the source file changes.
+
+MAX_CACHED_FITS = 32
+
+def calibration_cache_path(source_path: Path) -> Path:
+    source_path = Path(source_path)
+    return source_path.parent / f"{source_path.stem}.calibration.json"
+
+def _file_signature(path: Path) -> Dict:
+    st = Path(path).stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+def calibration_fit_key(**params) -> str:
+    """
+    Canonical key of the inputs a fit depends on (precursor, sequence, RT window, degree, ...).
+    Floats are rounded to 6 decimals so the same typed values give the same key.
+    """
+    def norm(v):
+        if isinstance(v, float):
+            return round(v, 6)
+        if isinstance(v, dict):
+            return {str(k): norm(x) for k, x in sorted(v.items())}
+        if isinstance(v, (list, tuple)):
+            return [norm(x) for x in v]
+        return v
+    return json.dumps(norm(params), sort_keys=True, separators=(",", ":"))
+
+def _read_sidecar(source_path: Path) -> Dict:
+    try:
+        data = json.loads(calibration_cache_path(source_path).read_text(encoding="utf-8"))
+        if data.get("file") == _file_signature(source_path) and isinstance(data.get("fits"), dict):
+            return data
+    except (OSError, ValueError, AttributeError):
+        pass
+    return {}
+
+def load_cached_calibration(source_path: Path, fit_key: str = "") -> Dict | None:
+    """Cached calibration for source_path and fit_key, if the file hasn't changed since it was fitted."""
+    return _read_sidecar(source_path).get("fits", {}).get(fit_key)
+
+def save_cached_calibration(source_path: Path, calibration: Dict, fit_key: str = "") -> Path | None:
+    """Add the fit under fit_key (the oldest fits beyond MAX_CACHED_FITS are dropped)."""
+    cache = calibration_cache_path(source_path)
+    try:
+        fits = _read_sidecar(source_path).get("fits", {})
+        fits.pop(fit_key, None)
+        fits[fit_key] = calibration
+        while len(fits) > MAX_CACHED_FITS:
+            del fits[next(iter(fits))]
+        cache.write_text(json.dumps({
+            "source": Path(source_path).name,
+            "file": _file_signature(source_path),
+            "fits": fits,
+        }, indent=2), encoding="utf-8")
+        return cache
+    except OSError:
+        return None
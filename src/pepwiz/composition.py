@@ -0,0 +1,205 @@
+"""
+Elemental compositions and exact masses for peptides and their b/y fragments.
+
+Every residue and terminal group is an integer (C, H, N, O, S) count vector. Fragment ladders are
+cumulative sums of those counts, which are exact, and each fragment is converted to a mass once
+(counts x monoisotopic element masses) instead of summing rounded residue masses. Residues with a
+user-set mass (B/J/X overrides) have no formula; their masses are carried in a separate float term.
+
+ion_table() is the single fragment table behind calc_fragments() and generate_theoretical_by();
+it can also attach isotope envelopes (relative abundance and exact mass offset of the M, M+1, ...
+peaks) computed from each fragment's composition.
+"""
+from __future__ import annotations
+import math
+import re
+from typing import Dict
+
+import numpy as np
+
+ELEMENTS = ("C", "H", "N", "O", "S")
+
+# (exact mass, abundance) per stable isotope, lightest first (AME2016 masses, IUPAC abundances)
+ISOTOPES = {
+    "C": ((12.0, 0.9893), (13.00335483507, 0.0107)),
+    "H": ((1.00782503223, 0.999885), (2.01410177812, 0.000115)),
+    "N": ((14.00307400443, 0.99636), (15.00010889888, 0.00364)),
+    "O": ((15.99491461957, 0.99757), (16.99913175650, 0.00038), (17.99915961286, 0.00205)),
+    "S": ((31.9720711744, 0.9499), (32.9714589098, 0.0075), (33.967867004, 0.0425), (35.96708071, 0.0001)),
+}
+MONO = np.array([ISOTOPES[e][0][0] for e in ELEMENTS])
+PROTON = 1.007276466812
+
+RESIDUE_FORMULAS = {
+    "A": "C3H5NO", "R": "C6H12N4O", "N": "C4H6N2O2", "D": "C4H5NO3", "C": "C3H5NOS",
+    "E": "C5H7NO3", "Q": "C5H8N2O2", "G": "C2H3NO", "H": "C6H7N3O", "I": "C6H11NO",
+    "L": "C6H11NO", "K": "C6H12N2O", "M": "C5H9NOS", "F": "C9H9NO", "P": "C5H7NO",
+    "S": "C3H5NO2", "T": "C4H7NO2", "W": "C11H10N2O", "Y": "C9H9NO2", "V": "C5H9NO",
+}
+
+# Group added to the y-ion residue sum (and the peptide) for each C-terminus; b-ions carry no
+# terminal group. Decarboxylated (daptides) = H2O - CH2O2.
+C_TERMINAL = {
+    "none": "H2O",
+    "amidated": "H3N",
+    "dehydrated": "",
+    "decarboxylated": "C-1O-1",
+}
+
+
+def parse_formula(formula: str) -> np.ndarray:
+    """'C3H5NO' / 'C-1O-1' -> count vector over ELEMENTS."""
+    counts = np.zeros(len(ELEMENTS), dtype=np.int64)
+    pos = 0
+    for m in re.finditer(r"([A-Z][a-z]?)(-?\d*)", formula):
+        if m.start() != pos or m.group(1) not in ELEMENTS:
+            raise ValueError(f"unsupported formula: {formula!r}")
+        counts[ELEMENTS.index(m.group(1))] += int(m.group(2) or 1)
+        pos = m.end()
+    if pos != len(formula):
+        raise ValueError(f"unsupported formula: {formula!r}")
+    return counts
+
+
+def format_formula(counts) -> str:
+    """Count vector -> Hill-ordered formula string ('C6H11NO')."""
+    return "".join(f"{e}{'' if n == 1 else n}" for e, n in zip(ELEMENTS, np.asarray(counts).tolist()) if n)
+
+
+def composition_mass(counts) -> float:
+    """Monoisotopic mass of a count vector (exactly rounded sum)."""
+    return math.fsum(float(n) * m for n, m in zip(np.asarray(counts).tolist(), MONO.tolist()))
+
+
+RESIDUE_COMPOSITION = {aa: parse_formula(f) for aa, f in RESIDUE_FORMULAS.items()}
+RESIDUE_MASS = {aa: composition_mass(c) for aa, c in RESIDUE_COMPOSITION.items()}
+C_TERMINAL_COMPOSITION = {k: parse_formula(f) for k, f in C_TERMINAL.items()}
+
+
+def c_terminal_key(term_mod: str | None) -> str:
+    """GUI/legacy terminal-mod strings ('C-term: Amidated', 'Amidation', 'Daptide decarb (y)', ...) -> C_TERMINAL key."""
+    t = str(term_mod or "").lower()
+    if "amid" in t:
+        return "amidated"
+    if "dehydrat" in t:
+        return "dehydrated"
+    if "decarb" in t:
+        return "decarboxylated"
+    return "none"
+
+
+def residue_arrays(seq: str, overrides: dict | None = None):
+    """
+    (L, 5) residue compositions and (L,) override masses; overridden residues have zero composition.
+    Raises ValueError for a residue that is neither standard nor overridden (B, J, X, Z, ...).
+    """
+    overrides = overrides or {}
+    comp = np.zeros((len(seq), len(ELEMENTS)), dtype=np.int64)
+    extra = np.zeros(len(seq))
+    for i, aa in enumerate(seq):
+        if aa in overrides:
+            extra[i] = float(overrides[aa])
+        elif aa in RESIDUE_COMPOSITION:
+            comp[i] = RESIDUE_COMPOSITION[aa]
+        else:
+            raise ValueError(f"unknown residue {aa!r} at position {i + 1} of {seq}; give its mass in overrides")
+    return comp, extra
+
+
+def peptide_composition(seq: str, overrides: dict | None = None, term_mod: str | None = None):
+    """(composition, override mass) of the intact neutral peptide."""
+    comp, extra = residue_arrays(seq, overrides)
+    return comp.sum(axis=0) + C_TERMINAL_COMPOSITION[c_terminal_key(term_mod)], math.fsum(extra.tolist())
+
+
+def peptide_mass(seq: str, overrides: dict | None = None, term_mod: str | None = None) -> float:
+    comp, extra = peptide_composition(seq, overrides, term_mod)
+    return composition_mass(comp) + extra
+
+
+def ion_table(seq: str, charges, overrides: dict | None = None, term_mod: str | None = None,
+              n_isotopes: int = 0) -> Dict:
+    """
+    b1..bL and y1..yL for every charge, in calc_fragments() order (per z: all b, then all y).
+    Returns {itype, idx, z, label (lists/arrays, one entry per ion), neutral, mz,
+    composition (n, 5), extra (override mass in the fragment)} and, with n_isotopes > 0,
+    isotopes / isotope_offsets (n, n_isotopes) from isotope_envelopes().
+    """
+    comp, extra = residue_arrays(seq, overrides)
+    L = len(seq)
+    b_comp, b_extra = np.cumsum(comp, axis=0), np.cumsum(extra)
+    y_comp = np.cumsum(comp[::-1], axis=0) + C_TERMINAL_COMPOSITION[c_terminal_key(term_mod)]
+    y_extra = np.cumsum(extra[::-1])
+    ladder_comp = np.vstack([b_comp, y_comp])
+    # counts are exact; products by element mass are exact to 1 ulp, summed with the override term
+    ladder_mass = (ladder_comp * MONO).sum(axis=1) + np.concatenate([b_extra, y_extra])
+
+    zs = np.array([int(z) for z in charges], dtype=np.int64)
+    n_z = len(zs)
+    idx = np.tile(np.concatenate([np.arange(1, L + 1)] * 2), n_z)
+    itype = (["b"] * L + ["y"] * L) * n_z
+    z = np.repeat(zs, 2 * L)
+    neutral = np.tile(ladder_mass, n_z)
+    table = {
+        "itype": itype, "idx": idx, "z": z,
+        "label": [f"{t}{i}^{c}+" for t, i, c in zip(itype, idx.tolist(), z.tolist())],
+        "neutral": neutral,
+        "mz": (neutral + z * PROTON) / z,
+        "composition": np.tile(ladder_comp, (n_z, 1)),
+        "extra": np.tile(np.concatenate([b_extra, y_extra]), n_z),
+    }
+    if n_isotopes > 0:
+        ab, off = isotope_envelopes(ladder_comp, n_isotopes)
+        table["isotopes"] = np.tile(ab, (n_z, 1))
+        table["isotope_offsets"] = np.tile(off, (n_z, 1))
+    return table
+
+
+# ---- isotope envelopes ----
+
+def _combine(pa, ma, pb, mb):
+    """Convolve rows of two (abundance, mass offset) envelope batches (k, n), truncated to n peaks."""
+    n = pa.shape[1]
+    p, w = np.zeros_like(pa), np.zeros_like(pa)
+    for i in range(n):
+        prod = pa[:, i:i + 1] * pb[:, :n - i]
+        p[:, i:] += prod
+        w[:, i:] += prod * (ma[:, i:i + 1] + mb[:, :n - i])
+    return p, np.divide(w, p, out=np.zeros_like(w), where=p > 0)
+
+
+def _atom_envelope(element: str, n: int):
+    """One atom: abundance and mass offset by extra neutron count 0..n-1."""
+    iso = ISOTOPES[element]
+    p, m = np.zeros(n), np.zeros(n)
+    for mass, ab in iso:
+        k = int(round(mass - iso[0][0]))
+        if k < n:
+            p[k], m[k] = ab, mass - iso[0][0]
+    return p, m
+
+
+def isotope_envelopes(compositions, n_peaks: int = 4):
+    """
+    compositions: (k, 5) count vectors. Returns (abundance, mass_offset), both (k, n_peaks):
+    the fraction of molecules in peak M+j and that peak's mean mass above the monoisotopic mass
+    (e.g. ~1.0029 for M+1 of a 12-mer). Negative counts are treated as zero.
+    Per element, counts**atom is built by binary exponentiation over all rows at once.
+    """
+    comps = np.maximum(np.atleast_2d(np.asarray(compositions, dtype=np.int64)), 0)
+    k = len(comps)
+    p = np.zeros((k, n_peaks))
+    p[:, 0] = 1.0
+    m = np.zeros((k, n_peaks))
+    for j, element in enumerate(ELEMENTS):
+        count = comps[:, j].copy()
+        bp, bm = (np.tile(a, (k, 1)) for a in _atom_envelope(element, n_peaks))
+        while count.any():
+            odd = (count & 1).astype(bool)[:, None]
+            if odd.any():
+                cp, cm = _combine(p, m, bp, bm)
+                p, m = np.where(odd, cp, p), np.where(odd, cm, m)
+            count >>= 1
+            if count.any():
+                bp, bm = _combine(bp, bm, bp, bm)
+    return p, m
@@ -0,0 +1,99 @@
+"""
+Backbone cleavage coverage across a batch of matched results.
+
+A job is one (file, peptide) result: {"label", "seq", "rows"} with rows from
+legacy_summary_from_spectrum(). Cut c (1..L-1) is the bond after residue c; b_c and y_(L-c)
+both report it, as in match_engine.compute_cleavages_from_masses(). All matched rows of all
+jobs are flattened once and scattered into a (jobs x cuts x series) tensor with numpy.
+"""
+from __future__ import annotations
+import csv
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from . import events
+
+SERIES = ("b", "y")
+
+
+def coverage_tensor(jobs) -> Dict:
+    """
+    jobs: [{"label", "seq", "rows"}]. Returns
+      {labels, seqs, lengths (J,), n_cuts, series, matched (J, C, 2) bool,
+       intensity (J, C, 2) summed matched intensity, valid (J, C) bool (cut exists for that peptide)}
+    where C is the longest peptide's cut count; column k is cut k+1.
+    """
+    jobs = list(jobs)
+    labels = [str(j.get("label", i)) for i, j in enumerate(jobs)]
+    seqs = [j["seq"] for j in jobs]
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    n_jobs = len(jobs)
+    n_cuts = int(max(1, lengths.max() - 1)) if n_jobs else 1
+
+    counts = np.array([len(j["rows"] or ()) for j in jobs], dtype=np.int64)
+    flat = [r for j in jobs for r in (j["rows"] or ())]
+    job = np.repeat(np.arange(n_jobs), counts)
+    itype = np.array([r.get("itype") for r in flat], dtype=object)
+    idx = np.fromiter((r.get("idx") or 0 for r in flat), dtype=np.int64, count=len(flat))
+    inten = np.fromiter((r.get("inten") or 0.0 for r in flat), dtype=np.float64, count=len(flat))
+    has_obs = np.fromiter((r.get("obs") is not None for r in flat), dtype=bool, count=len(flat))
+
+    is_b, is_y = itype == "b", itype == "y"
+    L = lengths[job] if len(flat) else np.empty(0, dtype=np.int64)
+    cut = np.where(is_b, idx, L - idx)
+    ok = (is_b | is_y) & has_obs & (idx >= 1) & (idx < L) & (cut >= 1) & (cut < L)
+
+    cell = (job[ok] * n_cuts + (cut[ok] - 1)) * 2 + is_y[ok].astype(np.int64)
+    size = n_jobs * n_cuts * 2
+    hits = np.bincount(cell, minlength=size).reshape(n_jobs, n_cuts, 2)
+    summed = np.bincount(cell, weights=inten[ok], minlength=size).reshape(n_jobs, n_cuts, 2)
+    valid = np.arange(1, n_cuts + 1)[None, :] < lengths[:, None]
+    return {
+        "labels": labels, "seqs": seqs, "lengths": lengths, "n_cuts": n_cuts, "series": SERIES,
+        "matched": hits > 0, "intensity": summed, "valid": valid,
+    }
+
+
+def coverage_summary(cov: Dict) -> List[Dict]:
+    """Per-job coverage: cuts seen by b, y, either and both, and the covered fraction of the backbone."""
+    m = cov["matched"] & cov["valid"][:, :, None]
+    b, y = m[:, :, 0].sum(axis=1), m[:, :, 1].sum(axis=1)
+    either, both = m.any(axis=2).sum(axis=1), m.all(axis=2).sum(axis=1)
+    total = cov["valid"].sum(axis=1)
+    frac = np.divide(either, total, out=np.zeros(len(total)), where=total > 0)
+    return [
+        {"label": lbl, "sequence": seq, "cuts": int(t), "b_cuts": int(nb), "y_cuts": int(ny),
+         "covered": int(e), "both": int(bo), "coverage_pct": float(f * 100.0)}
+        for lbl, seq, t, nb, ny, e, bo, f in zip(cov["labels"], cov["seqs"], total, b, y, either, both, frac)
+    ]
+
+
+def write_coverage_tables(cov: Dict, out_prefix: Path) -> Dict[str, Path]:
+    """
+    <prefix>.coverage.csv      one row per job (coverage_summary)
+    <prefix>.coverage_cuts.csv one row per (job, cut): bond, b/y matched flags and intensities
+    """
+    out_prefix = Path(out_prefix)
+    paths = {"jobs": out_prefix.with_name(out_prefix.name + ".coverage.csv"),
+             "cuts": out_prefix.with_name(out_prefix.name + ".coverage_cuts.csv")}
+    summary = coverage_summary(cov)
+    with open(paths["jobs"], "w", encoding="utf-8", newline="") as fh:
+        w = csv.DictWriter(fh, fieldnames=list(summary[0]) if summary else ["label"])
+        w.writeheader()
+        for s in summary:
+            w.writerow({**s, "coverage_pct": f"{s['coverage_pct']:.1f}"})
+
+    j, c = np.nonzero(cov["valid"])
+    m, it = cov["matched"][j, c], cov["intensity"][j, c]
+    with open(paths["cuts"], "w", encoding="utf-8", newline="") as fh:
+        w = csv.writer(fh)
+        w.writerow(["label", "sequence", "cut", "bond", "b", "y", "b_intensity", "y_intensity"])
+        for jj, cc, (mb, my), (ib, iy) in zip(j.tolist(), c.tolist(), m.tolist(), it.tolist()):
+            seq = cov["seqs"][jj]
+            w.writerow([cov["labels"][jj], seq, cc + 1, f"{seq[cc]}|{seq[cc + 1]}",
+                        int(mb), int(my), f"{ib:.6g}", f"{iy:.6g}"])
+    for kind, path in paths.items():
+        events.output(path, f"coverage_{kind}")
+    return paths
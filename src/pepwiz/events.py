@@ -0,0 +1,206 @@
+"""
+Structured progress events for embedding the pipeline (job runners, services, notebooks).
+
+An event is a plain dict with "type", "time" (epoch seconds) and type-specific fields:
+
+  stage_start   {stage, ...}
+  stage_end     {stage, seconds, ok, ...}
+  progress      {stage, done, total (None if unknown), unit, rate (unit/s), path (file being read)}
+  warning       {message, code, ...}           e.g. code="precursor_snap", delta_ppm=62.1
+  output        {path, kind}                   every file the pipeline writes
+  log           {message}                      the free-text log_fn lines, unchanged
+
+Sync: pass an EventEmitter to analyze(..., events=EventEmitter(callback)).
+Async: `async for ev in stream(analyze, path, seq, ...)` runs the call in a thread and yields
+its events; the last one is {"type": "result", "result": ...}.
+
+The active emitter is held in a context variable, so the hot loops in mzml_utils report
+progress without a callback parameter on every function in between. With no emitter active a
+ticker is a no-op; with one, progress is emitted at most every min_interval seconds per stage.
+"""
+from __future__ import annotations
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+_CURRENT: contextvars.ContextVar = contextvars.ContextVar("pepwiz_events", default=None)
+
+
+class EventEmitter:
+    """Fans events out to callbacks; progress is rate-limited to one event per min_interval per stage."""
+
+    def __init__(self, *callbacks: Callable[[Dict], None], min_interval: float = 0.25):
+        self.callbacks: List[Callable[[Dict], None]] = list(callbacks)
+        self.min_interval = float(min_interval)
+
+    def subscribe(self, callback: Callable[[Dict], None]):
+        self.callbacks.append(callback)
+        return callback
+
+    def emit(self, type: str, **fields) -> Dict:
+        event = {"type": type, "time": time.time(), **fields}
+        for cb in self.callbacks:
+            cb(event)
+        return event
+
+    @contextmanager
+    def stage(self, name: str, **fields):
+        self.emit("stage_start", stage=name, **fields)
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.emit("stage_end", stage=name, seconds=time.perf_counter() - t0, ok=ok, **fields)
+
+    def ticker(self, stage: str, total: int | None = None, unit: str = "scans", **fields) -> "Ticker":
+        return Ticker(self, stage, total, unit, fields)
+
+    def warning(self, message: str, code: str = "warning", **fields):
+        self.emit("warning", message=message, code=code, **fields)
+
+    def output(self, path, kind: str):
+        self.emit("output", path=str(path), kind=kind)
+
+    def log_fn(self, log_fn=None):
+        """A log_fn that emits each line as a "log" event and still passes it on to log_fn."""
+        def _log(msg):
+            self.emit("log", message=str(msg))
+            if log_fn is not None:
+                log_fn(msg)
+        return _log
+
+
+class Ticker:
+    """Counts work items in a hot loop; emits a progress event at most every min_interval seconds."""
+
+    __slots__ = ("emitter", "stage", "total", "unit", "fields", "done", "_t0", "_next")
+
+    def __init__(self, emitter: EventEmitter, stage: str, total: int | None, unit: str, fields: Dict):
+        self.emitter, self.stage, self.total, self.unit, self.fields = emitter, stage, total, unit, fields
+        self.done = 0
+        self._t0 = time.perf_counter()
+        self._next = self._t0 + emitter.min_interval
+
+    def tick(self, n: int = 1):
+        self.done += n
+        now = time.perf_counter()
+        if now >= self._next:
+            self._next = now + self.emitter.min_interval
+            self._emit(now)
+
+    def close(self):
+        """Final progress event (always emitted, so consumers see the end count)."""
+        self._emit(time.perf_counter())
+
+    def _emit(self, now: float):
+        elapsed = now - self._t0
+        self.emitter.emit("progress", stage=self.stage, done=self.done, total=self.total, unit=self.unit,
+                          rate=self.done / elapsed if elapsed > 0 else None, **self.fields)
+
+
+class _NullTicker:
+    __slots__ = ()
+
+    def tick(self, n: int = 1):
+        pass
+
+    def close(self):
+        pass
+
+
+_NULL_TICKER = _NullTicker()
+
+
+# ---- module-level helpers used inside the pipeline (no-ops without an active emitter) ----
+
+def current() -> EventEmitter | None:
+    return _CURRENT.get()
+
+
+@contextmanager
+def using(emitter: EventEmitter | None):
+    """Make emitter the active one for this thread/task (None keeps the current one)."""
+    if emitter is None:
+        yield current()
+        return
+    token = _CURRENT.set(emitter)
+    try:
+        yield emitter
+    finally:
+        _CURRENT.reset(token)
+
+
+def ticker(stage: str, total: int | None = None, unit: str = "scans", **fields):
+    em = _CURRENT.get()
+    return _NULL_TICKER if em is None else em.ticker(stage, total, unit, **fields)
+
+
+@contextmanager
+def stage(name: str, **fields):
+    em = _CURRENT.get()
+    if em is None:
+        yield
+    else:
+        with em.stage(name, **fields):
+            yield
+
+
+def warning(message: str, code: str = "warning", **fields):
+    em = _CURRENT.get()
+    if em is not None:
+        em.warning(message, code, **fields)
+
+
+def output(path, kind: str):
+    em = _CURRENT.get()
+    if em is not None:
+        em.output(path, kind)
+
+
+def with_events(fn):
+    """
+    Adds an events=EventEmitter keyword to fn: the emitter is active while fn runs and fn's
+    log_fn lines become "log" events (and still go to log_fn if one was passed).
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, events: EventEmitter | None = None, **kwargs):
+        if events is None:
+            return fn(*args, **kwargs)
+        kwargs["log_fn"] = events.log_fn(kwargs.get("log_fn"))
+        with using(events):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+async def stream(fn, *args, min_interval: float = 0.25, **kwargs):
+    """
+    Async iterator over the events of fn(*args, events=..., **kwargs) run in a worker thread.
+    Yields event dicts, then {"type": "result", "result": value}; re-raises fn's exception.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()   # bounded in practice: progress is rate-limited
+    done = object()
+
+    def push(event):
+        loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    emitter = EventEmitter(push, min_interval=min_interval)
+
+    def run():
+        try:
+            return fn(*args, events=emitter, **kwargs)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    future = loop.run_in_executor(None, contextvars.copy_context().run, run)
+    while True:
+        event = await queue.get()
+        if event is done:
+            break
+        yield event
+    yield {"type": "result", "time": time.time(), "result": await future}
@@ -0,0 +1,117 @@
+"""
+Stand-in for ProteoWizard msconvert (no Windows or vendor libraries needed).
+
+Takes msconvert's command line as run_msconvert() builds it and turns a synthetic "RAW"
+(see synthetic.write_raw_description) into mzML with the requested encoding:
+
+    python -m pepwiz.fakeconvert run.raw --mzML --zlib --64 --filter "peakPicking true 2-" \\
+        --outfile run.mzML --outdir out
+
+Injected behaviour, for exercising retries, parallel conversion and caching:
+  --latency S / --jitter S   sleep S (+ uniform 0..jitter) seconds before converting
+  --fail-rate P              fail this fraction of conversions (--seed makes it repeatable per file)
+  --fail-match TEXT          fail every input whose file name contains TEXT
+  --fail-mode exit|no-output exit non-zero with a message, or exit 0 without writing the mzML
+Use it through msconvert_utils.FakeConverter (or PEPWIZ_CONVERTER=fake).
+"""
+from __future__ import annotations
+import argparse
+import hashlib
+import random
+import sys
+import time
+from pathlib import Path
+
+VERSION = "pepwiz-fakeconvert 1.0"
+
+
+def encoding_from_options(args) -> tuple:
+    """msconvert encoding flags -> synthetic.ENCODINGS-style ((mz dtype, codec), (intensity dtype, codec))."""
+    zlib = "+zlib" if args.zlib else ""
+    mz_dt = "f4" if args.b32 or args.mz32 else "f8"
+    it_dt = "f4" if args.b32 or args.inten32 else "f8"
+    mz_codec = "linear" + zlib if args.numpressLinear else ("zlib" if args.zlib else "none")
+    it_codec = "slof" + zlib if args.numpressSlof else ("zlib" if args.zlib else "none")
+    return (mz_dt, mz_codec), (it_dt, it_codec)
+
+
+def _should_fail(args, raw: Path) -> bool:
+    if args.fail_match and args.fail_match in raw.name:
+        return True
+    if args.fail_rate <= 0:
+        return False
+    if args.seed is None:
+        return random.random() < args.fail_rate
+    digest = hashlib.sha256(f"{args.seed}:{raw.name}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64 < args.fail_rate
+
+
+def _parser():
+    ap = argparse.ArgumentParser(prog="fakeconvert", description="msconvert stand-in for synthetic RAW files")
+    ap.add_argument("input", nargs="?", type=Path)
+    ap.add_argument("--mzML", action="store_true")
+    ap.add_argument("--zlib", action="store_true")
+    ap.add_argument("--64", dest="b64", action="store_true")
+    ap.add_argument("--32", dest="b32", action="store_true")
+    ap.add_argument("--mz64", action="store_true")
+    ap.add_argument("--mz32", action="store_true")
+    ap.add_argument("--inten64", action="store_true")
+    ap.add_argument("--inten32", action="store_true")
+    ap.add_argument("--numpressLinear", action="store_true")
+    ap.add_argument("--numpressSlof", action="store_true")
+    ap.add_argument("--filter", action="append", default=[])
+    ap.add_argument("--outfile", default=None)
+    ap.add_argument("--outdir", type=Path, default=Path("."))
+    ap.add_argument("--latency", type=float, default=0.0)
+    ap.add_argument("--jitter", type=float, default=0.0)
+    ap.add_argument("--fail-rate", type=float, default=0.0)
+    ap.add_argument("--fail-match", default=None)
+    ap.add_argument("--fail-mode", choices=("exit", "no-output"), default="exit")
+    ap.add_argument("--seed", type=int, default=None)
+    return ap
+
+
+def main(argv=None) -> int:
+    if argv is None:
+        argv = sys.argv[1:]
+    if "--help" in argv or not argv:
+        # like msconvert: usage plus a release line, exit 0
+        print(f"Usage: fakeconvert [options] <synthetic.raw>\nrelease: {VERSION.split()[-1]} ({VERSION})")
+        return 0
+    args = _parser().parse_args(argv)
+    if args.input is None:
+        print("fakeconvert: no input file", file=sys.stderr)
+        return 1
+    if args.latency > 0 or args.jitter > 0:
+        time.sleep(args.latency + random.uniform(0, args.jitter))
+    if _should_fail(args, args.input):
+        print(f"fakeconvert: injected failure for {args.input.name}", file=sys.stderr)
+        return 0 if args.fail_mode == "no-output" else 1
+
+    from .synthetic import read_raw_description, run_from_description, write_mzml
+    try:
+        desc = read_raw_description(args.input)
+    except (OSError, RuntimeError) as e:
+        print(f"fakeconvert: {e}", file=sys.stderr)
+        return 1
+    ms2_only = False
+    for f in args.filter:
+        if f.split() == ["msLevel", "2"]:
+            ms2_only = True
+        elif not f.startswith("peakPicking"):
+            print(f"fakeconvert: filter ignored: {f}", file=sys.stderr)
+    args.outdir.mkdir(parents=True, exist_ok=True)
+    out = args.outdir / (args.outfile or args.input.with_suffix(".mzML").name)
+    tmp = out.with_name(out.name + ".part")
+    try:
+        write_mzml(run_from_description(desc), tmp, ms2_only=ms2_only, encoding=encoding_from_options(args))
+    except ImportError as e:
+        print(f"fakeconvert: {e}", file=sys.stderr)
+        return 1
+    tmp.replace(out)
+    print(f"fakeconvert: wrote {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,40 +8,16 @@ from tkinter import ttk, filedialog, messagebox
 from pathlib import Path
 import re
 import os, json, shutil, subprocess, tempfile
+import queue, threading
 
 from pepwiz.msconvert_utils import (
+    CONVERSION_PROFILES,
     find_msconvert,
     run_msconvert,
 )
 
-from pepwiz.mzml_utils import (
-    open_reader,
-    precursor_mz_from_spec,
-    list_precursors_with_counts,
-    iter_filtered_ms2_peaks,
-    average_spectrum,
-)
-
-from pepwiz.match_engine import (
-    PROTON,
-    WATER,
-    AA_MASS,
-    generate_theoretical_by,
-    ppm_error,
-    ppm_delta,
-    calc_fragments,
-    legacy_summary_from_spectrum,
-    nearest_match,
-    ion_meta,
-    compute_cleavages_from_masses,
-)
-
-from pepwiz.visualize import (
-    export_fragment_image,
-    export_annotated_spectrum,
-)
-
-from pepwiz.io_legacy import write_legacy_out
+# Analysis/plotting modules pull in numpy, pyteomics and matplotlib. They are imported where
+# they're used (and warmed up in the background once the window is up) so the GUI opens fast.
   
        
 def parse_rt_window(s: str):
@@ -77,14 +53,31 @@ class PepWizGUI(tk.Tk):
         self.J_var      = tk.StringVar()
         self.X_var      = tk.StringVar()
         self.keep_mzml_var = tk.BooleanVar(value=False)  # default: don’t keep mzML
+        self.conv_profile_var = tk.StringVar(value="default")  # msconvert output encoding
+        self.ms2_only_var = tk.BooleanVar(value=False)   # drop MS1 on conversion (no Suggest RT)
         self.term_mod_var = tk.StringVar(value="None")
         self.topn_var = tk.StringVar(value="200")
         self.draw_img_var = tk.BooleanVar(value=False)   #default dont generate fragment image
+        self.deiso_var = tk.BooleanVar(value=False)      #deisotope + assign fragment charges
+        self.decoy_var = tk.BooleanVar(value=False)      #decoy false-match estimate
+        self.n_decoys_var = tk.StringVar(value="200")
+        self.calib_var = tk.BooleanVar(value=False)      #two-pass mass recalibration
+        self.calib_ppm_var = tk.StringVar(value="30")    #first-pass (wide) tolerance
+        self.mem_budget_var = tk.StringVar(value="")     #MB; blank = keep scans in memory
+        self.lib_add_var = tk.BooleanVar(value=False)    #store the result in the spectral library
+        self.open_search_var = tk.BooleanVar(value=False)  #localize an unknown precursor mass shift
+        self.averaging_var = tk.StringVar(value="Greedy (legacy)")  #or the mergeable log grid
         
         self.ppm_var.set("10")
         self.draw_spec_var  = tk.BooleanVar(value=False)  # export annotated spectrum
         self.label_topn_var = tk.StringVar(value="30")    # max labels to draw on spectrum
         self.min_pct_var    = tk.StringVar(value="5")     # min % of base peak to label
+        self._cache = None                               # AnalysisCache, created on first use
+        self._bg_queue = queue.Queue()                   # log lines from background threads
+        self._replicate_files = []                       # >= 2 files -> consensus run across replicates
+        self._viewer = None                              # SpectrumWindow, opened on demand
+        self._last_result = None                         # last run's analyze() result, for the viewer
+        self._rematch_job = None
 
 #4) Widgets and layout
         pad = {"padx": 8, "pady": 6}
@@ -94,6 +87,7 @@ class PepWizGUI(tk.Tk):
         ttk.Label(top, text="Choose .raw/.mzXML/.mzML file:").grid(row=0, column=0, sticky=tk.W)
         ttk.Entry(top, textvariable=self.msfile_var, width=70).grid(row=0, column=1, sticky=tk.W)
         ttk.Button(top, text="Browse", command=self._choose_msfile).grid(row=0, column=2, sticky=tk.W)
+        ttk.Button(top, text="Replicates…", command=self._choose_replicates).grid(row=0, column=3, sticky=tk.W)
         
         keep_row = ttk.Frame(self); keep_row.pack(fill=tk.X, padx=8, pady=0)
         ttk.Checkbutton(
@@ -101,6 +95,10 @@ class PepWizGUI(tk.Tk):
             text="Save converted mzML next to RAW",
             variable=self.keep_mzml_var
         ).grid(row=0, column=0, sticky=tk.W)
+        ttk.Label(keep_row, text="Conversion profile:").grid(row=0, column=1, sticky=tk.W, padx=(16,0))
+        ttk.OptionMenu(keep_row, self.conv_profile_var, self.conv_profile_var.get(),
+                       *CONVERSION_PROFILES).grid(row=0, column=2, sticky=tk.W)
+        ttk.Checkbutton(keep_row, text="MS2 only", variable=self.ms2_only_var).grid(row=0, column=3, sticky=tk.W)
 
         #-------Middle row: parameteres------
         mid = ttk.Frame(self); mid.pack(fill=tk.X, **pad)
@@ -118,17 +116,34 @@ class PepWizGUI(tk.Tk):
             "C-term: Dehydrated",
             "C-term: Decarboxylated (Daptides)"
         ).grid(row=0, column=1, sticky=tk.W)
+        ttk.Checkbutton(mod_row, text="Open search: localize unknown precursor mass shift",
+                        variable=self.open_search_var).grid(row=0, column=2, sticky=tk.W, padx=(16,0))
         
         ttk.Label(mid, text="PPM tolerance:").grid(row=1, column=0, sticky=tk.W)
         ttk.Entry(mid, textvariable=self.ppm_var, width=10).grid(row=1, column=1, sticky=tk.W)
+        ttk.Checkbutton(mid, text="Auto-calibrate, first pass at ppm:",
+                        variable=self.calib_var).grid(row=1, column=3, sticky=tk.W, padx=(16,0))
+        ttk.Entry(mid, textvariable=self.calib_ppm_var, width=6).grid(row=1, column=4, sticky=tk.W)
 
         ttk.Label(mid, text="Fragment charge(s):").grid(row=2, column=0, sticky=tk.W)
         ttk.Entry(mid, textvariable=self.z_var, width=10).grid(row=2, column=1, sticky=tk.W)
         ttk.Label(mid, text="e.g., 1 or 1,2").grid(row=2, column=2, sticky=tk.W)
+        ttk.Checkbutton(mid, text="Deisotope (charges up to the max z above)",
+                        variable=self.deiso_var).grid(row=2, column=3, sticky=tk.W, padx=(16,0))
 
         topn_row = ttk.Frame(self); topn_row.pack(fill=tk.X, padx=8, pady=0)
-        ttk.Label(topn_row, text="Top peaks to match:").grid(row=0, column=0, sticky=tk.W)
-        ttk.Entry(topn_row, textvariable=self.topn_var, width=8).grid(row=0, column=1, sticky=tk.W)
+        # 200 = global top N; 10/100 = top 10 per 100 m/z window; snr:3 = 3x local noise
+        ttk.Label(topn_row, text="Top peaks to match (200, 10/100, snr:3):").grid(row=0, column=0, sticky=tk.W)
+        ttk.Entry(topn_row, textvariable=self.topn_var, width=10).grid(row=0, column=1, sticky=tk.W)
+        ttk.Checkbutton(topn_row, text="Decoy false-match estimate, decoys:",
+                        variable=self.decoy_var).grid(row=0, column=2, sticky=tk.W, padx=(16,0))
+        ttk.Entry(topn_row, textvariable=self.n_decoys_var, width=6).grid(row=0, column=3, sticky=tk.W)
+        ttk.Label(topn_row, text="Memory budget (MB, blank = keep scans in memory):").grid(
+            row=0, column=4, sticky=tk.W, padx=(16,0))
+        ttk.Entry(topn_row, textvariable=self.mem_budget_var, width=6).grid(row=0, column=5, sticky=tk.W)
+        ttk.Label(topn_row, text="Averaging:").grid(row=1, column=0, sticky=tk.W)
+        ttk.OptionMenu(topn_row, self.averaging_var, self.averaging_var.get(),
+                       "Greedy (legacy)", "Log grid (mergeable)").grid(row=1, column=1, columnspan=2, sticky=tk.W)
 
         img_row = ttk.Frame(self); img_row.pack(fill=tk.X, padx=8, pady=0)
         ttk.Checkbutton(img_row, text="Export fragment coverage image (optional)",
@@ -146,6 +161,14 @@ class PepWizGUI(tk.Tk):
         ttk.Entry(flt, textvariable=self.precursor_var, width=14).grid(row=0, column=1, sticky=tk.W)
         ttk.Label(flt, text="RT window min–max (min, optional):").grid(row=0, column=2, sticky=tk.W, padx=(16,0))
         ttk.Entry(flt, textvariable=self.rt_var, width=14).grid(row=0, column=3, sticky=tk.W)
+        ttk.Button(flt, text="Suggest RT", command=self._on_suggest_rt).grid(row=0, column=4, sticky=tk.W, padx=(8,0))
+        ttk.Button(flt, text="Precursor map", command=self._on_precursor_map).grid(row=0, column=5, sticky=tk.W, padx=(8,0))
+
+        lib_row = ttk.Frame(self); lib_row.pack(fill=tk.X, padx=8, pady=0)
+        ttk.Checkbutton(lib_row, text="Add result to spectral library",
+                        variable=self.lib_add_var).grid(row=0, column=0, sticky=tk.W)
+        ttk.Button(lib_row, text="Search library", command=self._on_search_library).grid(
+            row=0, column=1, sticky=tk.W, padx=(16,0))
         
         cust = ttk.Frame(self); cust.pack(fill=tk.X, padx=8, pady=6)
         ttk.Label(cust, text="Custom residue masses (Da, optional):").grid(row=0, column=0, columnspan=6, sticky=tk.W)
@@ -165,6 +188,7 @@ class PepWizGUI(tk.Tk):
         ctrls = ttk.Frame(self); ctrls.pack(fill=tk.X, **pad)
         self.run_btn = ttk.Button(ctrls, text="Run", command=self._on_run)
         self.run_btn.pack(side=tk.LEFT)
+        ttk.Button(ctrls, text="Spectrum viewer", command=self._on_show_viewer).pack(side=tk.LEFT, padx=(8,0))
         self.prog = ttk.Progressbar(ctrls, mode="determinate")
         self.prog.pack(fill=tk.X, expand=True, side=tk.LEFT, padx=8)
         
@@ -178,10 +202,42 @@ class PepWizGUI(tk.Tk):
         self.log_text.pack(fill=tk.BOTH, expand=True)
         
         
-        exe = find_msconvert(None)
-        self._log(f"msconvert: {'found at ' + exe if exe else 'not found (will prompt on RAW)'}")
+        # the open viewer re-annotates the last averaged spectrum as matching settings change
+        for var in (self.seq_var, self.ppm_var, self.z_var, self.term_mod_var,
+                    self.B_var, self.J_var, self.X_var, self.label_topn_var):
+            var.trace_add("write", lambda *_a: self._schedule_rematch())
+
         self._log("Dependencies: install with `py -m pip install pyteomics lxml`")
+        threading.Thread(target=self._background_startup, daemon=True).start()
+        self.after(100, self._drain_bg_queue)
+
+    # msconvert discovery and heavy imports happen off the UI thread
+    def _background_startup(self):
+        exe = find_msconvert(None)
+        self._bg_queue.put(f"msconvert: {'found at ' + exe if exe else 'not found (will prompt on RAW)'}")
+        try:
+            import pepwiz.pipeline, pepwiz.visualize  # noqa: F401  (warm the import cache)
+        except Exception as e:
+            self._bg_queue.put(f"Warning: analysis modules failed to import: {type(e).__name__}: {e}")
+
+    def _drain_bg_queue(self):
+        try:
+            while True:
+                self._log(self._bg_queue.get_nowait())
+        except queue.Empty:
+            pass
+        self.after(100, self._drain_bg_queue)
+
+    def _analysis_cache(self):
+        if self._cache is None:
+            from pepwiz.pipeline import AnalysisCache
+            # parsed scans/averages reused across runs; big files are decoded on all cores
+            self._cache = AnalysisCache(max_files=2, workers=min(8, os.cpu_count() or 1))
+        return self._cache
         
+    def _conversion_kwargs(self):
+        return {"profile": self.conv_profile_var.get(), "ms2_only": bool(self.ms2_only_var.get())}
+
     # Helper: file open dialog
     def _choose_msfile(self):
         p = filedialog.askopenfilename(
@@ -198,12 +254,14 @@ class PepWizGUI(tk.Tk):
 
         src = Path(p)
         self._source_for_output = src  # remember original selection for .out location
+        self._replicate_files = []
 
         if src.suffix.lower() == ".raw":
             try:
                 keep = bool(self.keep_mzml_var.get())
                 dest = src.parent if keep else None
-                mzml_path = run_msconvert(src, dest_dir=dest, log_fn=self._log, overwrite=True)
+                mzml_path = run_msconvert(src, dest_dir=dest, log_fn=self._log, overwrite=True,
+                                          **self._conversion_kwargs())
                 self.msfile_var.set(str(mzml_path))
                 target_for_listing = mzml_path
             except RuntimeError as e:
@@ -217,22 +275,225 @@ class PepWizGUI(tk.Tk):
 
         # Print parent-ion list to the log (top 20)
         try:
-            clusters = list_precursors_with_counts(target_for_listing, dedup_ppm=10.0)
+            clusters = self._analysis_cache().clusters(target_for_listing, dedup_ppm=10.0)
             if not clusters:
                 self._log("No MS2 parent ions found.")
             else:
                 self._log(f"Found {sum(c['count'] for c in clusters)} MS2 scans grouped into {len(clusters)} parent ions:")
-                header = f"{'Rank':>4}  {'Parent m/z':>12}  {'MS2 scans':>9}"
+                from pepwiz.mzml_utils import format_cluster_columns
+                header = f"{'Rank':>4}  {'Parent m/z':>12}  {'MS2 scans':>9}  {'z':>2}  {'RT range (min)':>15}  {'Apex':>6}"
                 self._log(header); self._log("-" * len(header))
                 for i, c in enumerate(clusters[:20], 1):
-                    self._log(f"{i:>4}  {c['mz']:>12.4f}  {c['count']:>9}")
+                    self._log(f"{i:>4}  {c['mz']:>12.4f}  {c['count']:>9}  {format_cluster_columns(c)}")
                 if len(clusters) > 20:
                     self._log(f"... and {len(clusters) - 20} more")
-                self._log("Tip: copy a parent m/z into the 'Precursor m/z' box above.")
+                self._log("Tip: copy a parent m/z into the 'Precursor m/z' box above, "
+                          "or click it on the Precursor map to fill m/z and RT window.")
         except RuntimeError as e:
             self._log(str(e))
 
 
+    # Helper: pick replicate mzML/mzXML files for a consensus run
+    def _choose_replicates(self):
+        ps = filedialog.askopenfilenames(
+            title="Choose replicate mzML/mzXML files",
+            filetypes=[("mzML", "*.mzML"), ("mzXML", "*.mzXML"), ("All files", "*.*")],
+        )
+        files = [Path(p) for p in ps if Path(p).suffix.lower() in (".mzml", ".mzxml")]
+        if len(files) < 2:
+            self._replicate_files = []
+            if ps:
+                self._log("Replicate mode needs at least two mzML/mzXML files (convert RAW first).")
+            return
+        self._replicate_files = files
+        self._source_for_output = files[0]
+        self.msfile_var.set(str(files[0]))
+        self._log(f"Replicate mode: {len(files)} runs will be averaged into one consensus spectrum:")
+        for f in files:
+            self._log(f"  {f}")
+
+    # Helper: MS1 XIC of the precursor -> fill the RT window box
+    def _on_suggest_rt(self):
+        from pepwiz.mzml_utils import extract_xics, suggest_rt_window
+        from pepwiz.visualize import export_xic
+
+        msfile = Path(self.msfile_var.get()).expanduser()
+        if not msfile.exists() or msfile.suffix.lower() == ".raw":
+            messagebox.showerror("Missing file", "Choose an mzML/mzXML file (RAW is converted on Browse).")
+            return
+        try:
+            precursor = float(self.precursor_var.get().strip())
+        except ValueError:
+            messagebox.showerror("Invalid precursor m/z", "Enter the precursor m/z first, e.g. 678.3456")
+            return
+        try:
+            ppm = float(self.ppm_var.get())
+        except ValueError:
+            ppm = 10.0
+
+        try:
+            xic = extract_xics(msfile, [precursor], ppm_tol=ppm, ms_level=1)
+        except Exception as e:
+            self._log(f"XIC failed: {type(e).__name__}: {e}")
+            return
+        win = suggest_rt_window(xic["rt"], xic["traces"][0])
+        if win is None:
+            self._log(f"No MS1 signal found for {precursor:.4f} ±{ppm} ppm.")
+            return
+        self.rt_var.set(f"{win['rt_min']:.2f},{win['rt_max']:.2f}")
+        self._log(f"Precursor {precursor:.4f} apex at {win['apex_rt']:.2f} min; RT window set to {win['rt_min']:.2f}–{win['rt_max']:.2f} min.")
+
+        base = getattr(self, "_source_for_output", msfile).with_suffix("")
+        xic_svg = base.parent / f"{base.name}.xic.svg"
+        export_xic(xic["rt"], xic["traces"], [f"m/z {precursor:.4f}"], xic_svg, window=win, log_fn=self._log)
+
+    # Helper: RT x m/z map of every MS2 precursor; clicking a precursor fills the gate fields
+    def _on_precursor_map(self):
+        msfile = Path(self.msfile_var.get()).expanduser()
+        if not msfile.exists() or msfile.suffix.lower() == ".raw":
+            messagebox.showerror("Missing file", "Choose an mzML/mzXML file (RAW is converted on Browse).")
+            return
+        try:
+            inventory = self._analysis_cache().inventory(msfile, dedup_ppm=10.0)
+        except Exception as e:
+            self._log(f"Precursor inventory failed: {type(e).__name__}: {e}")
+            return
+        if not inventory["clusters"]:
+            self._log("No MS2 parent ions found.")
+            return
+        try:
+            highlight = float(self.precursor_var.get().strip())
+        except ValueError:
+            highlight = None
+        try:
+            # exports go next to the original selection (not a temp mzML converted from RAW)
+            source = getattr(self, "_source_for_output", msfile)
+            PrecursorMapWindow(self, inventory, source, highlight, on_pick=self._pick_precursor)
+        except Exception as e:
+            self._log(f"Precursor map unavailable: {type(e).__name__}: {e}")
+
+    def _pick_precursor(self, cluster):
+        self.precursor_var.set(f"{cluster['mz']:.4f}")
+        if cluster.get("rt_min") is not None:
+            self.rt_var.set(f"{cluster['rt_min']:.2f},{cluster['rt_max']:.2f}")
+        rt = "" if cluster.get("rt_min") is None else \
+            f", RT {cluster['rt_min']:.2f}–{cluster['rt_max']:.2f} min (apex {cluster['apex_rt']:.2f})"
+        self._log(f"Picked precursor {cluster['mz']:.4f} ({cluster['count']} MS2 scans{rt}).")
+
+    # Helper: search the gated, averaged spectrum against the spectral library
+    def _on_search_library(self):
+        from pepwiz.library import SpectralLibrary
+        from pepwiz.pipeline import snap_precursor
+
+        msfile = Path(self.msfile_var.get()).expanduser()
+        if not msfile.exists() or msfile.suffix.lower() == ".raw":
+            messagebox.showerror("Missing file", "Choose an mzML/mzXML file (RAW is converted on Browse).")
+            return
+        try:
+            precursor = float(self.precursor_var.get().strip())
+            ppm = float(self.ppm_var.get())
+        except ValueError:
+            messagebox.showerror("Invalid input", "Enter the precursor m/z and PPM tolerance first.")
+            return
+        top_n = self._peak_picking()
+        rt_min, rt_max = parse_rt_window(self.rt_var.get())
+
+        cache = self._analysis_cache()
+        try:
+            parent_mz, _delta, _nearest = snap_precursor(precursor, cache.clusters(msfile, dedup_ppm=10.0))
+            avg = cache.averaged(msfile, parent_mz, ppm, rt_min, rt_max, ppm, top_n)
+            with SpectralLibrary() as lib:
+                hits = lib.search(avg, parent_mz, precursor_ppm=max(20.0, ppm))
+                n_lib = len(lib)
+        except Exception as e:
+            self._log(f"Library search failed: {type(e).__name__}: {e}")
+            return
+        if not hits:
+            self._log(f"No library entries within ±{max(20.0, ppm)} ppm of {parent_mz:.4f} ({n_lib} in library).")
+            return
+        self._log(f"Library hits for {parent_mz:.4f}:")
+        header = f"{'Score':>6}  {'Shared':>6}  {'Δppm':>7}  {'z':>5}  Sequence"
+        self._log(header); self._log("-" * len(header))
+        for h in hits:
+            self._log(f"{h['score']:>6.3f}  {h['shared_peaks']:>6}  {h['delta_ppm']:>7.2f}  "
+                      f"{','.join(map(str, h['charges'])):>5}  {h['sequence']}"
+                      f"{'' if h['term_mod'] == 'None' else ' (' + h['term_mod'] + ')'}")
+        if not self.seq_var.get().strip():
+            best = hits[0]
+            self.seq_var.set(best["sequence"])
+            self.z_var.set(",".join(map(str, best["charges"])))
+            self.term_mod_var.set(best["term_mod"])
+            self._log("Filled sequence, charges and terminal mod from the best hit.")
+
+    def _on_show_viewer(self):
+        if self._last_result is None:
+            messagebox.showinfo("Spectrum viewer", "Run an analysis first; the viewer shows its averaged spectrum.")
+            return
+        if self._viewer is None or not self._viewer.winfo_exists():
+            try:
+                self._viewer = SpectrumWindow(self)
+            except Exception as e:
+                self._log(f"Spectrum viewer unavailable: {type(e).__name__}: {e}")
+                self._viewer = None
+                return
+        self._viewer.show(self._last_result["avg_spec"], self._last_result["rows"], self._label_top_n())
+        self._viewer.lift()
+
+    def _peak_picking(self):
+        """
+        'Top peaks to match' field -> top_n (count, 'k/width' or 'snr:x'; 'all'/'none' keep every peak).
+        Unreadable -> 200; a count <= 0 keeps the legacy 200 (logged), unlike parse_peak_picking.
+        """
+        from pepwiz.mzml_utils import parse_peak_picking
+        text = self.topn_var.get().strip()
+        try:
+            top_n = parse_peak_picking(text)
+        except ValueError:
+            self._log(f"Top peaks: could not read '{text}', using 200.")
+            return 200
+        if top_n is None and text.lower() not in ("all", "none"):
+            self._log(f"Top peaks: '{text}' uses the legacy default of 200; type 'all' to keep every peak.")
+            return 200
+        return top_n
+
+    def _label_top_n(self):
+        try:
+            return int(self.label_topn_var.get().strip() or "30")
+        except ValueError:
+            return 30
+
+    def _schedule_rematch(self):
+        if self._viewer is None or self._last_result is None:
+            return
+        if self._rematch_job is not None:
+            self.after_cancel(self._rematch_job)
+        self._rematch_job = self.after(250, self._rematch_viewer)  # debounce typing
+
+    def _rematch_viewer(self):
+        """Re-match the last result against the current settings (analyze's matching path); no file access."""
+        self._rematch_job = None
+        if self._viewer is None or not self._viewer.winfo_exists() or self._last_result is None:
+            return
+        from pepwiz.pipeline import rematch
+        try:
+            seq = self.seq_var.get().strip().upper()
+            ppm = float(self.ppm_var.get())
+            charges = [int(z) for z in self.z_var.get().split(",") if z.strip()]
+            overrides = {k: float(v.get()) for k, v in (("B", self.B_var), ("J", self.J_var), ("X", self.X_var))
+                         if v.get().strip()}
+            if not seq or ppm <= 0 or not charges or any(z <= 0 for z in charges):
+                return
+            rows = rematch(self._last_result, seq, charges, ppm, overrides, self.term_mod_var.get())
+        except Exception:
+            return  # half-typed input: keep the current annotations
+        self._viewer.update_matches(rows, self._label_top_n())
+        last = self._last_result
+        path = [name for name, used in (("deisotoped", last.get("deisotoped") is not None),
+                                        ("recalibrated", bool(last.get("calibration"))),
+                                        ("open search", last.get("open_search") is not None)) if used]
+        self._viewer.title(f"PepWiz spectrum — {seq} ±{ppm:g} ppm, z={','.join(map(str, charges))} "
+                           f"({len(rows)} ions{'; ' + ', '.join(path) if path else ''}; Run to write the .out)")
+
     # Helper: append to log
     def _log(self, msg: str):
         self.log_text.insert(tk.END, msg + "\n")
@@ -240,6 +501,10 @@ class PepWizGUI(tk.Tk):
 
         # Run button handler
     def _on_run(self):
+        from pepwiz.match_engine import AA_MASS
+        from pepwiz.pipeline import analyze, analyze_replicates, output_paths, write_result_out
+        from pepwiz.visualize import export_fragment_image, export_annotated_spectrum
+
         self.prog.config(mode="indeterminate"); self.prog.start(12)
         try:
             msfile = Path(self.msfile_var.get()).expanduser()
@@ -252,7 +517,7 @@ class PepWizGUI(tk.Tk):
                 try:
                     keep = bool(self.keep_mzml_var.get())
                     dest = msfile.parent if keep else None
-                    msfile = run_msconvert(msfile, dest_dir=dest, log_fn=self._log)
+                    msfile = run_msconvert(msfile, dest_dir=dest, log_fn=self._log, **self._conversion_kwargs())
                 except RuntimeError:
                     self._log("msconvert not found or failed to run.\n")
                     self._log("PepWiz requires ProteoWizard's msconvert.exe to process RAW files.\n")
@@ -336,13 +601,9 @@ class PepWizGUI(tk.Tk):
             self._log(f"Sequence: {seq}")
             self._log(f"PPM: {ppm}, Charges: {charges}")
 
-            # --- Build theoretical fragments ---
             mod_choice = self.term_mod_var.get()
-            theo = calc_fragments(seq, charges, overrides, mod_choice)
             self._log(f"Terminal modification: {mod_choice}")
 
-
-
             # --- Optional precursor and RT filters from UI ---
             precursor_str = self.precursor_var.get().strip()
             rt_min, rt_max = parse_rt_window(self.rt_var.get())
@@ -357,83 +618,93 @@ class PepWizGUI(tk.Tk):
                 messagebox.showerror("Invalid precursor m/z", "Enter a number like 678.3456")
                 return
             self._log(f"Precursor input: '{precursor_str}' -> {precursor_target:.4f}")
-            # Build/refresh the parent-ion inventory and snap to nearest cluster center
+
+            top_n = self._peak_picking()
+
+            n_decoys = 0
+            if self.decoy_var.get():
+                try:
+                    n_decoys = max(1, int(self.n_decoys_var.get().strip() or "200"))
+                except ValueError:
+                    n_decoys = 200
             try:
-                clusters = list_precursors_with_counts(msfile, dedup_ppm=10.0)
-            except Exception:
-                clusters = []
-
-            snapped_parent = precursor_target
-            snap_note = ""
-            if clusters:
-                nearest = min(clusters, key=lambda c: ppm_delta(precursor_target, c["mz"]))
-                delta_ppm = ppm_delta(precursor_target, nearest["mz"])
-                snapped_parent = nearest["mz"]
-                snap_note = f"(snapped to {snapped_parent:.4f}, Δ={delta_ppm:.2f} ppm, scans={nearest['count']})"
-                if delta_ppm > 50:
-                    self._log(f"Warning: entered parent {precursor_target:.4f} is {delta_ppm:.1f} ppm from nearest cluster {snapped_parent:.4f}.")
-            else:
-                self._log("No parent clusters found; using the typed precursor m/z as-is.")
+                calib_ppm = float(self.calib_ppm_var.get().strip() or "30")
+            except ValueError:
+                calib_ppm = 30.0
+            try:
+                mem_budget = float(self.mem_budget_var.get().strip() or "nan")
+            except ValueError:
+                mem_budget = float("nan")
+            # a budget streams scans from disk (spilling to temp files) instead of caching them all
+            cache = self._analysis_cache()
+            cache.memory_budget_mb = mem_budget if mem_budget > 0 else None
+            averaging = "grid" if self.averaging_var.get().startswith("Log grid") else "greedy"
 
-            self._log(f"Precursor gate centered at {snapped_parent:.4f} {snap_note}")
+            # Choose the base path for output: original selection if available, else the working file
+            base_for_out = getattr(self, "_source_for_output", msfile)
 
-            # Collect filtered MS2 scans (use the *float* snapped_parent)
-            filtered = list(iter_filtered_ms2_peaks(msfile, snapped_parent, ppm, rt_min, rt_max))
-            if not filtered:
+            # Parse/gate/average results are cached across runs; only changed stages are redone
+            replicates = self._replicate_files
+            if len(replicates) >= 2:
+                if self.deiso_var.get() or self.calib_var.get() or self.open_search_var.get():
+                    self._log("Note: deisotoping, recalibration and open search are not applied in replicate mode.")
+                cache.max_files = max(cache.max_files, len(replicates))
+                first = replicates[0]
+                base_for_out = first.with_name(f"{first.stem}.consensus{first.suffix}")
+                result = analyze_replicates(
+                    replicates, seq, charges, ppm, precursor_target,
+                    overrides=overrides,
+                    term_mod=mod_choice,
+                    rt_min=rt_min, rt_max=rt_max,
+                    top_n=top_n,
+                    n_decoys=n_decoys,
+                    averaging=averaging,
+                    cache=cache,
+                    log_fn=self._log,
+                )
+            else:
+                result = analyze(
+                    msfile, seq, charges, ppm, precursor_target,
+                    overrides=overrides,
+                    term_mod=mod_choice,
+                    rt_min=rt_min, rt_max=rt_max,
+                    top_n=top_n,
+                    deisotope=bool(self.deiso_var.get()),
+                    n_decoys=n_decoys,
+                    calibrate=bool(self.calib_var.get()),
+                    calib_ppm=calib_ppm,
+                    calib_source=base_for_out,
+                    open_search=bool(self.open_search_var.get()),
+                    averaging=averaging,
+                    cache=cache,
+                    log_fn=self._log,
+                )
+            if not result["scans_count"]:
                 self._log("No MS2 scans passed the filters.")
                 messagebox.showwarning("No scans", "No MS2 scans matched the precursor/RT filters.")
                 return
-
-            try:
-                top_n = int(self.topn_var.get().strip() or "200")
-                if top_n <= 0:
-                    top_n = 200
-            except Exception:
-                top_n = 200
-
-
-            # --- Average them to one spectrum ---
-            avg_spec = average_spectrum(filtered, bin_ppm=ppm, top_n=top_n)
-
-
-            # --- Match against the averaged spectrum ---
-            summary_rows = legacy_summary_from_spectrum(avg_spec, theo, ppm)
+            avg_spec = result["avg_spec"]
+            summary_rows = result["rows"]
+            self._last_result = result
+            if self._viewer is not None and self._viewer.winfo_exists():
+                self._viewer.show(avg_spec, summary_rows, self._label_top_n())
 
             # --- Write compact .out ---
-           # Choose the base path for output: original selection if available, else the working file
-            base_for_out = getattr(self, "_source_for_output", msfile)
-
-            z_label = ",".join(str(z) for z in charges)
-            out_base = base_for_out.with_suffix("")               # strip .raw/.mzML/.mzXML
-            out_path = out_base.parent / f"{out_base.name}.z{z_label}.out"
-            img_base = base_for_out.with_suffix("")  
-            z_label  = ",".join(str(z) for z in charges)
-
-
-            parent_mz     = snapped_parent
-            scans_count   = len(filtered)
-            bin_width_ppm = ppm
-
-            # If you also want to embed the inventory in the .out:
-            parent_clusters = None
-            try:
-                parent_clusters = list_precursors_with_counts(msfile, dedup_ppm=10.0)
-            except Exception:
-                pass
-
-            write_legacy_out(
-                out_path, seq, charges, summary_rows,
-                parent_mz=snapped_parent,
-                ppm_gate=ppm,
-                scans_count=len(filtered),
-                rt_min=rt_min, rt_max=rt_max,
-                bin_ppm=ppm,
-                parent_clusters=parent_clusters,
-                term_mod=mod_choice,
-            )
-
+            paths = output_paths(base_for_out, charges)
+            out_path = paths["out"]
+            write_result_out(out_path, seq, charges, result, ppm=ppm,
+                             rt_min=rt_min, rt_max=rt_max, term_mod=mod_choice)
 
             self._log(f"Wrote legacy summary:\n{out_path}")
+
+            if self.lib_add_var.get() and summary_rows:
+                from pepwiz.library import SpectralLibrary
+                try:
+                    with SpectralLibrary() as lib:
+                        entry = lib.add_result(seq, charges, result, term_mod=mod_choice, source=str(base_for_out))
+                        self._log(f"Added to spectral library as entry {entry} ({lib.path}).")
+                except Exception as e:
+                    self._log(f"Could not add to spectral library: {type(e).__name__}: {e}")
             
                      
             try:
@@ -447,20 +718,14 @@ class PepWizGUI(tk.Tk):
 
             # Fragment map (SVG only)
             if self.draw_img_var.get() and summary_rows:
-                img_base = base_for_out.with_suffix("")  # align with .out naming
-                z_label = ",".join(str(z) for z in charges)
-                frag_svg = img_base.parent / f"{img_base.name}.z{z_label}.fragments.svg"
-                export_fragment_image(seq, summary_rows, frag_svg, log_fn=self._log)
+                export_fragment_image(seq, summary_rows, paths["fragments"], log_fn=self._log)
 
             # Annotated spectrum (SVG only)
             if self.draw_spec_var.get() and avg_spec and summary_rows:
-                img_base = base_for_out.with_suffix("")
-                z_label = ",".join(str(z) for z in charges)
-                spec_svg = img_base.parent / f"{img_base.name}.z{z_label}.spectrum.svg"
                 export_annotated_spectrum(
                     avg_spec,
                     summary_rows,
-                    spec_svg,
+                    paths["spectrum"],
                     label_top_n=label_top_n,
                     min_pct=min_pct,
                     log_fn=self._log
@@ -490,8 +755,95 @@ class PepWizGUI(tk.Tk):
              self.prog.config(mode="determinate", value=0)
 
 
-# Standard bootstrap
-if __name__ == "__main__":
+class SpectrumWindow(tk.Toplevel):
+    """Embedded matplotlib view of the averaged spectrum with zoom/pan (matplotlib toolbar)."""
+
+    def __init__(self, master):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+        from pepwiz.visualize import SpectrumView
+
+        super().__init__(master)
+        self.title("PepWiz spectrum")
+        self.geometry("900x480")
+        self.figure = Figure(figsize=(9, 4.2), dpi=100)
+        self.view = SpectrumView(self.figure)
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self)
+        NavigationToolbar2Tk(self.canvas, self).update()
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        # window resizes change the pixel budget for decimation
+        self.canvas.mpl_connect("resize_event", lambda _e: self._redraw())
+
+    def show(self, avg_spec, rows, label_top_n=30):
+        self.view.label_top_n = label_top_n
+        self.view.set_spectrum(avg_spec)
+        self.view.set_matches(rows)
+        self.canvas.draw_idle()
+
+    def update_matches(self, rows, label_top_n=30):
+        self.view.label_top_n = label_top_n
+        self.view.set_matches(rows)
+        self.canvas.draw_idle()
+
+    def _redraw(self):
+        self.view.refresh()
+        self.canvas.draw_idle()
+
+
+class PrecursorMapWindow(tk.Toplevel):
+    """RT x precursor m/z density map; click near a precursor to use it (on_pick(cluster))."""
+
+    def __init__(self, master, inventory, source_path, highlight=None, on_pick=None):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+        from pepwiz.visualize import draw_precursor_map
+
+        super().__init__(master)
+        self.title(f"PepWiz precursors — {Path(source_path).name}")
+        self.geometry("860x560")
+        self.inventory, self.source, self.highlight, self.on_pick = inventory, Path(source_path), highlight, on_pick
+        self.figure = Figure(figsize=(8.6, 5.2), dpi=100)
+        self.ax = self.figure.add_subplot(111)
+        img = draw_precursor_map(self.ax, inventory, highlight=highlight)
+        if img is not None:
+            self.figure.colorbar(img, ax=self.ax, label="MS2 scans per bin")
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self)
+        bar = ttk.Frame(self); bar.pack(side=tk.BOTTOM, fill=tk.X)
+        ttk.Button(bar, text="Export SVG", command=self._export).pack(side=tk.RIGHT, padx=6, pady=4)
+        NavigationToolbar2Tk(self.canvas, self).update()
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        self.canvas.mpl_connect("button_press_event", self._on_click)
+        self.canvas.draw_idle()
+
+    def _on_click(self, event):
+        if event.inaxes is not self.ax or event.xdata is None or self.on_pick is None:
+            return
+        if self.canvas.toolbar is not None and self.canvas.toolbar.mode:
+            return  # zoom/pan in progress
+        cands = [c for c in self.inventory["clusters"] if c.get("rt_min") is not None]
+        if not cands:
+            return
+        # nearest cluster in axis-normalized units (RT span vs m/z span)
+        (x0, x1), (y0, y1) = self.ax.get_xlim(), self.ax.get_ylim()
+        def dist(c):
+            dx = 0.0 if c["rt_min"] <= event.xdata <= c["rt_max"] else \
+                min(abs(event.xdata - c["rt_min"]), abs(event.xdata - c["rt_max"]))
+            return (dx / (x1 - x0)) ** 2 + ((event.ydata - c["mz"]) / (y1 - y0)) ** 2
+        self.on_pick(min(cands, key=dist))
+
+    def _export(self):
+        from pepwiz.visualize import export_precursor_map
+        out = self.source.with_suffix("")
+        out = out.parent / f"{out.name}.precursors.svg"
+        export_precursor_map(self.inventory, out, highlight=self.highlight, log_fn=self.master._log)
+
+
+def main():
     app = PepWizGUI()
     app.mainloop()
+
+
+# Standard bootstrap
+if __name__ == "__main__":
+    main()
        
\ No newline at end of file
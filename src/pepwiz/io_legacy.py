@@ -1,6 +1,9 @@
 from __future__ import annotations
 from pathlib import Path
 
+from . import events
+
+
 def write_legacy_out(
     out_path: Path,
     peptide: str,
@@ -14,6 +17,15 @@ def write_legacy_out(
     bin_ppm: float | None = None,
     parent_clusters=None,         # optional list from list_precursors_with_counts()
     term_mod: str | None = None,  # <--- ADD THIS
+    deisotoped_max_z: int | None = None,  # set when charges came from deisotoping
+    decoy_stats: dict | None = None,      # from match_engine.decoy_match_stats()
+    calibration: dict | None = None,      # from calibration.fit_ppm_calibration()
+    replicate_runs=None,                  # per-file stats from pipeline.analyze_replicates()
+    replicate_stats=None,                 # from pipeline.replicate_ion_stats()
+    mass_shift: dict | None = None,       # from match_engine.mass_shift_search()
+    averaging: str | None = None,         # "greedy" (default) or "grid"
+    peak_picking=None,                    # local / S/N top_n setting (parse_peak_picking)
+    selection: dict | None = None,        # analyze(selection=...): {label, scans, total, key}; replaces the gate
 ):
     z_label = ",".join(str(z) for z in charges)
     with open(out_path, "w", encoding="utf-8", newline="") as fh:
@@ -22,25 +34,89 @@ def write_legacy_out(
 
         # Run parameters / provenance
         details = []
-        if parent_mz is not None: details.append(f"Parent m/z = {parent_mz:.4f}")
-        if ppm_gate is not None:  details.append(f"precursor gate ±{ppm_gate} ppm")
+        if selection:
+            label = f"{selection['label']} " if selection.get("label") else ""
+            details.append(f"scan selection = {label}({selection['scans']}/{selection['total']} MS2 scans, "
+                           f"key {selection['key'][:12]}); no precursor/RT gate")
+        else:
+            if parent_mz is not None: details.append(f"Parent m/z = {parent_mz:.4f}")
+            if ppm_gate is not None:  details.append(f"precursor gate ±{ppm_gate} ppm")
         if scans_count is not None: details.append(f"scans averaged = {scans_count}")
-        if rt_min is not None or rt_max is not None:
+        if not selection and (rt_min is not None or rt_max is not None):
             details.append(f"RT window (min) = {'' if rt_min is None else f'{rt_min:.2f}'}-{'' if rt_max is None else f'{rt_max:.2f}'}")
-        if bin_ppm is not None:   details.append(f"averaging bin = ±{bin_ppm} ppm")
+        if bin_ppm is not None:
+            details.append(f"averaging bin = {bin_ppm} ppm log grid" if averaging == "grid"
+                           else f"averaging bin = ±{bin_ppm} ppm")
+        if isinstance(peak_picking, tuple):
+            from .mzml_utils import format_peak_picking
+            details.append(f"peak picking = {format_peak_picking(peak_picking)}")
         if term_mod and term_mod != "None":  # <--- include mod in header
             details.append(f"terminal mod = {term_mod}")
+        if deisotoped_max_z is not None:
+            details.append(f"fragment charges assigned by deisotoping (z <= {deisotoped_max_z})")
+        if calibration:
+            from .calibration import format_calibration
+            details.append(
+                f"mass calibration = {format_calibration(calibration)} "
+                f"(fit on {calibration['n_inliers']}/{calibration['n_points']} ions, MAD {calibration['mad_ppm']:.2f} ppm)"
+            )
         details.append("grouping = by fragment charge (z), then b->y, then index")
 
         fh.write("Run parameters: " + " | ".join(details) + "\n")
 
+        if len(peptide) > 1:
+            from .match_engine import compute_cleavages_from_masses
+            b_cuts, y_cuts = compute_cleavages_from_masses(peptide, rows)
+            n_cuts = len(peptide) - 1
+            covered = b_cuts | y_cuts
+            fh.write(
+                f"Cleavage coverage: {len(covered)}/{n_cuts} bonds ({len(covered) / n_cuts * 100:.0f}%) | "
+                f"b {len(b_cuts)} | y {len(y_cuts)} | both {len(b_cuts & y_cuts)} | "
+                f"missed after residue: {', '.join(str(c) for c in range(1, len(peptide)) if c not in covered) or 'none'}\n"
+            )
+
+        if decoy_stats:
+            d = decoy_stats
+            fh.write(
+                f"Decoy estimate ({d['n_decoys']} {d['mode']} decoys"
+                f"{', unmodified ladder, open-search shift not applied' if mass_shift else ''}): "
+                f"target matches = {d['target_matches']}/{d['n_ions']} "
+                f"(excl. {d.get('n_fixed_ions', 0)} terminus-fixed ions) | "
+                f"decoy matches = {d['decoy_mean']:.1f} ± {d['decoy_sd']:.1f} (max {d['decoy_max']}) | "
+                f"random match rate = {d['match_rate'] * 100:.1f}% | "
+                f"empirical p = {d['p_value']:.4g}\n"
+            )
+
+        if mass_shift:
+            m, best = mass_shift, mass_shift["best"]
+            others = ", ".join(f"{x['site']} {x['matches']}" for x in m["sites"][1:6])
+            fh.write(
+                f"Open modification: Δmass = {m['delta_mass']:+.4f} Da (precursor z = {m['precursor_charge']}) | "
+                f"best site = {best['site']} ({best['matches']}/{m['n_ions']} ions, unmodified {m['unmodified_matches']}, "
+                f"margin {m['margin']}) | next sites: {others or 'NA'}\n"
+            )
+            fh.write("Fragment tables below carry the shift at the best site.\n" if m.get("applied", True)
+                     else "Fragment tables below are unshifted (deisotoped neutral masses).\n")
+
+        if replicate_runs:
+            fh.write(f"Replicate runs ({len(replicate_runs)}), consensus of the per-run averages "
+                     f"(each divided by its scan count):\n")
+            fh.write(f"{'Run':>4}  {'Parent m/z':>12}  {'Δppm':>7}  {'Scans':>6}  {'Share%':>6}  File\n")
+            fh.write("-" * 56 + "\n")
+            for i, r in enumerate(replicate_runs, 1):
+                d = "NA" if r["snap_delta_ppm"] is None else f"{r['snap_delta_ppm']:.2f}"
+                share = "NA" if r.get("share") is None else f"{r['share'] * 100:.1f}"
+                fh.write(f"{i:>4}  {r['parent_mz']:>12.4f}  {d:>7}  {r['scans_count']:>6}  {share:>6}  "
+                         f"{Path(r['path']).name}\n")
+
         # Optional: parent-ion inventory...
         if parent_clusters:
+            from .mzml_utils import format_cluster_columns
             fh.write("Parent ions present (top 10 by MS2 count):\n")
-            fh.write(f"{'Rank':>4}  {'Parent m/z':>12}  {'MS2 scans':>9}\n")
-            fh.write("-" * 32 + "\n")
+            fh.write(f"{'Rank':>4}  {'Parent m/z':>12}  {'MS2 scans':>9}  {'z':>2}  {'RT range (min)':>15}  {'Apex':>6}\n")
+            fh.write("-" * 60 + "\n")
             for i, c in enumerate(parent_clusters[:10], 1):
-                fh.write(f"{i:>4}  {c['mz']:>12.4f}  {c['count']:>9}\n")
+                fh.write(f"{i:>4}  {c['mz']:>12.4f}  {c['count']:>9}  {format_cluster_columns(c)}\n")
 
         # Sections grouped by fragment charge
         frag_zs = sorted({r["z"] for r in rows if r["z"]})
@@ -61,3 +137,16 @@ def write_legacy_out(
                 else:
                     obs = f"{r['obs']:.4f}"; ppmv = f"{r['ppm']:.2f}"
                 fh.write(f"{itype:6} {ion:10} {parent_col:>12} {theo:>12} {obs:>12} {ppmv:>8}\n")
+
+        # Reproducibility of each matched ion across replicate runs
+        if replicate_stats:
+            n_total = replicate_stats[0]["n_total"]
+            fh.write("\n")
+            fh.write(f"[ Reproducibility across {n_total} runs ]\n")
+            fh.write(f"{'IonType':6} {'Ion':10} {'Runs':>6} {'CV%':>8} {'MeanPPM':>8}\n")
+            fh.write(f"{'-'*6} {'-'*10} {'-'*6} {'-'*8} {'-'*8}\n")
+            for s in replicate_stats:
+                cv = "NA" if s["cv_pct"] is None else f"{s['cv_pct']:.1f}"
+                mp = "NA" if s["mean_ppm"] is None else f"{s['mean_ppm']:.2f}"
+                fh.write(f"{s['itype']:6} {s['ion']:10} {s['n_runs']:>3}/{s['n_total']:<2} {cv:>8} {mp:>8}\n")
+    events.output(out_path, "out")
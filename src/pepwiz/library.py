@@ -0,0 +1,164 @@
+"""
+On-disk spectral library of averaged, annotated PepWiz spectra (SQLite).
+
+Entries are indexed by precursor m/z; a search pulls the candidates inside the precursor
+window and scores them all at once by cosine similarity of binned, sqrt-scaled intensity
+vectors. Default location: $PEPWIZ_LIBRARY, else ~/.pepwiz/library.sqlite
+"""
+from __future__ import annotations
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS spectra (
+    id           INTEGER PRIMARY KEY,
+    sequence     TEXT NOT NULL,
+    charges      TEXT NOT NULL,
+    term_mod     TEXT NOT NULL,
+    precursor_mz REAL NOT NULL,
+    scans        INTEGER,
+    source       TEXT,
+    added        REAL NOT NULL,
+    mz           BLOB NOT NULL,
+    intensity    BLOB NOT NULL,
+    rows         TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS spectra_precursor ON spectra (precursor_mz);
+"""
+
+
+def default_library_path() -> Path:
+    env = os.environ.get("PEPWIZ_LIBRARY")
+    return Path(env).expanduser() if env else Path.home() / ".pepwiz" / "library.sqlite"
+
+
+def _binned(mz: np.ndarray, inten: np.ndarray, bin_width: float):
+    """Unit-length sqrt-intensity vector on fixed m/z bins -> (sorted bin ids, weights)."""
+    keep = inten > 0
+    if not np.any(keep):
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    bins, inverse = np.unique(np.floor(mz[keep] / bin_width).astype(np.int64), return_inverse=True)
+    w = np.sqrt(np.bincount(inverse, weights=inten[keep]))
+    return bins, w / np.linalg.norm(w)
+
+
+class SpectralLibrary:
+    """Averaged spectra plus their matched rows, searchable by precursor m/z and cosine score."""
+
+    def __init__(self, path: Path | None = None):
+        self.path = Path(path) if path is not None else default_library_path()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM spectra").fetchone()[0]
+
+    def add(self, sequence: str, precursor_mz: float, spectrum, rows, *, charges=(1,),
+            term_mod: str = "None", scans: int | None = None, source: str | None = None) -> int:
+        """Store one averaged spectrum [(mz, inten)] with its matched rows; returns the entry id."""
+        if not spectrum:
+            raise RuntimeError("Cannot add an empty spectrum to the library.")
+        arr = np.asarray(spectrum, dtype=np.float64)
+        with self._lock, self._db:
+            cur = self._db.execute(
+                "INSERT INTO spectra (sequence, charges, term_mod, precursor_mz, scans, source, added,"
+                " mz, intensity, rows) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (sequence, ",".join(str(z) for z in charges), term_mod or "None", float(precursor_mz),
+                 scans, None if source is None else str(source), time.time(),
+                 arr[:, 0].tobytes(), arr[:, 1].tobytes(), json.dumps(rows)),
+            )
+            return cur.lastrowid
+
+    def add_result(self, sequence: str, charges, result: Dict, *, term_mod: str = "None",
+                   source: str | None = None) -> int:
+        """add() for a result dict returned by pipeline.analyze()."""
+        return self.add(sequence, result["parent_mz"], result["avg_spec"], result["rows"],
+                        charges=charges, term_mod=term_mod, scans=result["scans_count"], source=source)
+
+    def get(self, entry_id: int) -> Dict | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, sequence, charges, term_mod, precursor_mz, scans, source, added, mz, intensity, rows"
+                " FROM spectra WHERE id = ?", (int(entry_id),)).fetchone()
+        if row is None:
+            return None
+        mz, inten = np.frombuffer(row[8]), np.frombuffer(row[9])
+        return {
+            "id": row[0], "sequence": row[1], "charges": [int(z) for z in row[2].split(",")],
+            "term_mod": row[3], "precursor_mz": row[4], "scans": row[5], "source": row[6],
+            "added": row[7], "spectrum": list(zip(mz.tolist(), inten.tolist())), "rows": json.loads(row[10]),
+        }
+
+    def remove(self, entry_id: int) -> bool:
+        with self._lock, self._db:
+            return self._db.execute("DELETE FROM spectra WHERE id = ?", (int(entry_id),)).rowcount > 0
+
+    def search(self, spectrum, precursor_mz: float, precursor_ppm: float = 20.0,
+               bin_width: float = 0.02, top_k: int = 5, min_score: float = 0.0) -> List[Dict]:
+        """
+        Library entries within ±precursor_ppm of precursor_mz, best cosine first.
+        Returns [{id, sequence, charges, term_mod, precursor_mz, delta_ppm, score, shared_peaks}].
+        """
+        if not spectrum:
+            return []
+        tol = precursor_mz * precursor_ppm * 1e-6
+        with self._lock:
+            cands = self._db.execute(
+                "SELECT id, sequence, charges, term_mod, precursor_mz, mz, intensity FROM spectra"
+                " WHERE precursor_mz BETWEEN ? AND ?", (precursor_mz - tol, precursor_mz + tol)).fetchall()
+        if not cands:
+            return []
+
+        q = np.asarray(spectrum, dtype=np.float64)
+        q_bins, q_w = _binned(q[:, 0], q[:, 1], bin_width)
+        if not len(q_bins):
+            return []
+
+        # bin every candidate in one pass: sort key = (candidate, bin), sqrt of summed intensity
+        mz = [np.frombuffer(c[5]) for c in cands]
+        owner = np.repeat(np.arange(len(cands)), [len(m) for m in mz])
+        bins = np.floor(np.concatenate(mz) / bin_width).astype(np.int64)
+        inten = np.concatenate([np.frombuffer(c[6]) for c in cands])
+        stride = int(bins.max()) + 1
+        keys, inverse = np.unique(owner * stride + bins, return_inverse=True)
+        c_owner, c_bins = np.divmod(keys, stride)
+        c_w = np.sqrt(np.bincount(inverse.ravel(), weights=np.clip(inten, 0, None)))
+        norms = np.sqrt(np.bincount(c_owner, weights=c_w ** 2, minlength=len(cands)))
+
+        pos = np.clip(np.searchsorted(q_bins, c_bins), 0, len(q_bins) - 1)
+        shared = (q_bins[pos] == c_bins) & (c_w > 0)
+        dots = np.bincount(c_owner[shared], weights=c_w[shared] * q_w[pos[shared]], minlength=len(cands))
+        scores = np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+        n_shared = np.bincount(c_owner[shared], minlength=len(cands))
+
+        hits = []
+        for i in np.argsort(-scores, kind="stable")[:max(1, int(top_k))]:
+            if scores[i] < min_score:
+                break
+            c = cands[i]
+            hits.append({
+                "id": c[0], "sequence": c[1], "charges": [int(z) for z in c[2].split(",")],
+                "term_mod": c[3], "precursor_mz": c[4],
+                "delta_ppm": (precursor_mz - c[4]) / c[4] * 1e6,
+                "score": float(scores[i]), "shared_peaks": int(n_shared[i]),
+            })
+        return hits
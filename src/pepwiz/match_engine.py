@@ -2,96 +2,59 @@ from __future__ import annotations
 from pathlib import Path
 from typing import Iterable, List, Tuple, Dict
 import re
+from bisect import bisect_left, bisect_right
 
-PROTON = 1.007276466812  # 
-WATER  = 18.010564684    # 
-
-
-H_ATOM             = 1.00784           
-DECARB_DAPTIDE_NEU = 29.0022           # y-ion decarboxylation net (if that toggle is used)  
-AMIDATION_DELTA    = -0.984016         # C-term amidation
-DEHYDRATION_DELTA  = -18.010564684     # net -H2O 
-
-# ---- Monoisotopic AA masses  ----
-AA_MASS = {
-    "A": 71.03711,  "R": 156.10111, "N": 114.04293, "D": 115.02694,
-    "C": 103.00919, "E": 129.04259, "Q": 128.05858, "G": 57.02146,
-    "H": 137.05891, "I": 113.08406, "L": 113.08406, "K": 128.09496,
-    "M": 131.04049, "F": 147.06841, "P": 97.05276,  "S": 87.03203,
-    "T": 101.04768, "W": 186.07931, "Y": 163.06333, "V": 99.06841,
-}
-
-def _prefix_masses(seq: str) -> List[float]:
-    acc = 0.0
-    out: List[float] = []
-    for aa in seq:
-        acc += AA_MASS.get(aa.upper(), 0.0)
-        out.append(acc)
-    return out
-
-def _suffix_masses(seq: str) -> List[float]:
-    acc = 0.0
-    out: List[float] = []
-    for aa in reversed(seq):
-        acc += AA_MASS.get(aa.upper(), 0.0)
-        out.append(acc)
-    return list(reversed(out))
+import numpy as np
+
+from .composition import (
+    C_TERMINAL_COMPOSITION, MONO, PROTON, RESIDUE_MASS,
+    c_terminal_key, composition_mass, ion_table, parse_formula, peptide_mass, residue_arrays,
+)
+
+WATER = composition_mass(parse_formula("H2O"))                      # 18.0105646837
+
+# Exact values of the legacy constants (now derived from elemental compositions).
+H_ATOM             = float(MONO[1])
+DECARB_DAPTIDE_NEU = H_ATOM - composition_mass(C_TERMINAL_COMPOSITION["decarboxylated"])  # y = residues + H - this (H2O - CH2O2)
+AMIDATION_DELTA    = composition_mass(parse_formula("HNO-1"))       # C-term amidation, -0.984016
+DEHYDRATION_DELTA  = -WATER                                        # net -H2O
+
+# ---- Monoisotopic AA masses (exact, from RESIDUE_FORMULAS) ----
+AA_MASS = dict(RESIDUE_MASS)
+
+def _residue_masses(seq: str, overrides: dict | None) -> np.ndarray:
+    """Per-residue masses (overrides first); ValueError for an unknown residue, like ion_table()."""
+    comp, extra = residue_arrays(seq, overrides)
+    return np.array([composition_mass(c) + e for c, e in zip(comp, extra.tolist())], dtype=float)
 
 def _mz(neutral_mass: float, z: int) -> float:
     return (neutral_mass + z * PROTON) / z
 
-def _apply_terminal_mod(neutral_mass: float, term_mod: str | None, series: str) -> float:
-    """
-    Apply terminal modification to the neutral mass of a fragment if requested.
-    term_mod values are the same strings your GUI uses (“None”, “Amidation”, “Dehydration”, “Daptide decarb (y)”, …).
-    Only applies when it makes sense (e.g., y-series for decarb).
-    """
-    if not term_mod or term_mod == "None":
-        return neutral_mass
-    t = term_mod.lower().strip()
-    if t.startswith("amid"):       # amidation (C-term)
-        
-        return neutral_mass + AMIDATION_DELTA
-    if "dehydrat" in t:            # -H2O
-        return neutral_mass + DEHYDRATION_DELTA
-    if "decarb" in t and series == "y":  
-        return neutral_mass - DECARB_DAPTIDE_NEU
-    return neutral_mass
-
 def generate_theoretical_by(
     seq: str,
     charges: Iterable[int],
     term_mod: str | None = None,
+    overrides: dict | None = None,
 ) -> List[Tuple[str, float]]:
     """
     Generate b/y series for the given fragment charge set.
-    Returns [(ion_label, theo_mz)] like ('b5^2+', 345.1234).
-    Mirrors your v12 “theoretical ion builder” behavior for b/y with an optional terminal mod applied. 
+    Returns [(ion_label, theo_mz)] like ('b5^2+', 345.1234), ordered by cut (b_i then y_(L-i), per z).
+    Same masses as calc_fragments (shared ion_table); terminal mods only change y ions.
+    overrides maps residue letters to masses (needed for B/J/X or custom residues; ValueError otherwise).
     """
+    seq = seq.upper()
     L = len(seq)
     if L < 2:
         return []
-    pref = _prefix_masses(seq)          # b_n base
-    suff = _suffix_masses(seq)          # y_n base (needs +H2O)
-
+    chs = sorted(int(z) for z in charges if int(z) > 0) or [1]
+    t = ion_table(seq, chs, overrides, term_mod)
+    labels, mz = t["label"], t["mz"].tolist()
     theo: List[Tuple[str, float]] = []
-    chs = sorted(int(z) for z in charges if int(z) > 0)
-    if not chs:
-        chs = [1]
-
     for i in range(1, L):               # cut between i and i+1
-        # Neutral fragment masses (peptide fragments without protons)
-        b_mass = pref[i-1]              # b_i
-        y_mass = suff[i] + WATER        # y_{L-i} + H2O
-
-        # Optional terminal adjustments
-        b_mass_adj = _apply_terminal_mod(b_mass, term_mod, "b")
-        y_mass_adj = _apply_terminal_mod(y_mass, term_mod, "y")
-
-        for z in chs:
-            theo.append((f"b{i}^{z}+", _mz(b_mass_adj, z)))
-            y_idx = L - i
-            theo.append((f"y{y_idx}^{z}+", _mz(y_mass_adj, z)))
+        for k in range(len(chs)):
+            base = 2 * L * k
+            theo.append((labels[base + i - 1], mz[base + i - 1]))
+            theo.append((labels[base + 2 * L - i - 1], mz[base + 2 * L - i - 1]))
     return theo
     
 def ppm_error(obs_mz: float, theo_mz: float, *, signed: bool = True) -> float:
@@ -111,50 +74,13 @@ def ppm_delta(a: float, b: float) -> float:
     return abs((a - b) / b) * 1e6
 
 def calc_fragments(seq: str, charges, overrides: dict, term_mod_choice: str):
-    # Residue masses, honoring overrides (e.g., B/J/X if the user set them)
-    
-    masses = [(overrides[aa] if aa in overrides else AA_MASS[aa]) for aa in seq]
-
-    # b-prefix neutral masses
-    b_prefix = []
-    s = 0.0
-    for i, m in enumerate(masses, start=1):
-        s += m
-        b_prefix.append((i, s))
-
-    # y-suffix neutral masses
-    y_suffix = []
-    s = 0.0
-    for i, m in enumerate(reversed(masses), start=1):
-        s += m
-        y_suffix.append((i, s))
-
-    out = []
-    for z in charges:
-        z = int(z)
-
-        # b-ions are unaffected by C-term mods
-        for i, s in b_prefix:
-            out.append((f"b{i}^{z}+", (s + z*PROTON)/z))
-
-        # y-ions depend on terminal modification
-        if term_mod_choice == "C-term: Amidated":
-            for i, s in y_suffix:
-                out.append((f"y{i}^{z}+", (s + WATER + AMIDATION_DELTA + z*PROTON)/z))
-
-        elif term_mod_choice == "C-term: Dehydrated":
-            for i, s in y_suffix:
-                out.append((f"y{i}^{z}+", (s + WATER + DEHYDRATION_DELTA + z*PROTON)/z))
-
-        elif term_mod_choice == "C-term: Decarboxylated (Daptides)":
-            for i, s in y_suffix:
-                out.append((f"y{i}^{z}+", (s - DECARB_DAPTIDE_NEU + H_ATOM + z*PROTON)/z))
-
-        else:  # "None"
-            for i, s in y_suffix:
-                out.append((f"y{i}^{z}+", (s + WATER + z*PROTON)/z))
-
-    return out
+    """
+    [(label, m/z)] for b1..bL and y1..yL at each charge (per z: all b, then all y).
+    Residue masses honor overrides (e.g., B/J/X if the user set them); the C-terminal
+    modification only changes y ions. See composition.ion_table().
+    """
+    t = ion_table(seq, charges, overrides, term_mod_choice)
+    return list(zip(t["label"], t["mz"].tolist()))
     
 def ion_meta(ion_label: str):
     """
@@ -205,6 +131,211 @@ def legacy_summary_from_spectrum(
     rows.sort(key=lambda r: (r["z"], 0 if r["itype"] == "b" else 1, r["idx"]))
     return rows
 
+def neutral_fragments(seq: str, overrides: dict, term_mod_choice: str) -> List[Tuple[str, float]]:
+    """
+    Neutral b/y fragment masses [(ion_base, mass)] like ('b5', 544.2...).
+    Same ladder and terminal-mod handling as calc_fragments, without a charge.
+    """
+    return [
+        (ion_label.split("^", 1)[0], theo_mz - PROTON)
+        for ion_label, theo_mz in calc_fragments(seq, [1], overrides, term_mod_choice)
+    ]
+
+def legacy_summary_from_neutral(
+    neutral_peaks: List[Tuple[float, float, int]],
+    neutral_ions: List[Tuple[str, float]],
+    ppm_tol: float
+) -> List[Dict]:
+    """
+    Match neutral fragment masses against a deisotoped peak list [(neutral_mass, inten, z)].
+    Each hit takes its charge from the peak, so one pass covers every fragment z.
+    Same rows/ordering as legacy_summary_from_spectrum (theo/obs reported as m/z at that z).
+    """
+    rows: List[Dict] = []
+    if not neutral_peaks:
+        return rows
+    masses = [p[0] for p in neutral_peaks]
+    for base, theo_mass in neutral_ions:
+        if theo_mass <= 0:
+            continue
+        tol = theo_mass * ppm_tol * 1e-6
+        lo = bisect_left(masses, theo_mass - tol)
+        hi = bisect_right(masses, theo_mass + tol)
+        best_by_z: Dict[int, Tuple[float, float]] = {}
+        for k in range(lo, hi):
+            mass, inten, z = neutral_peaks[k]
+            d = abs(mass - theo_mass)
+            if z not in best_by_z or d < abs(best_by_z[z][0] - theo_mass):
+                best_by_z[z] = (mass, inten)
+        for z, (mass, inten) in best_by_z.items():
+            ion_label = f"{base}^{z}+"
+            itype, idx, _ = ion_meta(ion_label)
+            theo_mz = _mz(theo_mass, z)
+            obs_mz = _mz(mass, z)
+            rows.append({
+                "z": z, "itype": itype, "idx": idx, "ion": ion_label,
+                "theo": theo_mz, "obs": obs_mz, "ppm": ppm_error(obs_mz, theo_mz, signed=False),
+                "inten": inten
+            })
+    rows.sort(key=lambda r: (r["z"], 0 if r["itype"] == "b" else 1, r["idx"]))
+    return rows
+
+def _y_terminal_delta(term_mod_choice: str) -> float:
+    """Neutral mass added to the y-suffix residue sum (same rules as calc_fragments)."""
+    return composition_mass(C_TERMINAL_COMPOSITION[c_terminal_key(term_mod_choice)])
+
+def _fragment_mz_matrix(residue_masses, charges, term_mod_choice: str):
+    """
+    Vectorized calc_fragments for many sequences of equal length.
+    residue_masses: (n_seqs, L) -> (n_seqs, n_ions) m/z in calc_fragments order.
+    """
+    res = np.asarray(residue_masses, dtype=float)
+    b = np.cumsum(res, axis=1)
+    y = np.cumsum(res[:, ::-1], axis=1) + _y_terminal_delta(term_mod_choice)
+    blocks = []
+    for z in charges:
+        z = int(z)
+        blocks.append((b + z * PROTON) / z)
+        blocks.append((y + z * PROTON) / z)
+    return np.concatenate(blocks, axis=1)
+
+def _count_matches(spectrum, theo_mz, ppm_tol: float):
+    """Boolean mask (same shape as theo_mz): True where any spectrum peak lies within ±ppm_tol."""
+    mzs = np.sort(np.asarray([p[0] for p in spectrum], dtype=float))
+    theo = np.asarray(theo_mz, dtype=float)
+    lo = np.searchsorted(mzs, theo * (1 - ppm_tol * 1e-6), side="left")
+    hi = np.searchsorted(mzs, theo * (1 + ppm_tol * 1e-6), side="right")
+    return hi > lo
+
+def decoy_sequences(seq: str, n_decoys: int = 200, mode: str = "shuffle", seed: int = 0) -> List[str]:
+    """
+    Decoys of seq with both terminal residues kept in place.
+    mode='shuffle' -> n_decoys random permutations of the interior; mode='reverse' -> one reversed decoy.
+    """
+    if len(seq) < 4:
+        return []
+    if mode == "reverse":
+        return [seq[0] + seq[-2:0:-1] + seq[-1]]
+    interior = np.frombuffer(seq[1:-1].encode("ascii"), dtype="S1")
+    rng = np.random.default_rng(seed)
+    shuffled = rng.permuted(np.tile(interior, (int(n_decoys), 1)), axis=1)
+    return [seq[0] + row.tobytes().decode("ascii") + seq[-1] for row in shuffled]
+
+def decoy_match_stats(
+    spectrum: List[Tuple[float, float]],
+    seq: str,
+    charges,
+    overrides: dict,
+    term_mod_choice: str,
+    ppm_tol: float,
+    n_decoys: int = 200,
+    mode: str = "shuffle",
+    seed: int = 0,
+) -> Dict | None:
+    """
+    Empirical false-match estimate: match the target and all decoys in one vectorized batch.
+    Ions with the same m/z in every decoy (b1, b_L-1, b_L, y1, y_L-1, y_L: the termini are kept)
+    would match exactly when the target does, so they are left out of all counts.
+    Returns {n_decoys, n_ions (scored), n_fixed_ions (left out), target_matches, decoy_mean,
+    decoy_sd, decoy_max, match_rate, p_value} or None if no decoys can be built.
+    p_value = (1 + #decoys >= target) / (n_decoys + 1).
+    """
+    residue = dict(zip(seq, _residue_masses(seq, overrides).tolist()))   # decoys reuse seq's residues
+    decoys = decoy_sequences(seq, n_decoys, mode, seed)
+    if not decoys or not spectrum:
+        return None
+    masses = np.array([[residue[aa] for aa in s] for s in [seq] + decoys], dtype=float)
+    theo = _fragment_mz_matrix(masses, charges, term_mod_choice)
+    # invariant up to summation order of the same residues
+    fixed = np.ptp(theo, axis=0) <= theo.min(axis=0) * 1e-9
+    theo = theo[:, ~fixed]
+    if not theo.shape[1]:
+        return None
+    counts = _count_matches(spectrum, theo, ppm_tol).sum(axis=1)
+    target, dec = int(counts[0]), counts[1:]
+    return {
+        "n_decoys": len(decoys),
+        "mode": mode,
+        "n_ions": int(theo.shape[1]),
+        "n_fixed_ions": int(fixed.sum()),
+        "target_matches": target,
+        "decoy_mean": float(dec.mean()),
+        "decoy_sd": float(dec.std()),
+        "decoy_max": int(dec.max()),
+        "match_rate": float(dec.mean() / theo.shape[1]),
+        "p_value": float((1 + np.count_nonzero(dec >= target)) / (len(dec) + 1)),
+    }
+
+def peptide_neutral_mass(seq: str, overrides: dict, term_mod_choice: str) -> float:
+    """Neutral monoisotopic mass of the peptide (same residue and terminal rules as calc_fragments)."""
+    return peptide_mass(seq, overrides, term_mod_choice)
+
+def _matched_intensity(spectrum, theo_mz, ppm_tol: float):
+    """Summed spectrum intensity within ±ppm_tol of each theo_mz (same shape as theo_mz)."""
+    arr = np.asarray(sorted(spectrum), dtype=float)
+    cs = np.concatenate([[0.0], np.cumsum(arr[:, 1])])
+    theo = np.asarray(theo_mz, dtype=float)
+    lo = np.searchsorted(arr[:, 0], theo * (1 - ppm_tol * 1e-6), side="left")
+    hi = np.searchsorted(arr[:, 0], theo * (1 + ppm_tol * 1e-6), side="right")
+    return cs[hi] - cs[lo]
+
+def mass_shift_search(
+    spectrum: List[Tuple[float, float]],
+    seq: str,
+    charges,
+    overrides: dict,
+    term_mod_choice: str,
+    ppm_tol: float,
+    precursor_mz: float,
+    precursor_charge: int | None = None,
+    max_precursor_charge: int = 4,
+) -> Dict | None:
+    """
+    Open-modification search: delta = precursor neutral mass - theoretical peptide mass, placed on
+    each residue in turn and scored in one batch (matched ions, then matched intensity).
+    A shift on the first/last residue is indistinguishable from one on the N-/C-terminus.
+    precursor_charge=None picks the charge (1..max_precursor_charge) giving the smallest |delta|;
+    pass the recorded charge when known, since a wrong z turns into a wrong delta.
+    Returns {precursor_charge, delta_mass, n_ions, unmodified_matches, sites, best, margin, theo, rows}
+    with sites sorted best first, theo the (label, m/z) ladder of the best placement and rows its
+    legacy rows; None if no spectrum.
+    """
+    if not spectrum or not seq:
+        return None
+    theo_mass = peptide_neutral_mass(seq, overrides, term_mod_choice)
+    zs = [int(precursor_charge)] if precursor_charge else range(1, max(1, int(max_precursor_charge)) + 1)
+    z_prec, delta = min(((z, (precursor_mz - PROTON) * z - theo_mass) for z in zs), key=lambda t: abs(t[1]))
+
+    base = _residue_masses(seq, overrides)
+    n = len(seq)
+    masses = np.vstack([base, base + delta * np.eye(n)])    # row 0 = unmodified, row i = shift on residue i
+    theo = _fragment_mz_matrix(masses, charges, term_mod_choice)
+    hits = _count_matches(spectrum, theo, ppm_tol)
+    counts = hits.sum(axis=1)
+    inten = np.where(hits, _matched_intensity(spectrum, theo, ppm_tol), 0.0).sum(axis=1)
+
+    order = np.lexsort((-inten[1:], -counts[1:]))          # best site first
+    sites = [
+        {"position": int(i) + 1, "residue": seq[i], "site": f"{seq[i]}{int(i) + 1}",
+         "matches": int(counts[i + 1]), "intensity": float(inten[i + 1])}
+        for i in order
+    ]
+    best = sites[0]
+    labels = [label for label, _mz in calc_fragments(seq, charges, overrides, term_mod_choice)]
+    best_theo = list(zip(labels, theo[best["position"]].tolist()))
+    rows = legacy_summary_from_spectrum(spectrum, best_theo, ppm_tol)
+    return {
+        "precursor_charge": z_prec,
+        "delta_mass": float(delta),
+        "n_ions": int(theo.shape[1]),
+        "unmodified_matches": int(counts[0]),
+        "sites": sites,
+        "best": best,
+        "margin": best["matches"] - (sites[1]["matches"] if len(sites) > 1 else 0),
+        "theo": best_theo,
+        "rows": rows,
+    }
+
 def compute_cleavages_from_masses(seq: str, matched_rows):
     """
     Return two sets of cleavage indices (between 1..len(seq)-1):
@@ -1,9 +1,29 @@
 # msconvert_utils.py
 
 from __future__ import annotations
-import subprocess, os
+import subprocess, os, re, sqlite3, sys
 from pathlib import Path
 
+from . import events
+from .events import with_events
+
+_STORE = None
+
+def _provenance_store():
+    # one shared store per process; False marks "tried and unavailable"
+    global _STORE
+    if _STORE is None:
+        from .provenance import open_store
+        _STORE = open_store() or False
+    return _STORE or None
+
+def _store_call(method, *args, default=None, **kwargs):
+    # the store is a cache: a locked/corrupt database or a vanished file must never fail a conversion
+    try:
+        return method(*args, **kwargs)
+    except (OSError, sqlite3.Error):
+        return default
+
 def _looks_like_gui_or_cache(p: str) -> bool:
     pl = p.lower()
     return (
@@ -12,11 +32,48 @@ def _looks_like_gui_or_cache(p: str) -> bool:
         or "microsoft\\installer" in pl
     )
 
+def _resolve_windows_shortcut(lnk_path: str) -> str | None:
+    """
+    Target path of a Windows .lnk shortcut, read from the file itself (MS-SHLLINK LinkInfo:
+    LocalBasePath + CommonPathSuffix), so it works without pywin32 and on any OS.
+    None if the shortcut has no local target (e.g. an MSI advertised shortcut).
+    """
+    import struct
+    data = Path(lnk_path).read_bytes()
+    if len(data) < 76 or struct.unpack_from("<I", data, 0)[0] != 0x4C:
+        return None
+    flags = struct.unpack_from("<I", data, 20)[0]
+    pos = 76
+    if flags & 0x1:   # HasLinkTargetIDList
+        pos += 2 + struct.unpack_from("<H", data, pos)[0]
+    if not flags & 0x2:   # HasLinkInfo
+        return None
+    info = data[pos:]
+    header_size, info_flags, _vol, base_off, _net, suffix_off = struct.unpack_from("<6I", info, 4)
+    if not info_flags & 0x1:   # VolumeIDAndLocalBasePath
+        return None
+
+    def _cstr(off, wide=False):
+        if wide:
+            end = off
+            while info[end:end + 2] not in (b"\0\0", b""):
+                end += 2
+            return info[off:end].decode("utf-16-le")
+        return info[off:info.index(b"\0", off)].decode("mbcs" if os.name == "nt" else "latin-1")
+
+    if header_size >= 0x24:
+        base_u, suffix_u = struct.unpack_from("<2I", info, 28)
+        base, suffix = _cstr(base_u, wide=True), _cstr(suffix_u, wide=True)
+    else:
+        base, suffix = _cstr(base_off), _cstr(suffix_off)
+    if suffix and not base.endswith("\\"):
+        base += "\\"
+    return base + suffix or None
+
 def _normalize_msconvert_path(p: str | None) -> str | None:
     if not p:
         return None
     pp = p
-    # resolve .lnk if you kept _resolve_windows_shortcut; otherwise skip
     if pp.lower().endswith(".lnk"):
         try:
             pp = _resolve_windows_shortcut(pp) or ""
@@ -38,12 +95,19 @@ def _preflight_msconvert(path: str) -> tuple[bool, str]:
         cp = subprocess.run([path, "--help"], capture_output=True, text=True, timeout=10)
         # ProteoWizard sometimes returns 0 or 1 for --help; both are fine if it printed usage.
         if cp.returncode in (0, 1):
-            return True, ""
+            return True, (cp.stdout or "") + (cp.stderr or "")
         return False, f"msconvert exited with code {cp.returncode}\nSTDOUT:\n{cp.stdout}\nSTDERR:\n{cp.stderr}"
     except Exception as e:
         return False, f"Failed to execute msconvert: {e}"
 
-def find_msconvert(explicit_path: str | None = None) -> str | None:
+def _msconvert_version(help_text: str) -> str:
+    m = re.search(r"release:?\s*([\w.\-]+)", help_text or "", re.IGNORECASE)
+    if m:
+        return m.group(1)
+    lines = [ln.strip() for ln in (help_text or "").splitlines() if ln.strip()]
+    return lines[0][:80] if lines else ""
+
+def find_msconvert(explicit_path: str | None = None, use_cache: bool = True) -> str | None:
     
     cand = _normalize_msconvert_path(explicit_path)
     if cand: return cand
@@ -51,6 +115,11 @@ def find_msconvert(explicit_path: str | None = None) -> str | None:
     env = os.environ.get("PEPWIZ_MS_CONVERT") or os.environ.get("MSCONVERT_EXE")
     cand = _normalize_msconvert_path(env)
     if cand: return cand
+
+    # last validated executable (skips the PATH/default-location search)
+    store = _provenance_store() if use_cache else None
+    cand = _store_call(store.cached_msconvert) if store else None
+    if cand: return cand
   
     from shutil import which
     cand = _normalize_msconvert_path(which("msconvert.exe") or which("msconvert"))
@@ -62,43 +131,176 @@ def find_msconvert(explicit_path: str | None = None) -> str | None:
 
     return None
 
-def run_msconvert(raw_path: str | Path, out_dir: str | Path | None = None, *,
-                  overwrite: bool = False, extra_filters: list[str] | None = None,
-                  log_fn=None, dest_dir: str | Path | None = None) -> Path:
-    exe = find_msconvert(None)
-    if not exe:
-        msg = (
-            "ProteoWizard `msconvert.exe` not found.\n\n"
-            "To fix this:\n"
-            " 1️. Install ProteoWizard:\n"
-            "     https://proteowizard.sourceforge.io/download.html\n\n"
-            " 2️. Locate the actual CLI binary (open Command Prompt and run):\n"
-            "     where /r C:\\ msconvert.exe\n\n"
-            "   • Ignore results like MSConvertGUI_Icon.exe — those are shortcuts.\n"
-            " 3️. Register it permanently (Command Prompt):\n"
-            "     setx PEPWIZ_MS_CONVERT \"<path to msconvert.exe>\"\n"
-            " 4️. Restart PepWiz and try again.\n\n"
-            "Tip: Verify the path prints usage (not a GUI):\n"
-            "    \"%PEPWIZ_MS_CONVERT%\" --help\n"
-        )
-        if log_fn:
-            log_fn(msg)
-        raise RuntimeError(msg)
-
-    ok, preflight_msg = _preflight_msconvert(exe)
-    if not ok:
-        err = (
-            "Found msconvert, but it failed a quick check.\n"
-            "Make sure this is the CLI 'msconvert.exe', not the GUI/Installer icon.\n\n"
-            f"{preflight_msg}"
-        )
-        if log_fn:
-            log_fn(err)
-        raise RuntimeError(err)
+# Output encodings for run_msconvert(profile=...). All of them centroid MS2 (peakPicking).
+#   default        zlib, 64-bit m/z and intensity (the original PepWiz command)
+#   compact        zlib, 64-bit m/z, 32-bit intensity
+#   numpress       MS-Numpress linear m/z + SLOF intensity (sub-ppm m/z error; reading needs pynumpress)
+#   numpress-zlib  numpress followed by zlib (smallest files)
+CONVERSION_PROFILES = {
+    "default": ["--mzML", "--zlib", "--64"],
+    "compact": ["--mzML", "--zlib", "--mz64", "--inten32"],
+    "numpress": ["--mzML", "--numpressLinear", "--numpressSlof"],
+    "numpress-zlib": ["--mzML", "--zlib", "--numpressLinear", "--numpressSlof"],
+}
+
+def msconvert_options(extra_filters: list[str] | None = None, profile: str = "default",
+                      ms2_only: bool = False) -> list[str]:
+    """
+    msconvert arguments (besides input/output names) that run_msconvert() uses.
+    ms2_only drops MS1 scans (smaller files, but no precursor XIC / Suggest RT).
+    """
+    if profile not in CONVERSION_PROFILES:
+        raise RuntimeError(f"Unknown conversion profile {profile!r}; choose from {', '.join(CONVERSION_PROFILES)}.")
+    opts = CONVERSION_PROFILES[profile] + ["--filter", "peakPicking true 2-"]
+    if ms2_only:
+        opts += ["--filter", "msLevel 2"]
+    for f in extra_filters or []:
+        opts += ["--filter", f]
+    return opts
+
+_MISSING_MSCONVERT = (
+    "ProteoWizard `msconvert.exe` not found.\n\n"
+    "To fix this:\n"
+    " 1️. Install ProteoWizard:\n"
+    "     https://proteowizard.sourceforge.io/download.html\n\n"
+    " 2️. Locate the actual CLI binary (open Command Prompt and run):\n"
+    "     where /r C:\\ msconvert.exe\n\n"
+    "   • Ignore results like MSConvertGUI_Icon.exe — those are shortcuts.\n"
+    " 3️. Register it permanently (Command Prompt):\n"
+    "     setx PEPWIZ_MS_CONVERT \"<path to msconvert.exe>\"\n"
+    " 4️. Restart PepWiz and try again.\n\n"
+    "Tip: Verify the path prints usage (not a GUI):\n"
+    "    \"%PEPWIZ_MS_CONVERT%\" --help\n"
+)
+
+# ---- converter backends ----
+# run_msconvert() builds one msconvert command line; a backend supplies the program that runs it.
+# prepare() returns (command prefix, tool version) or raises RuntimeError with a user-facing message.
+
+class MsconvertBackend:
+    """ProteoWizard msconvert (found via find_msconvert(), validated once with --help)."""
+    name = "msconvert"
 
+    def __init__(self, exe: str | None = None):
+        self.exe = exe
 
+    def prepare(self, log_fn=None) -> tuple[list[str], str]:
+        exe = find_msconvert(self.exe)
+        if not exe:
+            if log_fn:
+                log_fn(_MISSING_MSCONVERT)
+            raise RuntimeError(_MISSING_MSCONVERT)
+        store = _provenance_store()
+        version = _store_call(store.msconvert_version, exe) if store else None
+        if version is None:
+            ok, preflight_msg = _preflight_msconvert(exe)
+            if not ok:
+                if store:
+                    _store_call(store.forget_msconvert, exe)
+                err = (
+                    "Found msconvert, but it failed a quick check.\n"
+                    "Make sure this is the CLI 'msconvert.exe', not the GUI/Installer icon.\n\n"
+                    f"{preflight_msg}"
+                )
+                if log_fn:
+                    log_fn(err)
+                raise RuntimeError(err)
+            version = _msconvert_version(preflight_msg)
+            if store:
+                _store_call(store.remember_msconvert, exe, version)
+        return [exe], version
+
+
+class FakeConverter:
+    """
+    Local stand-in (python -m pepwiz.fakeconvert) for synthetic RAW descriptions, with
+    injected latency/failures (see pepwiz.fakeconvert). Runs as a subprocess like msconvert,
+    so parallel conversion behaves the same way.
+    """
+    name = "fake"
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, fail_rate: float = 0.0,
+                 fail_match: str | None = None, fail_mode: str = "exit", seed: int | None = None):
+        self.latency, self.jitter, self.fail_rate = float(latency), float(jitter), float(fail_rate)
+        self.fail_match, self.fail_mode, self.seed = fail_match, fail_mode, seed
+
+    def prepare(self, log_fn=None) -> tuple[list[str], str]:
+        from .fakeconvert import VERSION
+        # -c with this package's parent on sys.path: works from a source tree as well as installed
+        boot = (f"import sys; sys.path.insert(0, {str(Path(__file__).resolve().parents[1])!r}); "
+                "from pepwiz.fakeconvert import main; sys.exit(main())")
+        cmd = [sys.executable, "-c", boot, "--latency", str(self.latency),
+               "--jitter", str(self.jitter), "--fail-rate", str(self.fail_rate), "--fail-mode", self.fail_mode]
+        if self.fail_match:
+            cmd += ["--fail-match", self.fail_match]
+        if self.seed is not None:
+            cmd += ["--seed", str(self.seed)]
+        return cmd, VERSION
+
+
+CONVERTERS = {"msconvert": MsconvertBackend, "fake": FakeConverter}
+_CONVERTER = None
+
+def set_converter(backend):
+    """Default backend for run_msconvert() in this process (None = back to $PEPWIZ_CONVERTER/msconvert)."""
+    global _CONVERTER
+    _CONVERTER = backend
+
+def get_converter(spec: str | None = None):
+    """
+    Backend from a spec like "msconvert" or "fake:latency=0.5,fail_rate=0.1"; without one, the
+    set_converter() default, else $PEPWIZ_CONVERTER, else msconvert.
+    """
+    if spec is None:
+        if _CONVERTER is not None:
+            return _CONVERTER
+        spec = os.environ.get("PEPWIZ_CONVERTER") or "msconvert"
+    name, _, params = spec.partition(":")
+    if name not in CONVERTERS:
+        raise RuntimeError(f"Unknown converter {name!r}; choose from {', '.join(CONVERTERS)}.")
+    kwargs = {}
+    for item in filter(None, params.split(",")):
+        key, _, value = item.partition("=")
+        try:
+            kwargs[key.strip()] = float(value) if key.strip() in ("latency", "jitter", "fail_rate") else (
+                int(value) if key.strip() == "seed" else value)
+        except ValueError:
+            raise RuntimeError(f"Bad converter option {item!r} in {spec!r}.") from None
+    try:
+        return CONVERTERS[name](**kwargs)
+    except TypeError as e:
+        raise RuntimeError(f"Bad converter options in {spec!r}: {e}") from None
+
+def _provenance_options(backend, options: list[str]) -> list[str]:
+    # conversions by another backend must never satisfy a msconvert lookup (and vice versa)
+    return options if backend.name == "msconvert" else [f"backend={backend.name}"] + options
+
+@with_events
+def run_msconvert(raw_path: str | Path, out_dir: str | Path | None = None, *,
+                  overwrite: bool = False, extra_filters: list[str] | None = None,
+                  log_fn=None, dest_dir: str | Path | None = None, reuse: bool = True,
+                  profile: str = "default", ms2_only: bool = False, backend=None) -> Path:
+    """
+    Convert a RAW file to mzML using one of CONVERSION_PROFILES (optionally MS2 only).
+    With reuse=True an unchanged RAW already converted with the same options into the same
+    folder is not converted again (see provenance.ProvenanceStore).
+    backend: MsconvertBackend (default) or FakeConverter; see get_converter().
+    """
     raw_path = Path(raw_path)
     out_dir = Path(dest_dir) if dest_dir is not None else (Path(out_dir) if out_dir is not None else raw_path.with_suffix(""))
+    backend = backend if backend is not None else get_converter()
+    options = msconvert_options(extra_filters, profile, ms2_only)
+    store = _provenance_store()
+    if reuse and store is not None and raw_path.exists():
+        previous = _store_call(store.lookup_conversion, raw_path, _provenance_options(backend, options),
+                               out_dir=out_dir)
+        if previous is not None:
+            if log_fn:
+                log_fn(f"Already converted (same RAW content and options): {previous}")
+            return previous
+
+    prefix, version = backend.prepare(log_fn)
+
     out_dir.mkdir(parents=True, exist_ok=True)
 
     out_name = raw_path.stem + ".mzML"
@@ -112,20 +314,48 @@ def run_msconvert(raw_path: str | Path, out_dir: str | Path | None = None, *,
                 break
             i += 1
 
-    cmd = [exe, str(raw_path), "--mzML", "--zlib", "--64",
-           "--filter", "peakPicking true 2-",
+    cmd = prefix + [str(raw_path)] + options + [
            "--outfile", str(out_mzml.name),
            "--outdir", str(out_dir)]
-    if extra_filters:
-        for f in extra_filters:
-            cmd += ["--filter", f]
 
-    cp = subprocess.run(cmd, capture_output=True, text=True, check=False)
+    def _stat(path):
+        try:
+            st = path.stat()
+            return st.st_size, st.st_mtime_ns
+        except OSError:
+            return None
+
+    before = _stat(out_mzml)   # with overwrite, a stale file must not pass for a new one
+    with events.stage("convert", raw=str(raw_path), profile=profile):
+        cp = subprocess.run(cmd, capture_output=True, text=True, check=False)
 
     if log_fn:
         if cp.stdout: log_fn(cp.stdout.strip())
         if cp.stderr: log_fn(cp.stderr.strip())
 
-    if cp.returncode != 0 or not out_mzml.exists():
-        raise RuntimeError(f"msconvert failed.\nSTDOUT:\n{cp.stdout}\nSTDERR:\n{cp.stderr}")
+    after = _stat(out_mzml)
+    if cp.returncode != 0 or after is None or after == before:
+        raise RuntimeError(f"{backend.name} failed.\nSTDOUT:\n{cp.stdout}\nSTDERR:\n{cp.stderr}")
+    if store is not None:
+        _store_call(store.record_conversion, raw_path, out_mzml, _provenance_options(backend, options),
+                    exe=" ".join(prefix), exe_version=version)
+    events.output(out_mzml, "mzml")
     return out_mzml
+
+def convert_many(raw_paths, workers: int = 2, **kwargs):
+    """
+    run_msconvert(path, **kwargs) for several RAW files, up to workers at a time (each
+    conversion is its own process, so threads suffice). Yields (raw_path, mzml_path, error)
+    in completion order, so analysis of the first files can start while the rest convert.
+    error is the RuntimeError/OSError message (mzml_path None) for a failed conversion.
+    """
+    import contextvars
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    raw_paths = [Path(p) for p in raw_paths]
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as pool:
+        futures = {pool.submit(contextvars.copy_context().run, run_msconvert, p, **kwargs): p for p in raw_paths}
+        for fut in as_completed(futures):
+            try:
+                yield futures[fut], fut.result(), None
+            except (RuntimeError, OSError) as e:
+                yield futures[fut], None, str(e)
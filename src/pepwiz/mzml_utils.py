@@ -1,11 +1,58 @@
 from pathlib import Path
 import re
 
-def open_reader(ms_path: Path):
-    """Open an mzML or mzXML file using pyteomics."""
+import numpy as np
+
+from . import events
+from .match_engine import PROTON
+
+ISOTOPE_SPACING = 1.00335  # 13C - 12C (Da)
+
+def open_reader(ms_path: Path, decode_binary: bool = True):
+    """
+    Open an mzML or mzXML file using pyteomics.
+    decode_binary=False leaves peak arrays encoded (zlib/numpress/32-bit) until peak_array()
+    is called, so skipped spectra (MS1, gated-out MS2) are never inflated or decoded.
+    """
     from pyteomics import mzxml, mzml
+    ms_path = Path(ms_path)
     opener = mzml.MzML if ms_path.suffix.lower() == ".mzml" else mzxml.MzXML
-    return opener(str(ms_path))
+    return opener(str(ms_path), decode_binary=decode_binary)
+
+def _spectrum_count(reader):
+    try:
+        return len(reader)
+    except Exception:   # non-indexed file
+        return None
+
+def _ticking(items, ticker):
+    try:
+        for item in items:
+            ticker.tick()
+            yield item
+    finally:
+        ticker.close()
+
+def tracked(reader, stage: str, ms_path):
+    """Iterate reader, reporting spectra read / total to the active event emitter (plain reader if none)."""
+    em = events.current()
+    if em is None:
+        return reader
+    return _ticking(reader, em.ticker(stage, _spectrum_count(reader), "spectra", path=str(ms_path)))
+
+def peak_array(value) -> np.ndarray:
+    """float64 array from a decoded or still-encoded (decode_binary=False) pyteomics array."""
+    if hasattr(value, "decode") and hasattr(value, "compression"):
+        try:
+            value = value.decode()
+        except Exception as e:
+            if "numpress" in str(getattr(value, "compression", "")).lower():
+                raise RuntimeError(
+                    "This file uses MS-Numpress compression, which needs pynumpress. Run:\n"
+                    "  py -m pip install pynumpress"
+                ) from e
+            raise
+    return np.asarray(value, dtype=float)
 
 def precursor_mz_from_spec(spec):
     """Extract precursor m/z from an MS2 spectrum (mzML or mzXML)."""
@@ -18,44 +65,315 @@ def precursor_mz_from_spec(spec):
     except Exception:
         return None
 
-def list_precursors_with_counts(ms_path: Path, dedup_ppm: float = 10.0):
-    """List unique precursor m/z clusters and counts."""
-    parents = []
+def spectrum_rt(spec):
+    """Retention time in minutes, or None if the spectrum doesn't carry one."""
+    # mzML: 'scanList'/'scan'/'scan start time' (minutes). mzXML sometimes 'retentionTime' in seconds (PTxxS).
+    rt = spec.get('scanList', {}).get('scan', [{}])[0].get('scan start time')
+    if rt is None:
+        # try mzXML ISO8601 duration 'PTxxS'
+        iso = spec.get('retentionTime')
+        if isinstance(iso, str) and iso.startswith("PT") and iso.endswith("S"):
+            try:
+                rt = float(iso[2:-1]) / 60.0
+            except Exception:
+                rt = None
+        elif iso is not None:
+            try:
+                rt = float(iso)
+            except Exception:
+                rt = None
+    return None if rt is None else float(rt)
+
+def precursor_info_from_spec(spec):
+    """(precursor m/z, charge, intensity) of an MS2 spectrum; charge/intensity are None when not recorded."""
+    pmz = precursor_mz_from_spec(spec)
+    z = inten = None
+    try:
+        if 'precursorList' in spec:  # mzML
+            sel = spec['precursorList']['precursor'][0]['selectedIonList']['selectedIon'][0]
+            z, inten = sel.get('charge state'), sel.get('peak intensity')
+        elif 'precursorMz' in spec:   # mzXML
+            p = spec['precursorMz'][0]
+            z, inten = p.get('precursorCharge'), p.get('precursorIntensity')
+        z = int(z) if z else None
+        inten = float(inten) if inten is not None else None
+    except Exception:
+        z = inten = None
+    return pmz, z, inten
+
+def precursor_inventory(ms_path: Path, dedup_ppm: float = 10.0):
+    """
+    One pass over the MS2 headers (no peak arrays decoded):
+      {"clusters": cluster_precursors(...) with RT range / apex / intensity / charge,
+       "scans": {"rt", "mz", "intensity", "charge"} NumPy arrays, one entry per MS2 scan with a precursor}
+    """
+    rts, parents, intens, charges = [], [], [], []
     try:
-        with open_reader(ms_path) as reader:
-            for spec in reader:
+        with open_reader(ms_path, decode_binary=False) as reader:
+            for spec in tracked(reader, "inventory", ms_path):
                 ms_level = spec.get('ms level') or spec.get('msLevel')
                 try:
                     if int(ms_level) != 2:
                         continue
                 except Exception:
                     continue
-                pmz = precursor_mz_from_spec(spec)
+                pmz, z, inten = precursor_info_from_spec(spec)
                 if pmz is not None:
                     parents.append(pmz)
+                    rts.append(spectrum_rt(spec))
+                    intens.append(inten)
+                    charges.append(z)
     except ImportError as e:
         raise RuntimeError("pyteomics (and lxml) are required. Run:\n  py -m pip install pyteomics lxml") from e
+    return inventory_from_arrays(parents, rts, intens, charges, dedup_ppm)
 
-    if not parents:
+def inventory_from_arrays(parents, rts, intensities, charges, dedup_ppm: float = 10.0):
+    """precursor_inventory() from per-scan lists (None = missing RT/intensity/charge)."""
+    def arr(values, fill):
+        return np.array([fill if v is None else v for v in values], dtype=float)
+    scans = {"mz": arr(parents, np.nan), "rt": arr(rts, np.nan),
+             "intensity": arr(intensities, np.nan), "charge": arr(charges, 0).astype(np.int64)}
+    return {"clusters": cluster_precursors(parents, dedup_ppm, scans=scans), "scans": scans}
+
+def list_precursors_with_counts(ms_path: Path, dedup_ppm: float = 10.0):
+    """List unique precursor m/z clusters and counts (plus RT range, apex RT, intensity, charge)."""
+    return precursor_inventory(ms_path, dedup_ppm)["clusters"]
+
+def cluster_precursors(parents, dedup_ppm: float = 10.0, scans=None):
+    """
+    Greedy ppm clustering of precursor m/z values -> [{mz, count}] sorted by count desc.
+    With scans (per-parent arrays "rt", "intensity", "charge" as from precursor_inventory) each
+    cluster also gets rt_min, rt_max, apex_rt (RT of its most intense precursor, else median RT),
+    intensity (summed precursor intensity) and charge (most common recorded charge).
+    """
+    if not len(parents):
         return []
-    parents.sort()
-    clusters, cur = [], [parents[0]]
-    for mz in parents[1:]:
-        center = sum(cur)/len(cur)
-        if abs(mz-center)/center*1e6 <= dedup_ppm:
-            cur.append(mz)
+    order = np.argsort(np.asarray(parents, dtype=float), kind="stable")
+    mzs = np.asarray(parents, dtype=float)[order].tolist()
+    label = np.empty(len(mzs), dtype=np.int64)
+    centers, counts = [], []
+    k, total, n = 0, mzs[0], 1
+    label[0] = 0
+    for i in range(1, len(mzs)):
+        mz = mzs[i]
+        center = total / n
+        if abs(mz - center) / center * 1e6 <= dedup_ppm:
+            total += mz; n += 1
         else:
-            clusters.append({"mz": sum(cur)/len(cur), "count": len(cur)})
-            cur = [mz]
-    clusters.append({"mz": sum(cur)/len(cur), "count": len(cur)})
+            centers.append(total / n); counts.append(n)
+            k += 1
+            total, n = mz, 1
+        label[i] = k
+    centers.append(total / n); counts.append(n)
+    clusters = [{"mz": c, "count": m} for c, m in zip(centers, counts)]
+
+    if scans is not None:
+        _describe_clusters(clusters, label, {key: np.asarray(v)[order] for key, v in scans.items()})
     clusters.sort(key=lambda r: (-r["count"], r["mz"]))
     return clusters
 
+def _describe_clusters(clusters, label, scans):
+    """Per-cluster RT range, apex, summed intensity and charge, all by grouped NumPy reductions."""
+    n = len(clusters)
+    rt, inten, z = scans["rt"].astype(float), scans["intensity"].astype(float), scans["charge"].astype(np.int64)
+    has_rt, has_i = ~np.isnan(rt), ~np.isnan(inten)
+    rt_min = np.full(n, np.inf); np.minimum.at(rt_min, label[has_rt], rt[has_rt])
+    rt_max = np.full(n, -np.inf); np.maximum.at(rt_max, label[has_rt], rt[has_rt])
+    i_sum = np.bincount(label[has_i], weights=inten[has_i], minlength=n)
+    n_i = np.bincount(label[has_i], minlength=n)
+    # apex: the scan with the largest precursor intensity in each cluster (first one on ties)
+    both = has_rt & has_i
+    apex = np.full(n, np.nan)
+    if both.any():
+        idx = np.flatnonzero(both)
+        srt = idx[np.lexsort((-inten[idx], label[idx]))]
+        first = np.unique(label[srt], return_index=True)[1]
+        apex[label[srt[first]]] = rt[srt[first]]
+    # no intensities recorded: median RT of the cluster's scans instead
+    missing = np.isnan(apex) & np.isfinite(rt_min)
+    if missing.any():
+        idx = np.flatnonzero(has_rt)
+        srt = idx[np.lexsort((rt[idx], label[idx]))]
+        groups, start, cnt = np.unique(label[srt], return_index=True, return_counts=True)
+        med = 0.5 * (rt[srt[start + (cnt - 1) // 2]] + rt[srt[start + cnt // 2]])
+        fill = missing[groups]
+        apex[groups[fill]] = med[fill]
+    # most common charge > 0 per cluster (lowest charge on ties)
+    zmax = int(z.max()) if len(z) else 0
+    zc = np.zeros((n, zmax + 1), dtype=np.int64)
+    ok = z > 0
+    np.add.at(zc, (label[ok], z[ok]), 1)
+    best_z = zc.argmax(axis=1) if zmax else np.zeros(n, dtype=np.int64)
+    for k, c in enumerate(clusters):
+        c.update(
+            rt_min=float(rt_min[k]) if np.isfinite(rt_min[k]) else None,
+            rt_max=float(rt_max[k]) if np.isfinite(rt_max[k]) else None,
+            apex_rt=None if np.isnan(apex[k]) else float(apex[k]),
+            intensity=float(i_sum[k]) if n_i[k] else None,
+            charge=int(best_z[k]) if best_z[k] > 0 else None,
+        )
+
+def format_cluster_columns(cluster) -> str:
+    """z / RT range / apex columns of a precursor cluster (NA when the file doesn't record them)."""
+    z = f"{cluster['charge']:>2}" if cluster.get("charge") else "NA"
+    rt = (f"{cluster['rt_min']:.2f}-{cluster['rt_max']:.2f}" if cluster.get("rt_min") is not None else "NA")
+    apex = f"{cluster['apex_rt']:.2f}" if cluster.get("apex_rt") is not None else "NA"
+    return f"{z:>2}  {rt:>15}  {apex:>6}"
+
+def precursor_density(inventory, rt_bins: int = 200, mz_bins: int = 200, weighted: bool = False):
+    """
+    2-D RT x precursor-m/z density of the MS2 scans of precursor_inventory():
+    (H[rt_bin, mz_bin], rt_edges, mz_edges). weighted=True sums precursor intensity instead of counting.
+    """
+    sc = inventory["scans"]
+    ok = ~np.isnan(sc["rt"]) & ~np.isnan(sc["mz"])
+    rt, mz = sc["rt"][ok], sc["mz"][ok]
+    w = np.nan_to_num(sc["intensity"][ok], nan=0.0) if weighted else None
+    rng = None
+    if len(rt):
+        # 2% margins so precursors at the edges of the run aren't drawn on the frame
+        pad = lambda a: (a.min() - 0.02 * (np.ptp(a) or 1.0), a.max() + 0.02 * (np.ptp(a) or 1.0))
+        rng = (pad(rt), pad(mz))
+    return np.histogram2d(rt, mz, bins=(rt_bins, mz_bins), range=rng, weights=w)
+
+def passes_ms2_gate(rt, pmz, precursor_mz: float | None, ppm_tol: float,
+                    rt_min: float | None, rt_max: float | None) -> bool:
+    """Precursor/RT gate shared by the file readers and the in-memory scan cache."""
+    # RT filter only applies if the scan has an RT
+    if rt is not None:
+        if rt_min is not None and rt < rt_min:
+            return False
+        if rt_max is not None and rt > rt_max:
+            return False
+    # Precursor m/z filter (if provided)
+    if precursor_mz is not None:
+        if pmz is None:
+            return False
+        if abs(pmz - precursor_mz) / precursor_mz * 1e6 > ppm_tol:
+            return False
+    return True
+
+def _ms2_record(spec, gate=None):
+    """Scan record for an MS2 spectrum that passes gate (None = no gate), else None."""
+    ms_level = spec.get('ms level') or spec.get('msLevel')
+    try:
+        if int(ms_level) != 2:
+            return None
+    except Exception:
+        return None
+    rt = spectrum_rt(spec)
+    pmz, pz, pint = precursor_info_from_spec(spec)
+    if gate is not None and not passes_ms2_gate(rt, pmz, *gate):
+        return None
+    return {
+        "rt": rt,
+        "precursor_mz": pmz,
+        "precursor_charge": pz,
+        "precursor_intensity": pint,
+        "mz": peak_array(spec['m/z array']),
+        "intensity": peak_array(spec['intensity array']),
+    }
+
+# ---- intra-file parallel decoding ----
+# The parent builds (or reads) the spectrum offset index once; each worker gets a pickled
+# reader that carries that index, so it can jump straight to its chunk of spectra.
+
+_WORKER_READER = None
+
+def _init_decode_worker(reader_state: bytes):
+    # unpickling reopens the file, so workers never share a file position (also under fork)
+    import pickle
+    global _WORKER_READER
+    _WORKER_READER = pickle.loads(reader_state)
+
+def _decode_chunk(ids, gate):
+    out = []
+    for sid in ids:
+        rec = _ms2_record(_WORKER_READER.get_by_id(sid), gate)
+        if rec is not None:
+            out.append(rec)
+    return out
+
+def _spectrum_ids(reader):
+    index = reader.index
+    for key in ("spectrum", "scan"):
+        try:
+            if key in index:
+                return list(index[key].keys())
+        except TypeError:
+            break
+    return list(index.keys())
+
+def _iter_ms2_records_parallel(ms_path: Path, gate, workers: int, chunk_size: int, stage: str = "decode"):
+    """Decode + gate chunks of spectra in a process pool; yield records in file order."""
+    import pickle
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    with open_reader(ms_path, decode_binary=False) as reader:
+        ids = _spectrum_ids(reader)
+        if len(ids) < 4 * chunk_size:
+            # not worth a pool: decode in-process
+            for spec in tracked(reader, stage, ms_path):
+                rec = _ms2_record(spec, gate)
+                if rec is not None:
+                    yield rec
+            return
+        chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+        max_pending = 2 * workers  # bounds decoded-but-unconsumed chunks in memory
+        progress = events.ticker(stage, len(ids), "spectra", path=str(ms_path))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_decode_worker,
+                                 initargs=(pickle.dumps(reader),)) as pool:
+            pending = deque()
+            next_chunk = 0
+            while pending or next_chunk < len(chunks):
+                while next_chunk < len(chunks) and len(pending) < max_pending:
+                    pending.append((len(chunks[next_chunk]), pool.submit(_decode_chunk, chunks[next_chunk], gate)))
+                    next_chunk += 1
+                n, fut = pending.popleft()
+                records = fut.result()
+                progress.tick(n)
+                yield from records
+        progress.close()
+
+def _iter_ms2_records(ms_path: Path, gate=None, workers: int = 1, chunk_size: int = 256, stage: str = "decode"):
+    try:
+        if workers and workers > 1:
+            yield from _iter_ms2_records_parallel(Path(ms_path), gate, int(workers), max(1, int(chunk_size)), stage)
+            return
+        reader = open_reader(ms_path, decode_binary=False)
+    except ImportError as e:
+        raise RuntimeError("pyteomics (and lxml) are required. Run:\n  py -m pip install pyteomics lxml") from e
+    with reader:
+        for spec in tracked(reader, stage, ms_path):
+            rec = _ms2_record(spec, gate)
+            if rec is not None:
+                yield rec
+
+def iter_ms2_scans(ms_path: Path, workers: int = 1, chunk_size: int = 256):
+    """
+    Yield every MS2 scan once as {"rt", "precursor_mz", "mz", "intensity"} (NumPy arrays).
+    This is the ungated scan table that the pipeline cache keeps in memory.
+    workers > 1 decodes chunks of chunk_size spectra in a process pool (same order/output).
+    """
+    yield from _iter_ms2_records(ms_path, None, workers, chunk_size)
+
 def iter_filtered_ms2_peaks(ms_path: Path, precursor_mz: float | None, ppm_tol: float,
-                            rt_min: float | None, rt_max: float | None):
-   
-    with open_reader(ms_path) as reader:
-        for spec in reader:
+                            rt_min: float | None, rt_max: float | None,
+                            workers: int = 1, chunk_size: int = 256):
+    """
+    Yield [(mz, inten)] for each MS2 scan passing the precursor/RT gate, in file order.
+    workers > 1 splits the file by spectrum offsets and decodes/filters chunks in a process
+    pool; at most 2*workers chunks are in flight, so memory stays bounded for huge files.
+    """
+    if workers and workers > 1:
+        gate = (precursor_mz, ppm_tol, rt_min, rt_max)
+        for rec in _iter_ms2_records(ms_path, gate, workers, chunk_size, stage="gate"):
+            yield list(zip(rec["mz"].tolist(), rec["intensity"].tolist()))
+        return
+
+    with open_reader(ms_path, decode_binary=False) as reader:
+        for spec in tracked(reader, "gate", ms_path):
             ms_level = spec.get('ms level') or spec.get('msLevel')
             try:
                 if int(ms_level) != 2:
@@ -63,35 +381,134 @@ def iter_filtered_ms2_peaks(ms_path: Path, precursor_mz: float | None, ppm_tol:
             except Exception:
                 continue
 
-            # RT filter (if available)
-            if rt_min is not None or rt_max is not None:
-                # mzML: 'scanList'/'scan'/'scan start time' (minutes). mzXML sometimes 'retentionTime' in seconds (PTxxS).
-                rt = spec.get('scanList', {}).get('scan', [{}])[0].get('scan start time')
-                if rt is None:
-                    # try mzXML ISO8601 duration 'PTxxS'
-                    iso = spec.get('retentionTime')
-                    if isinstance(iso, str) and iso.startswith("PT") and iso.endswith("S"):
-                        try:
-                            rt = float(iso[2:-1]) / 60.0
-                        except Exception:
-                            rt = None
-                # apply window if we have RT
-                if rt is not None:
-                    if rt_min is not None and rt < rt_min: 
-                        continue
-                    if rt_max is not None and rt > rt_max: 
-                        continue
+            rt = spectrum_rt(spec) if (rt_min is not None or rt_max is not None) else None
+            pmz = precursor_mz_from_spec(spec) if precursor_mz is not None else None
+            if not passes_ms2_gate(rt, pmz, precursor_mz, ppm_tol, rt_min, rt_max):
+                continue
 
-            # Precursor m/z filter (if provided)
-            if precursor_mz is not None:
-                pmz = precursor_mz_from_spec(spec)
-                if pmz is None:
-                    continue
-                if abs(pmz - precursor_mz) / precursor_mz * 1e6 > ppm_tol:
-                    continue
+            mzs = peak_array(spec['m/z array']); ints = peak_array(spec['intensity array'])
+            yield list(zip(mzs.tolist(), ints.tolist()))
+
+# ---- peak picking (the "top_n" stage) ----
+
+def parse_peak_picking(value, default=200):
+    """
+    "Top peaks to match" setting -> the top_n value the averaging functions accept:
+      200 / "200"   global top 200 by intensity (legacy)
+      "10/100"      local top 10 in every 100 m/z window
+      "snr:3"       peaks >= 3x the local noise (median intensity per 100 m/z window)
+      "snr:3/50"    same with 50 m/z noise windows
+      "0" / "all"   keep every peak (None); blank -> default
+    Integral floats (200.0, "200.0", JSON numbers) count as integers; bools are rejected.
+    Raises ValueError on anything else.
+    """
+    if isinstance(value, (bool, np.bool_)):
+        raise ValueError(f"invalid peak picking setting: {value!r}")
+    if value is None or isinstance(value, tuple):
+        return value
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        n = _peak_count(value)
+        return n if n > 0 else None
+    s = str(value).strip().lower().replace(" ", "")
+    if not s:
+        return default
+    if s in ("0", "all", "none"):
+        return None
+    if s.startswith("snr:"):
+        factor, _, width = s[4:].partition("/")
+        spec = ("snr", float(factor), float(width or 100.0))
+    elif "/" in s:
+        k, _, width = s.partition("/")
+        spec = ("local", _peak_count(k), float(width))
+    else:
+        n = _peak_count(s)
+        return n if n > 0 else None
+    if spec[1] <= 0 or spec[2] <= 0:
+        raise ValueError(f"invalid peak picking setting: {value!r}")
+    return spec
+
+def _peak_count(x) -> int:
+    """Peak count from an int, an integral float or its string form (200, 200.0, "200.0")."""
+    f = float(x)
+    if not f.is_integer():
+        raise ValueError(f"invalid peak picking setting: {x!r} (peak counts are whole numbers)")
+    return int(f)
+
+def format_peak_picking(top_n) -> str:
+    if top_n is None:
+        return "all peaks"
+    if isinstance(top_n, int):
+        return f"top {top_n}"
+    mode, param, width = top_n
+    if mode == "snr":
+        return f"S/N >= {param:g} (noise = median per {width:g} m/z)"
+    return f"top {param} per {width:g} m/z"
+
+def _top_indices(values: np.ndarray, n: int) -> np.ndarray:
+    """Indices of the n largest values in input order; ties go to the earlier index (like a stable sort)."""
+    if len(values) <= n:
+        return np.arange(len(values))
+    kth = np.partition(values, len(values) - n)[len(values) - n]
+    above = np.flatnonzero(values > kth)
+    ties = np.flatnonzero(values == kth)[:n - len(above)]
+    return np.sort(np.concatenate([above, ties]))
 
-            mzs = spec['m/z array']; ints = spec['intensity array']
-            yield list(zip(mzs, ints))
+def _windows(mz: np.ndarray, width: float):
+    """Boundaries of fixed m/z windows over m/z-sorted peaks: [(start, stop)] of each occupied window."""
+    win = np.floor(mz / width).astype(np.int64)
+    edges = np.flatnonzero(win[1:] != win[:-1]) + 1
+    bounds = np.concatenate([[0], edges, [len(mz)]])
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+def _sorted_by_mz(mz: np.ndarray, inten: np.ndarray):
+    if len(mz) < 2 or not np.any(mz[1:] < mz[:-1]):
+        return None, mz, inten
+    order = np.argsort(mz, kind="stable")
+    return order, mz[order], inten[order]
+
+def local_noise(mz, inten, width: float = 100.0, min_peaks: int = 5) -> np.ndarray:
+    """Noise level per peak: median intensity of its m/z window (global median for sparse windows)."""
+    mz, inten = np.asarray(mz, dtype=float), np.asarray(inten, dtype=float)
+    if not len(mz):
+        return np.empty(0)
+    order, mz, inten = _sorted_by_mz(mz, inten)
+    noise = np.empty(len(mz))
+    global_median = float(np.median(inten))
+    for a, b in _windows(mz, width):   # one partition-based median per window: linear overall
+        noise[a:b] = np.median(inten[a:b]) if b - a >= min_peaks else global_median
+    if order is not None:
+        noise[order] = noise.copy()
+    return noise
+
+def select_peaks(mz, inten, top_n) -> np.ndarray:
+    """
+    Indices (ascending) of the peaks kept by a top_n setting from parse_peak_picking().
+    Selection is by partial partition (np.partition / per-window medians), never a full sort.
+    """
+    inten = np.asarray(inten, dtype=float)
+    n = len(inten)
+    if top_n is None or n == 0:
+        return np.arange(n)
+    if isinstance(top_n, (int, np.integer)):
+        return _top_indices(inten, int(top_n)) if top_n > 0 else np.arange(n)
+    mode, param, width = top_n
+    mz = np.asarray(mz, dtype=float)
+    if mode == "snr":
+        return np.flatnonzero(inten >= param * local_noise(mz, inten, width))
+    if mode == "local":
+        order, mz_s, inten_s = _sorted_by_mz(mz, inten)
+        keep = np.concatenate([a + _top_indices(inten_s[a:b], int(param)) for a, b in _windows(mz_s, width)])
+        return np.sort(keep if order is None else order[keep])
+    raise ValueError(f"unknown peak picking mode: {mode!r}")
+
+def pick_peaks(spectrum, top_n):
+    """select_peaks() for an m/z-sorted [(mz, inten, ...)] list; returns the kept entries in order."""
+    if top_n is None or not spectrum:
+        return list(spectrum)
+    if isinstance(top_n, int) and (top_n <= 0 or len(spectrum) <= top_n):
+        return list(spectrum)
+    arr = np.asarray([p[:2] for p in spectrum], dtype=float)
+    return [spectrum[i] for i in select_peaks(arr[:, 0], arr[:, 1], top_n).tolist()]
 
 def average_spectrum(peaks_lists, bin_ppm: float = 10.0, top_n: int | None = 200):
     """Average multiple MS2 peak lists into one centroided spectrum."""
@@ -121,8 +538,523 @@ def average_spectrum(peaks_lists, bin_ppm: float = 10.0, top_n: int | None = 200
 
     if not out:
         return out
-    if isinstance(top_n, int) and top_n > 0 and len(out) > top_n:
-        out = sorted(out, key=lambda x: x[1], reverse=True)[:top_n]
-    out.sort(key=lambda x: x[0])
+    # bins come out in m/z order
+    return pick_peaks(out, top_n)
+
+
+# ---- bounded-memory (streaming) averaging ----
+
+def _iter_blocks(arr, block: int = 1 << 16):
+    """(mz, inten) pairs of a (2, n) m/z-sorted array (in memory or memory-mapped), block by block."""
+    for start in range(0, arr.shape[1], block):
+        chunk = np.array(arr[:, start:start + block])
+        yield from zip(chunk[0].tolist(), chunk[1].tolist())
+
+def _iter_sorted_run(path: Path, block: int = 1 << 16):
+    """Stream (mz, inten) pairs from a spilled run, block by block via a memory map."""
+    return _iter_blocks(np.load(path, mmap_mode="r"), block)
+
+def _greedy_bins(sorted_peaks, bin_ppm: float):
+    """average_spectrum's greedy binning over an m/z-sorted stream -> (centroid, summed I)."""
+    mz0 = None
+    sum_I = sum_mzI = 0.0
+    hi = 0.0
+    for mz, inten in sorted_peaks:
+        if mz0 is None or mz > hi:
+            if mz0 is not None and sum_I > 0:
+                yield (sum_mzI / sum_I, sum_I)
+            mz0 = mz
+            hi = mz0 * (1 + bin_ppm * 1e-6)
+            sum_I = sum_mzI = 0.0
+        sum_I += inten
+        sum_mzI += mz * inten
+    if mz0 is not None and sum_I > 0:
+        yield (sum_mzI / sum_I, sum_I)
+
+def _window_groups(sorted_peaks, width: float):
+    """Group an m/z-sorted stream into the fixed windows of _windows(): yields (mz array, I array)."""
+    win, mzs, its = None, [], []
+    for mz, inten in sorted_peaks:
+        w = int(np.floor(mz / width))
+        if w != win and mzs:
+            yield np.array(mzs), np.array(its)
+            mzs, its = [], []
+        win = w
+        mzs.append(mz); its.append(inten)
+    if mzs:
+        yield np.array(mzs), np.array(its)
+
+def _kth_smallest(read_blocks, k: int, limit: int = 1 << 16, n_buckets: int = 1024) -> float:
+    """
+    k-th smallest (0-based) of the values streamed by read_blocks() (a fresh block iterator per call),
+    exactly, holding at most ~limit values: histogram passes narrow the bucket holding it.
+    """
+    levels = []                    # (lo, hi, bucket) chosen so far; a candidate falls in all of them
+    below = 0                      # values already known to rank before the candidates
+
+    def bucket(v, lo, hi):
+        if hi <= lo:
+            return np.zeros(len(v), dtype=np.int64)
+        return np.clip(((v - lo) / (hi - lo) * n_buckets).astype(np.int64), 0, n_buckets - 1)
+
+    def candidates(v):
+        keep = np.ones(len(v), dtype=bool)
+        for lo, hi, b in levels:
+            keep &= bucket(v, lo, hi) == b
+        return v[keep]
+
+    while True:
+        n, lo, hi = 0, np.inf, -np.inf
+        for v in read_blocks():
+            c = candidates(v)
+            if len(c):
+                n += len(c); lo = min(lo, float(c.min())); hi = max(hi, float(c.max()))
+        if n <= limit or lo == hi:
+            if lo == hi:
+                return lo
+            vals = np.concatenate([candidates(v) for v in read_blocks()])
+            return float(np.partition(vals, k - below)[k - below])
+        counts = np.zeros(n_buckets, dtype=np.int64)
+        for v in read_blocks():
+            counts += np.bincount(bucket(candidates(v), lo, hi), minlength=n_buckets)
+        cum = np.cumsum(counts)
+        b = int(np.searchsorted(cum, k - below, side="right"))
+        below += int(cum[b - 1]) if b else 0
+        levels.append((lo, hi, b))
+
+def _pick_streamed(bins, top_n, spill, block: int = 1 << 16, min_peaks: int = 5):
+    """
+    pick_peaks() over an m/z-sorted stream of bins, holding one m/z window (or top_n bins) at a time.
+    S/N picking spills the bin intensities through spill(name) -> path, for the global median
+    that sparse windows fall back to (see local_noise); they are read back block pairs at a time.
+    """
+    import heapq
+    if top_n is None or (isinstance(top_n, int) and top_n <= 0):
+        return list(bins)                                     # every bin: the output itself is O(bins)
+    if isinstance(top_n, int):
+        out = heapq.nlargest(top_n, bins, key=lambda x: x[1])  # O(top_n) memory
+        out.sort(key=lambda x: x[0])
+        return out
+    mode, param, width = top_n
+    if mode == "local":
+        out = []
+        for mz, inten in _window_groups(bins, width):
+            idx = _top_indices(inten, int(param))
+            out.extend(zip(mz[idx].tolist(), inten[idx].tolist()))
+        return out
+    if mode != "snr":
+        raise ValueError(f"unknown peak picking mode: {mode!r}")
+
+    # pass 1: bins to disk (raw float64 mz, I pairs), noting whether any window is sparse
+    path = spill("bins.f8")
+    n, sparse = 0, False
+    with open(path, "wb") as fh:
+        for mz, inten in _window_groups(bins, width):
+            np.column_stack([mz, inten]).tofile(fh)
+            n += len(mz)
+            sparse = sparse or len(mz) < min_peaks
+    if not n:
+        return []
+    data = np.memmap(path, dtype=np.float64, mode="r", shape=(n, 2))
+
+    def intensities():
+        return (np.array(data[i:i + block, 1]) for i in range(0, n, block))
+
+    global_median = None
+    if sparse:   # np.median: the middle value, or the mean of the two middle values
+        hi = _kth_smallest(intensities, n // 2)
+        global_median = hi if n % 2 else float(np.mean([_kth_smallest(intensities, n // 2 - 1), hi]))
+    # pass 2: one window at a time from the spilled bins
+    out = []
+    pairs = _iter_blocks(data.T, block)
+    for mz, inten in _window_groups(pairs, width):
+        noise = np.median(inten) if len(inten) >= min_peaks else global_median
+        keep = inten >= param * noise
+        out.extend(zip(mz[keep].tolist(), inten[keep].tolist()))
+    del data, pairs
     return out
 
+def average_spectrum_streaming(peaks_iter, bin_ppm: float = 10.0, top_n: int | None = 200,
+                               memory_budget_mb: float = 256.0, spill_dir: Path | None = None):
+    """
+    Same result as average_spectrum(), but consumes scans one at a time.
+    Peaks are buffered up to a quarter of memory_budget_mb (sorting needs copies); beyond that each
+    buffer is sorted and spilled to a temporary .npy run, and the runs are k-way merged
+    (memory-mapped, read in blocks sized to the budget) into the binning pass. Peak picking holds
+    only top_n bins or one m/z window at a time (S/N picking spills the bins for a second pass), so
+    memory stays within the budget plus the output; top_n=None returns every bin, O(bins) output.
+    Returns (averaged_spectrum, n_scans).
+    """
+    import heapq, tempfile
+
+    budget = max(1.0, float(memory_budget_mb)) * 1024 * 1024
+    n_scans = 0
+    buf, buf_bytes, runs = [], 0, []
+    tmp = None
+
+    def spill(name: str) -> Path:
+        nonlocal tmp
+        if tmp is None:
+            tmp = tempfile.TemporaryDirectory(prefix="pepwiz-avg-", dir=spill_dir)
+        return Path(tmp.name) / name
+
+    def sorted_buffer():
+        run = np.concatenate(buf, axis=1)
+        buf.clear()
+        return run[:, np.argsort(run[0], kind="stable")]
+
+    try:
+        for peaks in peaks_iter:
+            n_scans += 1
+            if not peaks:
+                continue
+            arr = np.asarray(peaks, dtype=float).T   # (2, n)
+            buf.append(arr)
+            buf_bytes += arr.nbytes
+            if buf_bytes > budget / 4:
+                path = spill(f"run{len(runs):05d}.npy")
+                np.save(path, sorted_buffer())
+                runs.append(path)
+                buf_bytes = 0
+
+        last = sorted_buffer() if buf else None
+        n_streams = len(runs) + (last is not None)
+        if not n_streams:
+            return [], n_scans
+        # each stream holds one block as Python floats (~80 bytes per pair); share a quarter of the budget
+        block = max(256, int(budget / 4 / n_streams / 80))
+        streams = [_iter_sorted_run(p, block) for p in runs]
+        if last is not None:
+            streams.append(_iter_blocks(last, block))
+            last = None   # freed with its stream once merged
+        # heapq.merge keeps earlier runs first on ties, i.e. the same order as one stable sort
+        merged = streams[0] if len(streams) == 1 else heapq.merge(*streams, key=lambda p: p[0])
+        del streams
+        return _pick_streamed(_greedy_bins(merged, bin_ppm), top_n, spill,
+                              block=max(256, int(budget / 4 / 80))), n_scans
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+
+# ---- fixed log-spaced (ppm-uniform) grid averaging ----
+
+def grid_index(mz, bin_ppm: float = 10.0):
+    """Integer bin of m/z on a log grid where every bin is bin_ppm wide."""
+    return np.floor(np.log(np.asarray(mz, dtype=float)) / np.log1p(bin_ppm * 1e-6)).astype(np.int64)
+
+_LIMB = float(1 << 24)
+
+def _to_limbs(x: np.ndarray) -> np.ndarray:
+    """Fixed-point limbs (n, 3) int64 of x: floor(x / 2^24), the rest of floor(x), and the fraction in 2^-24 units."""
+    x = np.asarray(x, dtype=float)
+    whole = np.floor(x)
+    high = np.floor(whole / _LIMB)
+    frac = np.rint((x - whole) * _LIMB)   # all three steps are exact in float64
+    return np.column_stack([high, whole - high * _LIMB, frac]).astype(np.int64)
+
+def _from_limbs(limbs: np.ndarray) -> np.ndarray:
+    limbs = limbs.astype(float)
+    return limbs[:, 0] * _LIMB + limbs[:, 1] + limbs[:, 2] / _LIMB
+
+class GridAccumulator:
+    """
+    Sparse sums (intensity, m/z*intensity) per log-grid bin.
+    Sums are kept in fixed point (integer limbs, resolution 2^-24 ≈ 6e-8 in intensity units), so
+    adding scans and merging accumulators are exact integer sums: partial accumulators built in
+    any order, thread, process or run combine to bit-identical spectra.
+    Picklable; spectrum() does the centroid refinement.
+    """
+
+    def __init__(self, bin_ppm: float = 10.0):
+        self.bin_ppm = float(bin_ppm)
+        self.n_scans = 0
+        self._keys = np.empty(0, dtype=np.int64)
+        self._sum_i = np.empty((0, 3), dtype=np.int64)
+        self._sum_mzi = np.empty((0, 3), dtype=np.int64)
+        self._pending = []
+        self._pending_n = 0
+
+    def add(self, peaks):
+        """Accumulate one scan [(mz, inten)]."""
+        self.n_scans += 1
+        if not len(peaks):
+            return self
+        arr = np.asarray(peaks, dtype=float)
+        arr = arr[arr[:, 0] > 0]
+        self._pending.append((grid_index(arr[:, 0], self.bin_ppm), _to_limbs(arr[:, 1]),
+                              _to_limbs(arr[:, 0] * arr[:, 1])))
+        self._pending_n += len(arr)
+        if self._pending_n > (1 << 20):
+            self._compact()
+        return self
+
+    def add_many(self, peaks_lists):
+        for peaks in peaks_lists:
+            self.add(peaks)
+        return self
+
+    def merge(self, other: "GridAccumulator"):
+        """Add another accumulator (same grid) into this one."""
+        if other.bin_ppm != self.bin_ppm:
+            raise RuntimeError(f"Cannot merge grids of {other.bin_ppm} and {self.bin_ppm} ppm.")
+        other._compact()
+        self._pending.append((other._keys, other._sum_i, other._sum_mzi))
+        self._pending_n += len(other._keys)
+        self.n_scans += other.n_scans
+        self._compact()
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def scaled(self, factor: float) -> "GridAccumulator":
+        """Copy with every bin sum multiplied by factor (rounded once onto the fixed-point grid)."""
+        self._compact()
+        out = GridAccumulator(self.bin_ppm)
+        out.n_scans = self.n_scans
+        out._keys = self._keys.copy()
+        out._sum_i = _to_limbs(_from_limbs(self._sum_i) * factor)
+        out._sum_mzi = _to_limbs(_from_limbs(self._sum_mzi) * factor)
+        return out
+
+    def __len__(self):
+        self._compact()
+        return len(self._keys)
+
+    def __getstate__(self):
+        self._compact()
+        return self.__dict__.copy()
+
+    def _compact(self):
+        if not self._pending:
+            return
+        keys = np.concatenate([self._keys] + [p[0] for p in self._pending])
+        si = np.concatenate([self._sum_i] + [p[1] for p in self._pending])
+        smi = np.concatenate([self._sum_mzi] + [p[2] for p in self._pending])
+        self._keys, inverse = np.unique(keys, return_inverse=True)
+        order = np.argsort(inverse.ravel(), kind="stable")
+        starts = np.flatnonzero(np.r_[True, np.diff(inverse.ravel()[order]) != 0]) if len(order) else order
+        self._sum_i = np.add.reduceat(si[order], starts, axis=0) if len(order) else si
+        self._sum_mzi = np.add.reduceat(smi[order], starts, axis=0) if len(order) else smi
+        self._pending, self._pending_n = [], 0
+
+    def spectrum(self, top_n: int | None = 200, max_span: int = 2):
+        """
+        Centroided spectrum [(mz, summed I)], m/z-sorted like average_spectrum().
+        Runs of adjacent occupied bins (a peak straddling a bin edge) are merged into one
+        intensity-weighted centroid, at most max_span bins per peak.
+        """
+        self._compact()
+        sum_i, sum_mzi = _from_limbs(self._sum_i), _from_limbs(self._sum_mzi)
+        keep = sum_i > 0
+        keys, si, smi = self._keys[keep], sum_i[keep], sum_mzi[keep]
+        if not len(keys):
+            return []
+        start = np.ones(len(keys), dtype=bool)
+        start[1:] = np.diff(keys) != 1
+        run = np.cumsum(start) - 1
+        pos = np.arange(len(keys)) - np.flatnonzero(start)[run]
+        group = np.cumsum(start | (pos % max(1, int(max_span)) == 0)) - 1
+        tot_i = np.bincount(group, weights=si)
+        out_mz = np.bincount(group, weights=smi) / tot_i
+        if top_n is not None:
+            idx = select_peaks(out_mz, tot_i, top_n)
+            out_mz, tot_i = out_mz[idx], tot_i[idx]
+        return list(zip(out_mz.tolist(), tot_i.tolist()))
+
+def average_spectrum_grid(peaks_lists, bin_ppm: float = 10.0, top_n: int | None = 200):
+    """average_spectrum() on the fixed log grid (order-independent, mergeable; see GridAccumulator)."""
+    return GridAccumulator(bin_ppm).add_many(peaks_lists).spectrum(top_n)
+
+
+def _accumulate_chunk(ids, gate, bin_ppm, calibration):
+    from .calibration import calibrate_peaks
+    acc = GridAccumulator(bin_ppm)
+    for rec in _decode_chunk(ids, gate):
+        peaks = np.column_stack([rec["mz"], rec["intensity"]])
+        acc.add(calibrate_peaks(peaks, calibration) if calibration else peaks)
+    return acc
+
+def accumulate_ms2_grid(ms_path: Path, precursor_mz: float | None, ppm_tol: float,
+                        rt_min: float | None, rt_max: float | None, bin_ppm: float = 10.0,
+                        calibration: dict | None = None, workers: int = 1, chunk_size: int = 256):
+    """
+    Gate the file's MS2 scans straight into a GridAccumulator (memory ~ occupied bins, not scans).
+    workers > 1 accumulates chunks of spectra in a process pool and merges the partial grids.
+    calibration (from calibration.fit_ppm_calibration) is applied to each scan first.
+    """
+    ms_path = Path(ms_path)
+    gate = (precursor_mz, ppm_tol, rt_min, rt_max)
+    if not workers or workers <= 1:
+        from .calibration import calibrate_peaks
+        acc = GridAccumulator(bin_ppm)
+        for rec in _iter_ms2_records(ms_path, gate, stage="gate"):
+            peaks = np.column_stack([rec["mz"], rec["intensity"]])
+            acc.add(calibrate_peaks(peaks, calibration) if calibration else peaks)
+        return acc
+
+    import pickle
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    try:
+        reader = open_reader(ms_path, decode_binary=False)
+    except ImportError as e:
+        raise RuntimeError("pyteomics (and lxml) are required. Run:\n  py -m pip install pyteomics lxml") from e
+    with reader:
+        ids = _spectrum_ids(reader)
+        chunk_size = max(1, int(chunk_size))
+        chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+        if len(chunks) < 4:
+            return accumulate_ms2_grid(ms_path, precursor_mz, ppm_tol, rt_min, rt_max, bin_ppm, calibration)
+        acc = GridAccumulator(bin_ppm)
+        progress = events.ticker("gate", len(ids), "spectra", path=str(ms_path))
+        with ProcessPoolExecutor(max_workers=int(workers), initializer=_init_decode_worker,
+                                 initargs=(pickle.dumps(reader),)) as pool:
+            futures = {pool.submit(_accumulate_chunk, c, gate, bin_ppm, calibration): len(c) for c in chunks}
+            for fut in as_completed(futures):
+                acc.merge(fut.result())  # exact integer sums: completion order doesn't matter
+                progress.tick(futures[fut])
+        progress.close()
+        return acc
+
+
+
+def _nearest_free_peak(mzs, used, target: float, ppm_tol: float):
+    """Index of the closest unused peak within ±ppm_tol of target, else None."""
+    tol = target * ppm_tol * 1e-6
+    lo = int(np.searchsorted(mzs, target - tol, side="left"))
+    hi = int(np.searchsorted(mzs, target + tol, side="right"))
+    best, best_d = None, None
+    for k in range(lo, hi):
+        if used[k]:
+            continue
+        d = abs(mzs[k] - target)
+        if best_d is None or d < best_d:
+            best, best_d = k, d
+    return best
+
+def deisotope_spectrum(spectrum, ppm_tol: float = 10.0, max_charge: int = 4,
+                       min_isotopes: int = 2, max_isotopes: int = 6,
+                       keep_singletons: bool = True, top_n: int | None = None):
+    """
+    Collapse isotope envelopes and assign a charge to each fragment.
+    Works on an averaged spectrum or a single scan: [(mz, inten)] -> [(neutral_mass, inten, z)],
+    sorted by mass. Envelope intensities are summed onto the monoisotopic peak. Peaks with no
+    isotope partner are kept as z=1 when keep_singletons is True.
+    """
+    if not spectrum:
+        return []
+    arr = np.asarray(spectrum, dtype=float)
+    order = np.argsort(arr[:, 0], kind="stable")
+    mzs, ints = arr[order, 0], arr[order, 1]
+    used = np.zeros(len(mzs), dtype=bool)
+    max_charge = max(1, int(max_charge))
+
+    out = []
+    for seed in np.argsort(-ints, kind="stable"):
+        if used[seed]:
+            continue
+        used[seed] = True  # keep the seed out of its own neighbour searches
+        best_z, best_chain = None, None
+        for z in range(max_charge, 0, -1):
+            step = ISOTOPE_SPACING / z
+            chain = [seed]
+            cur = seed
+            while len(chain) < max_isotopes:
+                nxt = _nearest_free_peak(mzs, used, mzs[cur] + step, ppm_tol)
+                if nxt is None or nxt in chain:
+                    break
+                chain.append(nxt); cur = nxt
+            # the most intense peak is not always monoisotopic (larger fragments)
+            cur = seed
+            while len(chain) < max_isotopes:
+                prv = _nearest_free_peak(mzs, used, mzs[cur] - step, ppm_tol)
+                if prv is None or prv in chain:
+                    break
+                chain.insert(0, prv); cur = prv
+            if len(chain) >= min_isotopes and (best_chain is None or len(chain) > len(best_chain)):
+                best_z, best_chain = z, chain
+
+        if best_chain is not None:
+            used[best_chain] = True
+            mono = mzs[best_chain[0]]
+            out.append(((mono - PROTON) * best_z, float(ints[best_chain].sum()), best_z))
+        elif keep_singletons:
+            out.append((mzs[seed] - PROTON, float(ints[seed]), 1))
+
+    out.sort(key=lambda x: x[0])
+    out = pick_peaks(out, top_n)
+    return [(float(m), i, z) for m, i, z in out]
+
+
+def extract_xics(ms_path: Path, targets, ppm_tol: float = 10.0, ms_level: int = 1,
+                 precursor_mz: float | None = None, precursor_ppm: float | None = None):
+    """
+    Extracted-ion chromatograms for many m/z targets in one pass over the file.
+    Each scan is summed within ±ppm_tol of every target at once (sorted targets + searchsorted
+    on a cumulative-intensity array). With ms_level=2, precursor_mz gates the MS2 scans
+    (fragment-ion XICs). Returns {"targets", "rt", "traces"}; traces is (n_targets, n_scans).
+    """
+    targets = np.asarray(targets, dtype=float)
+    order = np.argsort(targets)
+    sorted_t = targets[order]
+    lo = sorted_t * (1 - ppm_tol * 1e-6)
+    hi = sorted_t * (1 + ppm_tol * 1e-6)
+    gate_ppm = ppm_tol if precursor_ppm is None else precursor_ppm
+
+    rts, cols = [], []
+    with open_reader(ms_path, decode_binary=False) as reader:
+        for spec in tracked(reader, "xic", ms_path):
+            level = spec.get('ms level') or spec.get('msLevel')
+            try:
+                if int(level) != ms_level:
+                    continue
+            except Exception:
+                continue
+            if precursor_mz is not None and ms_level > 1:
+                pmz = precursor_mz_from_spec(spec)
+                if pmz is None or abs(pmz - precursor_mz) / precursor_mz * 1e6 > gate_ppm:
+                    continue
+            rt = spectrum_rt(spec)
+            if rt is None:
+                continue
+            mzs = peak_array(spec['m/z array'])
+            ints = peak_array(spec['intensity array'])
+            if mzs.size > 1 and np.any(mzs[1:] < mzs[:-1]):
+                o = np.argsort(mzs, kind="stable"); mzs, ints = mzs[o], ints[o]
+            csum = np.concatenate(([0.0], np.cumsum(ints)))
+            cols.append(csum[np.searchsorted(mzs, hi, side="right")] - csum[np.searchsorted(mzs, lo, side="left")])
+            rts.append(rt)
+
+    traces = np.zeros((len(targets), len(rts)))
+    if cols:
+        traces[order] = np.stack(cols, axis=1)
+    return {"targets": targets, "rt": np.asarray(rts, dtype=float), "traces": traces}
+
+def suggest_rt_window(rt, trace, frac: float = 0.1, smooth: int = 5):
+    """
+    Elution apex and a suggested RT window from one XIC trace.
+    The trace is smoothed with a moving average; the window spans the contiguous region
+    around the apex where the smoothed signal stays >= frac * apex.
+    Returns {"apex_rt", "apex_intensity", "rt_min", "rt_max"} or None for an empty trace.
+    """
+    rt = np.asarray(rt, dtype=float)
+    y = np.asarray(trace, dtype=float)
+    if y.size == 0 or not np.any(y > 0):
+        return None
+    k = max(1, min(int(smooth), y.size))
+    ys = np.convolve(y, np.ones(k) / k, mode="same")
+    apex = int(np.argmax(ys))
+    above = ys >= frac * ys[apex]
+    left = apex
+    while left > 0 and above[left - 1]:
+        left -= 1
+    right = apex
+    while right < y.size - 1 and above[right + 1]:
+        right += 1
+    return {
+        "apex_rt": float(rt[apex]),
+        "apex_intensity": float(y[apex]),
+        "rt_min": float(rt[left]),
+        "rt_max": float(rt[right]),
+    }
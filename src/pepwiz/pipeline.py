@@ -0,0 +1,776 @@
+from __future__ import annotations
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from .match_engine import (
+    PROTON,
+    ppm_delta,
+    calc_fragments,
+    legacy_summary_from_spectrum,
+    neutral_fragments,
+    legacy_summary_from_neutral,
+    decoy_match_stats,
+    mass_shift_search,
+)
+from .mzml_utils import (
+    iter_ms2_scans,
+    iter_filtered_ms2_peaks,
+    precursor_inventory,
+    inventory_from_arrays,
+    passes_ms2_gate,
+    average_spectrum,
+    average_spectrum_streaming,
+    GridAccumulator,
+    accumulate_ms2_grid,
+    deisotope_spectrum,
+    pick_peaks,
+    parse_peak_picking,
+)
+from .calibration import (
+    fit_ppm_calibration,
+    calibrate_peaks,
+    calibration_fit_key,
+    format_calibration,
+    load_cached_calibration,
+    save_cached_calibration,
+)
+from . import events
+from .events import with_events
+from .io_legacy import write_legacy_out
+from .selection import ScanIndex, ScanSelection
+
+
+_MISSING = object()
+
+
+def file_key(ms_path: Path):
+    """Identity of a file's contents for caching: (resolved path, size, mtime)."""
+    p = Path(ms_path).resolve()
+    st = p.stat()
+    return (str(p), st.st_size, st.st_mtime_ns)
+
+
+class AnalysisCache:
+    """
+    Memoizes the expensive stages of a run, each keyed only by the inputs it depends on:
+
+      scans     <- file                      (the one full parse of the mzML/mzXML)
+      clusters  <- file, dedup_ppm          (precursor inventory: clusters + per-scan RT/m/z table)
+      gated     <- file, precursor, gate ppm, RT window  (ordinals of the passing scans)
+      grids     <- gated key, bin ppm, calibration  (GridAccumulator, for averaging="grid")
+      averaged  <- gated key, bin ppm, top_n, calibration, averaging mode
+      index     <- file                      (ScanIndex: per-scan header table for ScanSelections)
+
+    Fragment building, matching and writing are never cached. A change of charges, terminal mod
+    or B/J/X masses therefore only re-matches, and a new ppm/RT window re-gates from memory
+    instead of re-reading the file. Up to max_files files are kept (least recently used first out).
+    workers > 1 decodes the one full parse in a process pool (see iter_ms2_scans); the stage
+    methods take a workers= override for callers that run several files at once.
+
+    With memory_budget_mb set, scans are never held in memory: clusters and averages are computed
+    by streaming the file, and the averaging accumulator spills sorted runs to spill_dir (a temp
+    dir by default) whenever it grows past the budget. Only the small results are cached.
+    Grid averaging needs no spill: its accumulator only grows with the number of occupied bins.
+    """
+
+    def __init__(self, max_files: int = 2, max_averaged: int = 16, workers: int = 1,
+                 memory_budget_mb: float | None = None, spill_dir: Path | None = None):
+        self.max_files = max(1, int(max_files))
+        self.max_averaged = max(1, int(max_averaged))
+        self.workers = max(1, int(workers))
+        self.memory_budget_mb = memory_budget_mb
+        self.spill_dir = spill_dir
+        self._files: OrderedDict = OrderedDict()   # fkey -> {"scans", "clusters", "gated", "averaged"}
+        self._lock = threading.RLock()
+
+    def _entry(self, ms_path: Path):
+        fkey = file_key(ms_path)
+        with self._lock:
+            entry = self._files.get(fkey)
+            if entry is not None:
+                self._files.move_to_end(fkey)
+                return fkey, entry
+            # a file that changed on disk gets a new key; drop the stale one
+            for old in [k for k in self._files if k[0] == fkey[0]]:
+                del self._files[old]
+            entry = {"scans": None, "clusters": {}, "gated": OrderedDict(), "averaged": OrderedDict(),
+                     "grids": OrderedDict(), "counts": OrderedDict(), "index": None,
+                     "lock": threading.RLock()}
+            self._files[fkey] = entry
+            while len(self._files) > self.max_files:
+                self._files.popitem(last=False)
+            return fkey, entry
+
+    # LRU lookup/insert under the entry lock (the server runs analyses on a thread pool);
+    # values are computed outside the lock and returned from a local, never re-read from the cache.
+    # The once-per-file stages (scans, inventory, index, streamed counts) are computed under the
+    # (re-entrant) lock instead, so concurrent cold requests make one pass over the file, not one each.
+    def _cached(self, entry, name: str, key):
+        with entry["lock"]:
+            cache = entry[name]
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+        return _MISSING
+
+    def _remember(self, entry, name: str, key, value):
+        with entry["lock"]:
+            cache = entry[name]
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > self.max_averaged:
+                cache.popitem(last=False)
+        return value
+
+    @property
+    def streaming(self) -> bool:
+        return self.memory_budget_mb is not None
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+
+    def __len__(self):
+        return len(self._files)
+
+    def scans(self, ms_path: Path, workers: int | None = None) -> List[Dict]:
+        """All MS2 scans of the file (parsed once)."""
+        _, entry = self._entry(ms_path)
+        with entry["lock"]:
+            if entry["scans"] is None:
+                entry["scans"] = list(iter_ms2_scans(Path(ms_path), workers=workers or self.workers))
+            return entry["scans"]
+
+    def inventory(self, ms_path: Path, dedup_ppm: float = 10.0, workers: int | None = None) -> Dict:
+        """Same result as precursor_inventory(), computed from the cached scans."""
+        _, entry = self._entry(ms_path)
+        with entry["lock"]:
+            if dedup_ppm not in entry["clusters"] and self.streaming:
+                entry["clusters"][dedup_ppm] = precursor_inventory(Path(ms_path), dedup_ppm=dedup_ppm)
+            if dedup_ppm not in entry["clusters"]:
+                scans = [s for s in self.scans(ms_path, workers) if s["precursor_mz"] is not None]
+                entry["clusters"][dedup_ppm] = inventory_from_arrays(
+                    [s["precursor_mz"] for s in scans], [s["rt"] for s in scans],
+                    [s.get("precursor_intensity") for s in scans], [s.get("precursor_charge") for s in scans],
+                    dedup_ppm)
+            return entry["clusters"][dedup_ppm]
+
+    def clusters(self, ms_path: Path, dedup_ppm: float = 10.0, workers: int | None = None):
+        """Same result as list_precursors_with_counts(), computed from the cached scans."""
+        return self.inventory(ms_path, dedup_ppm, workers)["clusters"]
+
+    def _gate_indices(self, ms_path: Path, precursor_mz: float | None, ppm_tol: float,
+                      rt_min: float | None, rt_max: float | None, workers: int | None = None) -> np.ndarray:
+        _, entry = self._entry(ms_path)
+        key = (precursor_mz, ppm_tol, rt_min, rt_max)
+        idx = self._cached(entry, "gated", key)
+        if idx is not _MISSING:
+            return idx
+        idx = np.array([i for i, s in enumerate(self.scans(ms_path, workers))
+                        if passes_ms2_gate(s["rt"], s["precursor_mz"], precursor_mz, ppm_tol, rt_min, rt_max)],
+                       dtype=np.int64)
+        return self._remember(entry, "gated", key, idx)
+
+    def gated(self, ms_path: Path, precursor_mz: float | None, ppm_tol: float,
+              rt_min: float | None = None, rt_max: float | None = None, workers: int | None = None):
+        """
+        Peak lists of the scans passing the gate (same output as iter_filtered_ms2_peaks).
+        Only the scan ordinals are cached; the lists are built per call.
+        """
+        scans = self.scans(ms_path, workers)
+        return [list(zip(scans[i]["mz"].tolist(), scans[i]["intensity"].tolist()))
+                for i in self._gate_indices(ms_path, precursor_mz, ppm_tol, rt_min, rt_max, workers).tolist()]
+
+    def gated_count(self, ms_path: Path, precursor_mz: float | None, ppm_tol: float,
+                    rt_min: float | None = None, rt_max: float | None = None, workers: int | None = None) -> int:
+        """Number of scans passing the gate (a counting pass in streaming mode, no peaks kept)."""
+        if not self.streaming:
+            return len(self._gate_indices(ms_path, precursor_mz, ppm_tol, rt_min, rt_max, workers))
+        _, entry = self._entry(ms_path)
+        key = (precursor_mz, ppm_tol, rt_min, rt_max)
+        with entry["lock"]:
+            n = self._cached(entry, "counts", key)
+            if n is _MISSING:
+                n = self._remember(entry, "counts", key, sum(
+                    1 for _ in iter_filtered_ms2_peaks(Path(ms_path), precursor_mz, ppm_tol, rt_min, rt_max)))
+            return n
+
+    def accumulated(self, ms_path: Path, precursor_mz: float | None, ppm_tol: float,
+                    rt_min: float | None, rt_max: float | None, bin_ppm: float,
+                    calibration: Dict | None = None, workers: int | None = None) -> GridAccumulator:
+        """Log-grid accumulator of the gated scans; merge copies of it, don't modify it."""
+        _, entry = self._entry(ms_path)
+        key = (precursor_mz, ppm_tol, rt_min, rt_max, bin_ppm, _calibration_key(calibration))
+        acc = self._cached(entry, "grids", key)
+        if acc is not _MISSING:
+            return acc
+        if self.streaming:
+            acc = accumulate_ms2_grid(Path(ms_path), precursor_mz, ppm_tol, rt_min, rt_max, bin_ppm,
+                                      calibration, workers=workers or self.workers)
+            self._remember(entry, "counts", key[:4], acc.n_scans)
+        else:
+            peaks = self.gated(ms_path, precursor_mz, ppm_tol, rt_min, rt_max, workers)
+            if calibration:
+                peaks = [calibrate_peaks(p, calibration) for p in peaks]
+            acc = GridAccumulator(bin_ppm).add_many(peaks)
+        return self._remember(entry, "grids", key, acc)
+
+    def averaged(self, ms_path: Path, precursor_mz: float | None, ppm_tol: float,
+                 rt_min: float | None, rt_max: float | None, bin_ppm: float,
+                 top_n: int | None, calibration: Dict | None = None, averaging: str = "greedy",
+                 workers: int | None = None):
+        """
+        Averaged spectrum of the gated scans (recalibrated first if a calibration is given).
+        averaging="greedy" is average_spectrum(); "grid" is the fixed log grid (GridAccumulator).
+        """
+        _, entry = self._entry(ms_path)
+        key = (precursor_mz, ppm_tol, rt_min, rt_max, bin_ppm, top_n, _calibration_key(calibration), averaging)
+        spec = self._cached(entry, "averaged", key)
+        if spec is not _MISSING:
+            return spec
+        if averaging == "grid":
+            spec = self.accumulated(ms_path, precursor_mz, ppm_tol, rt_min, rt_max, bin_ppm,
+                                    calibration, workers).spectrum(top_n)
+        elif self.streaming:
+            peaks = iter_filtered_ms2_peaks(Path(ms_path), precursor_mz, ppm_tol, rt_min, rt_max,
+                                            workers=workers or self.workers)
+            if calibration:
+                peaks = (calibrate_peaks(p, calibration) for p in peaks)
+            spec, n_scans = average_spectrum_streaming(
+                peaks, bin_ppm=bin_ppm, top_n=top_n,
+                memory_budget_mb=self.memory_budget_mb, spill_dir=self.spill_dir)
+            self._remember(entry, "counts", key[:4], n_scans)
+        else:
+            peaks = self.gated(ms_path, precursor_mz, ppm_tol, rt_min, rt_max, workers)
+            if calibration:
+                peaks = [calibrate_peaks(p, calibration) for p in peaks]
+            spec = average_spectrum(peaks, bin_ppm=bin_ppm, top_n=top_n)
+        return self._remember(entry, "averaged", key, spec)
+
+    def scan_index(self, ms_path: Path) -> ScanIndex:
+        """ScanIndex of the file: from the cached scans, or one header pass in streaming mode."""
+        _, entry = self._entry(ms_path)
+        with entry["lock"]:
+            if entry["index"] is None:
+                if self.streaming:
+                    entry["index"] = ScanIndex.from_file(Path(ms_path))
+                else:
+                    entry["index"] = ScanIndex.from_scans(Path(ms_path), self.scans(ms_path))
+            return entry["index"]
+
+    def selected(self, ms_path: Path, selection: ScanSelection):
+        """Peak lists of the selected scans (memory mode; gated() for a ScanSelection, not cached)."""
+        return list(self.scan_index(ms_path).peaks(selection))
+
+    def averaged_selection(self, ms_path: Path, selection: ScanSelection, bin_ppm: float,
+                           top_n: int | None, calibration: Dict | None = None, averaging: str = "greedy"):
+        """averaged() over a ScanSelection; in streaming mode only the selected scans are decoded."""
+        _, entry = self._entry(ms_path)
+        key = ("selection", selection.key(), bin_ppm, top_n, _calibration_key(calibration), averaging)
+        spec = self._cached(entry, "averaged", key)
+        if spec is not _MISSING:
+            return spec
+        if self.streaming:
+            peaks = self.scan_index(ms_path).peaks(selection, workers=self.workers)
+        else:
+            peaks = self.selected(ms_path, selection)
+        if calibration:
+            peaks = (calibrate_peaks(p, calibration) for p in peaks)
+        if averaging == "grid":
+            spec = GridAccumulator(bin_ppm).add_many(peaks).spectrum(top_n)
+        elif self.streaming:
+            spec, _ = average_spectrum_streaming(
+                peaks, bin_ppm=bin_ppm, top_n=top_n,
+                memory_budget_mb=self.memory_budget_mb, spill_dir=self.spill_dir)
+        else:
+            spec = average_spectrum(list(peaks), bin_ppm=bin_ppm, top_n=top_n)
+        return self._remember(entry, "averaged", key, spec)
+
+
+def _calibration_key(calibration: Dict | None):
+    return None if not calibration else (tuple(calibration["coeffs"]), tuple(calibration["mz_range"]))
+
+
+@lru_cache(maxsize=256)
+def _fragment_table(seq: str, charges: tuple, overrides: tuple, term_mod: str):
+    return tuple(calc_fragments(seq, list(charges), dict(overrides), term_mod))
+
+def fragment_table(seq: str, charges, overrides: dict | None, term_mod: str):
+    """calc_fragments() memoized on its inputs (fragment tables are reused across runs and requests)."""
+    return list(_fragment_table(seq, tuple(int(z) for z in charges),
+                                tuple(sorted((overrides or {}).items())), term_mod))
+
+
+def snap_precursor(precursor_mz: float, clusters):
+    """Nearest cluster center to the typed precursor: (snapped_mz, delta_ppm, cluster or None)."""
+    if not clusters:
+        return precursor_mz, None, None
+    nearest = min(clusters, key=lambda c: ppm_delta(precursor_mz, c["mz"]))
+    return nearest["mz"], ppm_delta(precursor_mz, nearest["mz"]), nearest
+
+
+@with_events
+def analyze(
+    ms_path: Path,
+    seq: str,
+    charges,
+    ppm: float,
+    precursor_mz: float,
+    *,
+    overrides: dict | None = None,
+    term_mod: str = "None",
+    rt_min: float | None = None,
+    rt_max: float | None = None,
+    top_n: int | None = 200,
+    deisotope: bool = False,
+    n_decoys: int = 0,
+    calibrate: bool = False,
+    calib_ppm: float = 30.0,
+    calib_source: Path | None = None,
+    calib_degree: int = 1,
+    open_search: bool = False,
+    averaging: str = "greedy",
+    selection=None,
+    selection_label: str | None = None,
+    cache: AnalysisCache | None = None,
+    log_fn=print,
+) -> Dict:
+    """
+    Headless PepWiz run: snap precursor -> gate -> (calibrate) -> average -> (deisotope) -> match
+    -> (localize the precursor mass shift).
+    Returns a dict with the matched rows and everything write_legacy_out() needs.
+    result["scans_count"] == 0 means nothing passed the filters.
+    averaging: "greedy" (average_spectrum) or "grid" (fixed log grid, see GridAccumulator).
+    top_n: global peak count, or a local-window / S/N setting (see parse_peak_picking()).
+    events: an events.EventEmitter receiving stage/progress/warning events (see pepwiz.events).
+    selection: a ScanSelection over cache.scan_index(ms_path), or a function index -> ScanSelection,
+    used instead of the precursor/RT gate (the precursor is still snapped for the open search);
+    result["selection"] then records {label, scans, total, key} for the .out header.
+    """
+    ms_path = Path(ms_path)
+    overrides = overrides or {}
+    top_n = parse_peak_picking(top_n)
+    cache = cache if cache is not None else AnalysisCache(max_files=1)
+    t0 = time.perf_counter()
+
+    theo = fragment_table(seq, charges, overrides, term_mod)
+
+    with events.stage("precursors"):
+        clusters = cache.clusters(ms_path, dedup_ppm=10.0)
+    parent_mz, delta_ppm, nearest = snap_precursor(precursor_mz, clusters)
+    if nearest is not None:
+        log_fn(f"Precursor gate centered at {parent_mz:.4f} "
+               f"(snapped to {parent_mz:.4f}, Δ={delta_ppm:.2f} ppm, scans={nearest['count']})")
+        if delta_ppm > 50:
+            msg = f"entered parent {precursor_mz:.4f} is {delta_ppm:.1f} ppm from nearest cluster {parent_mz:.4f}."
+            log_fn(f"Warning: {msg}")
+            events.warning(msg, "precursor_snap", precursor_mz=precursor_mz, parent_mz=parent_mz, delta_ppm=delta_ppm)
+    else:
+        log_fn("No parent clusters found; using the typed precursor m/z as-is.")
+        events.warning("no parent clusters found; using the typed precursor m/z", "no_clusters",
+                       precursor_mz=precursor_mz)
+
+    result = {
+        "parent_mz": parent_mz, "snap_delta_ppm": delta_ppm, "clusters": clusters,
+        "scans_count": 0, "avg_spec": [], "rows": [], "theo": theo,
+        "calibration": None, "deisotoped_max_z": None, "decoy_stats": None, "mass_shift": None,
+        "averaging": averaging, "peak_picking": top_n, "selection": None,
+        "deisotoped": None, "open_search": None,   # for rematch()
+    }
+
+    with events.stage("gate"):
+        if selection is not None:
+            index = cache.scan_index(ms_path)
+            if callable(selection):
+                selection = selection(index)
+            if selection.n != len(index):
+                raise ValueError(f"selection covers {selection.n} scans but {ms_path.name} has {len(index)} MS2 scans")
+            result["scans_count"] = len(selection)
+            result["selection"] = {"label": selection_label, "scans": len(selection), "total": len(index),
+                                   "key": selection.key()}
+            log_fn(f"Scan selection: {len(selection)}/{len(index)} MS2 scans (precursor/RT gate not applied).")
+        else:
+            if cache.streaming:
+                # the streamed average also counts the gated scans, so prime it instead of a separate pass
+                cache.averaged(ms_path, parent_mz, ppm, rt_min, rt_max, ppm, None if deisotope else top_n,
+                               averaging=averaging)
+            result["scans_count"] = cache.gated_count(ms_path, parent_mz, ppm, rt_min, rt_max)
+
+    def average(n, cal):
+        if selection is not None:
+            return cache.averaged_selection(ms_path, selection, ppm, n, cal, averaging)
+        return cache.averaged(ms_path, parent_mz, ppm, rt_min, rt_max, ppm, n, cal, averaging)
+
+    if not result["scans_count"]:
+        events.warning("no MS2 scans passed the precursor/RT filters", "no_scans",
+                       parent_mz=parent_mz, ppm=ppm, rt_min=rt_min, rt_max=rt_max)
+        return result
+
+    # --- Optional two-pass mass recalibration (fits cached per source file and fit inputs) ---
+    calibration = None
+    if calibrate:
+        cal_source = Path(calib_source) if calib_source is not None else ms_path
+        gate = ({"selection": result["selection"]["key"]} if selection is not None
+                else {"precursor_mz": parent_mz, "ppm": ppm, "rt": [rt_min, rt_max]})
+        fit_key = calibration_fit_key(
+            sequence=seq, charges=[int(z) for z in charges], overrides=overrides,
+            term_mod=term_mod, calib_ppm=max(calib_ppm, ppm), degree=int(calib_degree),
+            top_n=list(top_n) if isinstance(top_n, tuple) else top_n, averaging=averaging, **gate)
+        calibration = load_cached_calibration(cal_source, fit_key)
+        if calibration:
+            log_fn(f"Using cached calibration: {format_calibration(calibration)}")
+        else:
+            wide = max(calib_ppm, ppm)
+            first_spec = average(top_n, None)
+            calibration = fit_ppm_calibration(legacy_summary_from_spectrum(first_spec, theo, wide),
+                                              degree=calib_degree)
+            if calibration:
+                save_cached_calibration(cal_source, calibration, fit_key)
+                log_fn(
+                    f"Calibration fit on {calibration['n_inliers']}/{calibration['n_points']} ions at ±{wide} ppm: "
+                    f"{format_calibration(calibration)} (MAD {calibration['mad_ppm']:.2f} ppm)"
+                )
+            else:
+                log_fn(f"Calibration skipped: too few matches at ±{wide} ppm.")
+                events.warning(f"calibration skipped: too few matches at ±{wide} ppm", "calibration_skipped")
+    result["calibration"] = calibration
+
+    deiso = None
+    if deisotope:
+        # Deisotope before top-N so isotope peaks don't take the slots of real fragments
+        max_z = max(charges)
+        with events.stage("average", scans=result["scans_count"]):
+            avg_spec = average(None, calibration)
+            deiso = deisotope_spectrum(avg_spec, ppm_tol=ppm, max_charge=max_z, top_n=top_n)
+        log_fn(f"Deisotoped {len(avg_spec)} averaged peaks into {len(deiso)} neutral masses (z <= {max_z}).")
+        result["deisotoped_max_z"] = max_z
+        result["deisotoped"] = deiso
+    else:
+        with events.stage("average", scans=result["scans_count"]):
+            avg_spec = average(top_n, calibration)
+    with events.stage("match"):
+        rows = _match_rows(avg_spec, deiso, seq, charges, overrides, term_mod, ppm, theo)
+    # --- Optional open-modification search on the precursor mass difference ---
+    if open_search:
+        # the inventory's recorded charge for the snapped cluster; None falls back to the smallest |Δ|
+        prec_z = nearest.get("charge") if nearest is not None else None
+        result["open_search"] = {"precursor_charge": prec_z}
+        with events.stage("open_search"):
+            shift = _open_search(avg_spec, deiso, seq, charges, overrides, term_mod, ppm, parent_mz, prec_z)
+        if shift is None:
+            log_fn("Open search skipped: no averaged peaks.")
+        elif not _is_shifted(shift, parent_mz, ppm):
+            log_fn(f"Open search: precursor matches the unmodified peptide (Δ={shift['delta_mass']:+.4f} Da).")
+        else:
+            best = shift["best"]
+            log_fn(
+                f"Open search: Δ={shift['delta_mass']:+.4f} Da (precursor z={shift['precursor_charge']}) "
+                f"best at {best['site']} with {best['matches']}/{shift['n_ions']} ions "
+                f"(unmodified {shift['unmodified_matches']}, next site {best['matches'] - shift['margin']})"
+            )
+            # the report and annotations use the shifted ladder; deisotoped rows stay neutral/unshifted
+            shift["applied"] = deiso is None
+            if shift["applied"]:
+                rows = shift["rows"]
+                result["theo"] = shift["theo"]
+            result["mass_shift"] = shift
+    result["avg_spec"] = avg_spec
+    result["rows"] = rows
+
+    # --- Optional decoy estimate against the same spectrum ---
+    if n_decoys and n_decoys > 0:
+        with events.stage("decoys", n_decoys=n_decoys):
+            if deiso is not None:
+                # deisotoped peaks are neutral masses; compare them as singly charged ions
+                stats = decoy_match_stats([(m + PROTON, i) for m, i, _z in deiso], seq, [1],
+                                          overrides, term_mod, ppm, n_decoys=n_decoys)
+            else:
+                stats = decoy_match_stats(avg_spec, seq, charges, overrides, term_mod, ppm, n_decoys=n_decoys)
+        if stats:
+            log_fn(
+                f"Decoys: target {stats['target_matches']}/{stats['n_ions']} ions vs "
+                f"{stats['decoy_mean']:.1f} ± {stats['decoy_sd']:.1f} for {stats['n_decoys']} decoys "
+                f"(p = {stats['p_value']:.4g}{', unmodified ladder' if result['mass_shift'] else ''})"
+            )
+        else:
+            log_fn("Decoy estimate skipped: sequence too short to shuffle.")
+        result["decoy_stats"] = stats
+
+    log_fn(f"Analysis finished in {(time.perf_counter() - t0) * 1000:.0f} ms "
+           f"({result['scans_count']} scans, {len(rows)} matched ions).")
+    return result
+
+
+
+def _match_rows(avg_spec, deiso, seq, charges, overrides, term_mod, ppm, theo=None):
+    """analyze()'s match step: deisotoped neutral masses if given, else the averaged m/z peaks."""
+    if deiso is not None:
+        return legacy_summary_from_neutral(deiso, neutral_fragments(seq, overrides, term_mod), ppm)
+    if theo is None:
+        theo = fragment_table(seq, charges, overrides, term_mod)
+    return legacy_summary_from_spectrum(avg_spec, theo, ppm)
+
+def _open_search(avg_spec, deiso, seq, charges, overrides, term_mod, ppm, parent_mz, precursor_charge):
+    if deiso is not None:
+        # deisotoped peaks are neutral masses; search them as singly charged ions
+        return mass_shift_search([(m + PROTON, i) for m, i, _z in deiso], seq, [1],
+                                 overrides, term_mod, ppm, parent_mz, precursor_charge=precursor_charge)
+    return mass_shift_search(avg_spec, seq, charges, overrides, term_mod, ppm, parent_mz,
+                             precursor_charge=precursor_charge)
+
+def _is_shifted(shift, parent_mz: float, ppm: float) -> bool:
+    return abs(shift["delta_mass"]) > parent_mz * shift["precursor_charge"] * ppm * 1e-6
+
+def rematch(result: Dict, seq: str, charges, ppm: float, overrides: dict | None = None,
+            term_mod: str = "None") -> List[Dict]:
+    """
+    Rows for new sequence/charges/tolerance/mods against a finished analyze() result, along the
+    same path analyze() took: its (calibrated) average, its deisotoped neutral list, and the
+    open-search shifted ladder when the precursor still doesn't match. No file access.
+    """
+    overrides = overrides or {}
+    deiso = result.get("deisotoped")
+    rows = _match_rows(result["avg_spec"], deiso, seq, charges, overrides, term_mod, ppm)
+    search = result.get("open_search")
+    if search is not None and deiso is None:
+        shift = _open_search(result["avg_spec"], None, seq, charges, overrides, term_mod, ppm,
+                             result["parent_mz"], search["precursor_charge"])
+        if shift is not None and _is_shifted(shift, result["parent_mz"], ppm):
+            rows = shift["rows"]
+    return rows
+
+
+def _replicate_run(cache: AnalysisCache, ms_path: Path, precursor_mz: float, ppm: float,
+                   rt_min: float | None, rt_max: float | None, averaging: str = "greedy",
+                   workers: int | None = None) -> Dict:
+    """Snap, gate and average one replicate file (summed intensities, no top-N)."""
+    clusters = cache.clusters(ms_path, dedup_ppm=10.0, workers=workers)
+    parent_mz, delta_ppm, _nearest = snap_precursor(precursor_mz, clusters)
+    grid = (cache.accumulated(ms_path, parent_mz, ppm, rt_min, rt_max, ppm, workers=workers)
+            if averaging == "grid" else None)
+    avg = cache.averaged(ms_path, parent_mz, ppm, rt_min, rt_max, ppm, None, averaging=averaging, workers=workers)
+    return {
+        "path": str(ms_path), "parent_mz": parent_mz, "snap_delta_ppm": delta_ppm,
+        "scans_count": cache.gated_count(ms_path, parent_mz, ppm, rt_min, rt_max, workers=workers),
+        "avg_spec": avg, "grid": grid,
+    }
+
+def replicate_ion_stats(rows, run_specs, ppm: float, top_n: int | None = 200) -> List[Dict]:
+    """
+    Per-ion reproducibility of consensus matches across runs.
+    Each run's spectrum is cut to the same top-N as the consensus; an ion counts as observed in a
+    run if it matches there within ±ppm. Intensities are normalized to the run's total intensity
+    before the CV, so different loadings don't read as irreproducibility.
+    """
+    theo = [(r["ion"], r["theo"]) for r in rows]
+    per_run = []
+    for spec in run_specs:
+        total = sum(i for _mz, i in spec) or 1.0
+        spec = pick_peaks(spec, top_n)
+        per_run.append(({h["ion"]: h for h in legacy_summary_from_spectrum(spec, theo, ppm)}, total))
+
+    stats = []
+    for r in rows:
+        hits = [(run[r["ion"]], total) for run, total in per_run if r["ion"] in run]
+        share = np.array([h["inten"] / total for h, total in hits])
+        cv = float(share.std(ddof=1) / share.mean() * 100) if len(share) > 1 and share.mean() > 0 else None
+        stats.append({
+            "z": r["z"], "itype": r["itype"], "idx": r["idx"], "ion": r["ion"],
+            "n_runs": len(hits), "n_total": len(run_specs), "cv_pct": cv,
+            "mean_ppm": float(np.mean([h["ppm"] for h, _t in hits])) if hits else None,
+        })
+    return stats
+
+@with_events
+def analyze_replicates(
+    ms_paths,
+    seq: str,
+    charges,
+    ppm: float,
+    precursor_mz: float,
+    *,
+    overrides: dict | None = None,
+    term_mod: str = "None",
+    rt_min: float | None = None,
+    rt_max: float | None = None,
+    top_n: int | None = 200,
+    n_decoys: int = 0,
+    averaging: str = "greedy",
+    workers: int | None = None,
+    cache: AnalysisCache | None = None,
+    log_fn=print,
+) -> Dict:
+    """
+    Consensus run over replicate files: each file is snapped/gated/averaged in parallel, the
+    per-file averages are divided by their scan counts (so every run weighs the same however many
+    scans it has) and merged with average_spectrum(), then matched once. With averaging="grid"
+    the per-file grid accumulators are scaled the same way and summed.
+    workers runs are processed at once (default: all); the cache's decode workers are split
+    between them.
+    Returns the same keys as analyze() plus "runs" (per-file stats, with "share": the run's
+    fraction of the consensus intensity) and "replicate_stats" (replicate_ion_stats() of the
+    matched ions).
+    """
+    ms_paths = [Path(p) for p in ms_paths]
+    overrides = overrides or {}
+    top_n = parse_peak_picking(top_n)
+    cache = cache if cache is not None else AnalysisCache(max_files=len(ms_paths))
+    workers = max(1, min(len(ms_paths), workers or os.cpu_count() or 1))
+    decode_workers = max(1, cache.workers // workers)   # concurrent runs share the decode pool budget
+    t0 = time.perf_counter()
+
+    theo = fragment_table(seq, charges, overrides, term_mod)
+    with events.stage("replicates", files=len(ms_paths)), ThreadPoolExecutor(max_workers=workers) as pool:
+        # each thread gets a copy of this context, so the active event emitter follows the work
+        futures = [pool.submit(contextvars.copy_context().run, _replicate_run,
+                               cache, p, precursor_mz, ppm, rt_min, rt_max, averaging, decode_workers)
+                   for p in ms_paths]
+        runs = [f.result() for f in futures]
+
+    # per-scan means: a run's weight in the consensus doesn't depend on how many scans it had
+    for run in runs:
+        n = run["scans_count"]
+        run["avg_spec"] = [(mz, i / n) for mz, i in run["avg_spec"]] if n else []
+        if run["grid"] is not None and n:
+            run["grid"] = run["grid"].scaled(1.0 / n)
+    total = sum(i for run in runs for _mz, i in run["avg_spec"]) or 1.0
+    for run in runs:
+        run["share"] = sum(i for _mz, i in run["avg_spec"]) / total
+
+    for run in runs:
+        delta = run["snap_delta_ppm"]
+        log_fn(f"{Path(run['path']).name}: parent {run['parent_mz']:.4f}"
+               f"{'' if delta is None else f' (Δ={delta:.2f} ppm)'}, {run['scans_count']} scans, "
+               f"{run['share'] * 100:.0f}% of the consensus intensity")
+    used = [run for run in runs if run["scans_count"]]
+    if len(used) < len(runs):
+        log_fn(f"Warning: {len(runs) - len(used)} of {len(runs)} runs had no scans passing the filters.")
+        events.warning(f"{len(runs) - len(used)} of {len(runs)} runs had no scans passing the filters", "no_scans",
+                       paths=[r["path"] for r in runs if not r["scans_count"]])
+
+    result = {
+        "parent_mz": float(np.mean([r["parent_mz"] for r in used])) if used else precursor_mz,
+        "snap_delta_ppm": None, "clusters": None,
+        "scans_count": sum(r["scans_count"] for r in used),
+        "avg_spec": [], "rows": [], "theo": theo,
+        "calibration": None, "deisotoped_max_z": None, "decoy_stats": None,
+        "runs": [{k: v for k, v in r.items() if k not in ("avg_spec", "grid")} for r in runs],
+        "replicate_stats": [], "averaging": averaging, "peak_picking": top_n,
+    }
+    if not used:
+        return result
+
+    with events.stage("average", scans=result["scans_count"]):
+        if averaging == "grid":
+            pooled = GridAccumulator(ppm)
+            for r in used:
+                pooled.merge(r["grid"])
+            avg_spec = pooled.spectrum(top_n)
+        else:
+            avg_spec = average_spectrum([r["avg_spec"] for r in used], bin_ppm=ppm, top_n=top_n)
+    with events.stage("match"):
+        rows = legacy_summary_from_spectrum(avg_spec, theo, ppm)
+    result["avg_spec"] = avg_spec
+    result["rows"] = rows
+    result["replicate_stats"] = replicate_ion_stats(rows, [r["avg_spec"] for r in used], ppm, top_n)
+
+    if n_decoys and n_decoys > 0:
+        result["decoy_stats"] = decoy_match_stats(avg_spec, seq, charges, overrides, term_mod, ppm,
+                                                  n_decoys=n_decoys)
+
+    log_fn(f"Replicate analysis finished in {(time.perf_counter() - t0) * 1000:.0f} ms "
+           f"({len(used)} runs, {result['scans_count']} scans, {len(rows)} matched ions).")
+    return result
+
+
+def output_paths(source: Path, charges) -> Dict[str, Path]:
+    """Output file names used by the GUI: <stem>.z<charges>.out/.fragments.svg/.spectrum.svg."""
+    base = Path(source).with_suffix("")
+    z_label = ",".join(str(z) for z in charges)
+    return {
+        "out": base.parent / f"{base.name}.z{z_label}.out",
+        "fragments": base.parent / f"{base.name}.z{z_label}.fragments.svg",
+        "spectrum": base.parent / f"{base.name}.z{z_label}.spectrum.svg",
+    }
+
+
+def _float_or_none(v):
+    return None if v in (None, "") else float(v)
+
+def _flag(v) -> bool:
+    return v.strip().lower() in ("1", "true", "yes", "y", "on") if isinstance(v, str) else bool(v)
+
+def analysis_kwargs(req: Dict) -> Dict:
+    """
+    analyze() arguments from a flat dict of strings or JSON values (server requests, batch CSV rows):
+    sequence, charges ("1,2" or [1, 2]), ppm, precursor_mz, overrides, term_mod, rt_min, rt_max,
+    top_n, deisotope, n_decoys, open_search, averaging. Raises ValueError on missing/invalid fields.
+    """
+    try:
+        seq = str(req["sequence"]).strip().upper()
+        charges = req.get("charges", [1])
+        if isinstance(charges, str):
+            charges = [int(z) for z in charges.split(",") if z.strip()]
+        charges = [int(z) for z in charges]
+        ppm = float(req.get("ppm", 10.0))
+        precursor_mz = float(req["precursor_mz"])
+        overrides = req.get("overrides") or {}
+        if isinstance(overrides, str):
+            overrides = json.loads(overrides)
+        overrides = {k: float(v) for k, v in overrides.items()}
+        top_n = parse_peak_picking(req.get("top_n", 200), default=None)
+        n_decoys = int(req.get("n_decoys", 0) or 0)
+        rt_min, rt_max = _float_or_none(req.get("rt_min")), _float_or_none(req.get("rt_max"))
+    except KeyError as e:
+        raise ValueError(f"missing field: {e.args[0]}") from e
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"invalid field: {e}") from e
+    if not seq or not charges or any(z <= 0 for z in charges) or ppm <= 0:
+        raise ValueError("sequence, positive charges and ppm > 0 are required")
+    return dict(
+        seq=seq, charges=charges, ppm=ppm, precursor_mz=precursor_mz,
+        overrides=overrides,
+        term_mod=req.get("term_mod") or "None",
+        rt_min=rt_min,
+        rt_max=rt_max,
+        top_n=top_n,
+        deisotope=_flag(req.get("deisotope", False)),
+        n_decoys=n_decoys,
+        open_search=_flag(req.get("open_search", False)),
+        averaging="grid" if req.get("averaging") == "grid" else "greedy",
+    )
+
+
+def write_result_out(out_path: Path, seq: str, charges, result: Dict, *, ppm: float,
+                     rt_min: float | None = None, rt_max: float | None = None,
+                     term_mod: str | None = None):
+    """write_legacy_out() for a result dict returned by analyze()."""
+    write_legacy_out(
+        out_path, seq, charges, result["rows"],
+        parent_mz=result["parent_mz"],
+        ppm_gate=ppm,
+        scans_count=result["scans_count"],
+        rt_min=rt_min, rt_max=rt_max,
+        bin_ppm=ppm,
+        parent_clusters=result["clusters"],
+        term_mod=term_mod,
+        deisotoped_max_z=result["deisotoped_max_z"],
+        decoy_stats=result["decoy_stats"],
+        calibration=result["calibration"],
+        replicate_runs=result.get("runs"),
+        replicate_stats=result.get("replicate_stats"),
+        mass_shift=result.get("mass_shift"),
+        averaging=result.get("averaging"),
+        peak_picking=result.get("peak_picking"),
+        selection=result.get("selection"),
+    )
@@ -0,0 +1,224 @@
+"""
+Local provenance store for RAW -> mzML conversion (SQLite).
+
+Remembers the validated msconvert executable (and its version) so discovery and the --help
+preflight run once per install, and records which RAW file (by content hash), msconvert
+version and options produced each mzML, so an unchanged RAW isn't converted twice.
+Default location: $PEPWIZ_PROVENANCE, else ~/.pepwiz/provenance.sqlite
+"""
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tools (
+    exe       TEXT PRIMARY KEY,
+    size      INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    version   TEXT,
+    validated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path     TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256   TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversions (
+    id             INTEGER PRIMARY KEY,
+    raw_path       TEXT NOT NULL,
+    raw_sha256     TEXT NOT NULL,
+    mzml_path      TEXT NOT NULL,
+    mzml_size      INTEGER NOT NULL,
+    mzml_mtime_ns  INTEGER NOT NULL,
+    options        TEXT NOT NULL,
+    exe            TEXT,
+    exe_version    TEXT,
+    created        REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversions_raw ON conversions (raw_sha256);
+"""
+
+
+def default_provenance_path() -> Path:
+    env = os.environ.get("PEPWIZ_PROVENANCE")
+    return Path(env).expanduser() if env else Path.home() / ".pepwiz" / "provenance.sqlite"
+
+
+def _stat_key(path: Path):
+    st = Path(path).stat()
+    return st.st_size, st.st_mtime_ns
+
+
+def content_hash(path: Path, chunk_size: int = 1 << 20) -> str:
+    """sha256 of a file, or of every file (relative name + bytes) under a directory (.d/.raw folders)."""
+    path = Path(path)
+    h = hashlib.sha256()
+    files = sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+    for f in files:
+        if path.is_dir():
+            h.update(str(f.relative_to(path)).encode("utf-8") + b"\0")
+        with open(f, "rb") as fh:
+            for block in iter(lambda: fh.read(chunk_size), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+class ProvenanceStore:
+    """Cached msconvert validation plus a RAW-hash -> mzML conversion log."""
+
+    def __init__(self, path: Path | None = None):
+        self.path = Path(path) if path is not None else default_provenance_path()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # several batch/convert processes may share the store: wait for a writer instead of failing
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30.0)
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ---- msconvert executable ----
+
+    def remember_msconvert(self, exe: str, version: str | None = None):
+        size, mtime = _stat_key(exe)
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO tools VALUES (?, ?, ?, ?, ?)",
+                             (str(exe), size, mtime, version, time.time()))
+
+    def msconvert_version(self, exe: str) -> str | None:
+        """Version recorded when exe passed preflight; None if unknown or the file has changed."""
+        tool = self._tool(exe)
+        return None if tool is None else (tool["version"] or "")
+
+    def cached_msconvert(self) -> str | None:
+        """Most recently validated executable that still exists unchanged, else None."""
+        with self._lock:
+            rows = self._db.execute("SELECT exe FROM tools ORDER BY validated DESC").fetchall()
+        for (exe,) in rows:
+            if self._tool(exe) is not None:
+                return exe
+        return None
+
+    def forget_msconvert(self, exe: str | None = None):
+        with self._lock, self._db:
+            if exe is None:
+                self._db.execute("DELETE FROM tools")
+            else:
+                self._db.execute("DELETE FROM tools WHERE exe = ?", (str(exe),))
+
+    def _tool(self, exe: str) -> Dict | None:
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime_ns, version FROM tools WHERE exe = ?",
+                                   (str(exe),)).fetchone()
+        if row is None:
+            return None
+        try:
+            if _stat_key(exe) != (row[0], row[1]):
+                return None
+        except OSError:
+            return None
+        return {"exe": exe, "version": row[2]}
+
+    # ---- conversions ----
+
+    def file_hash(self, path: Path) -> str:
+        """content_hash() memoized on (path, size, mtime), so unchanged RAW files are hashed once."""
+        path = Path(path).resolve()
+        size, mtime = _stat_key(path)
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime_ns, sha256 FROM file_hashes WHERE path = ?",
+                                   (str(path),)).fetchone()
+        if row is not None and (row[0], row[1]) == (size, mtime):
+            return row[2]
+        digest = content_hash(path)
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+                             (str(path), size, mtime, digest))
+        return digest
+
+    def record_conversion(self, raw_path: Path, mzml_path: Path, options, *,
+                          exe: str | None = None, exe_version: str | None = None) -> int:
+        mzml_path = Path(mzml_path).resolve()
+        size, mtime = _stat_key(mzml_path)
+        raw_hash = self.file_hash(raw_path)
+        with self._lock, self._db:
+            cur = self._db.execute(
+                "INSERT INTO conversions (raw_path, raw_sha256, mzml_path, mzml_size, mzml_mtime_ns,"
+                " options, exe, exe_version, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (str(Path(raw_path).resolve()), raw_hash, str(mzml_path), size, mtime,
+                 json.dumps(list(options)), exe, exe_version, time.time()),
+            )
+            return cur.lastrowid
+
+    def conversions(self, raw_path: Path) -> List[Dict]:
+        """Every recorded conversion of this RAW content (newest first), flagged valid if the mzML is unchanged."""
+        raw_hash = self.file_hash(raw_path)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, raw_path, mzml_path, mzml_size, mzml_mtime_ns, options, exe, exe_version, created"
+                " FROM conversions WHERE raw_sha256 = ? ORDER BY created DESC", (raw_hash,)).fetchall()
+        out = []
+        for r in rows:
+            try:
+                valid = _stat_key(r[2]) == (r[3], r[4])
+            except OSError:
+                valid = False
+            out.append({
+                "id": r[0], "raw_path": r[1], "raw_sha256": raw_hash, "mzml_path": Path(r[2]),
+                "options": json.loads(r[5]), "exe": r[6], "exe_version": r[7], "created": r[8],
+                "valid": valid,
+            })
+        return out
+
+    def lookup_conversion(self, raw_path: Path, options=None, out_dir: Path | None = None) -> Path | None:
+        """
+        Existing, unchanged mzML converted from this RAW content, else None.
+        options / out_dir, when given, must match what the conversion was run with.
+        """
+        want = None if options is None else list(options)
+        out_dir = None if out_dir is None else Path(out_dir).resolve()
+        for c in self.conversions(raw_path):
+            if not c["valid"]:
+                continue
+            if want is not None and c["options"] != want:
+                continue
+            if out_dir is not None and c["mzml_path"].parent != out_dir:
+                continue
+            return c["mzml_path"]
+        return None
+
+
+def open_store(path: Path | None = None, log_fn=None) -> ProvenanceStore | None:
+    """ProvenanceStore, or None (conversion still works) if the database can't be opened."""
+    try:
+        return ProvenanceStore(path)
+    except (OSError, sqlite3.Error) as e:
+        if log_fn:
+            log_fn(f"Provenance store unavailable ({e}); msconvert discovery won't be cached.")
+        return None
+
+
+def converted_mzml_for(raw_path: Path, options=None, store: ProvenanceStore | None = None) -> Path | None:
+    """Is this RAW already converted? Path of a valid recorded mzML, else None."""
+    own = store is None
+    store = store or open_store()
+    if store is None:
+        return None
+    try:
+        return store.lookup_conversion(raw_path, options)
+    finally:
+        if own:
+            store.close()
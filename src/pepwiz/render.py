@@ -0,0 +1,209 @@
+"""
+Batch figure export: a render queue that dedupes and renders in parallel.
+
+Jobs are keyed by a content hash of what actually ends up in the figure (fragment maps: sequence,
+matched cut set and style; spectra: averaged peaks, matched ions and label settings), so identical
+figures across files are rendered once and copied to every requested output. Figures render in a
+process pool whose workers import matplotlib (and warm mathtext) up front. Every output is written
+to a temp file next to the target and moved into place with os.replace, so readers never see a
+partial SVG/PNG.
+
+    q = RenderQueue(workers=4, budget_s=5.0)
+    q.add_fragments(seq, rows, "run1.fragments.svg")
+    q.add_spectrum(avg_spec, rows, "run1.spectrum.png")
+    report = q.run()
+"""
+from __future__ import annotations
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from . import events
+from .visualize import _figure_format
+
+
+def _fragment_payload(seq: str, rows) -> List[Dict]:
+    """Only what export_fragment_image draws: unique (itype, idx, z) cuts, in a canonical order."""
+    L = len(seq)
+    cuts = {(r.get("itype"), int(r["idx"]), r.get("z")) for r in rows or ()
+            if r.get("itype") in ("b", "y") and r.get("idx") and 1 <= int(r["idx"]) < L}
+    return [{"itype": it, "idx": idx, "z": z} for it, idx, z in sorted(cuts, key=lambda c: (c[0], c[1], c[2] or 0))]
+
+
+def _spectrum_payload(rows) -> List[Dict]:
+    keep = [{"obs": r["obs"], "itype": r["itype"], "idx": r["idx"], "z": r["z"], "inten": r.get("inten", 0.0)}
+            for r in rows or () if r.get("obs") is not None and r.get("itype") in ("b", "y")
+            and r.get("idx") and r.get("z")]
+    return sorted(keep, key=lambda r: (r["obs"], r["itype"], r["idx"], r["z"]))
+
+
+def render_key(kind: str, payload: Dict, avg_spec=None) -> str:
+    """sha256 of the figure content; equal keys render byte-identical figures."""
+    h = hashlib.sha256(kind.encode("utf-8") + b"\0")
+    h.update(json.dumps(payload, sort_keys=True, default=float).encode("utf-8"))
+    if avg_spec is not None:
+        h.update(np.ascontiguousarray(np.asarray(avg_spec, dtype=np.float64)).tobytes())
+    return h.hexdigest()
+
+
+def _temp_path(out: Path) -> Path:
+    return out.with_name(f".{out.name}.{os.getpid()}.{time.monotonic_ns()}.tmp")
+
+
+def _init_render_worker():
+    """Pay matplotlib's import, font cache and mathtext parser cost once per worker."""
+    from .visualize import _ensure_matplotlib
+    ok, plt = _ensure_matplotlib(lambda _msg: None)
+    if ok:
+        import io
+        fig, ax = plt.subplots(figsize=(1, 1))
+        ax.text(0, 0, "$b_{1}^{1+}$")
+        fig.savefig(io.BytesIO(), format="svg")
+        plt.close(fig)
+
+
+def _render(kind: str, args: Dict, out: str, fmt: str):
+    """Render one figure to out atomically. Returns (seconds, log lines); raises if nothing was written."""
+    from .visualize import export_fragment_image, export_annotated_spectrum
+    out = Path(out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = _temp_path(out)
+    notes = []
+    t0 = time.perf_counter()
+    try:
+        if kind == "fragments":
+            export_fragment_image(args["seq"], args["rows"], tmp, log_fn=notes.append, fmt=fmt)
+        else:
+            export_annotated_spectrum(args["avg_spec"], args["rows"], tmp, label_top_n=args["label_top_n"],
+                                      min_pct=args["min_pct"], log_fn=notes.append, fmt=fmt)
+        if not tmp.exists():
+            raise RuntimeError(notes[-1] if notes else f"{kind} figure was not written")
+        os.replace(tmp, out)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return time.perf_counter() - t0, notes
+
+
+def _copy_atomic(src: Path, out: Path):
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = _temp_path(out)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, out)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+class RenderQueue:
+    """
+    Collects fragment-map and spectrum exports, then renders each distinct figure once.
+    workers=0 renders in this process (no pool). budget_s flags figures that took longer.
+    """
+
+    def __init__(self, workers: int | None = None, budget_s: float | None = None, log_fn=print):
+        self.workers = (os.cpu_count() or 1) if workers is None else max(0, int(workers))
+        self.budget_s = budget_s
+        self.log_fn = log_fn
+        self._jobs: Dict[str, Dict] = {}   # key -> {kind, args, fmt, outs}
+
+    def __len__(self):
+        return sum(len(j["outs"]) for j in self._jobs.values())
+
+    def _add(self, kind: str, args: Dict, key_payload: Dict, out, avg_spec=None) -> str:
+        out = Path(out)
+        fmt = _figure_format(out)
+        key = render_key(kind, dict(key_payload, fmt=fmt), avg_spec)
+        job = self._jobs.setdefault(key, {"kind": kind, "args": args, "fmt": fmt, "outs": []})
+        if out not in job["outs"]:
+            job["outs"].append(out)
+        return key
+
+    def add_fragments(self, seq: str, rows, out) -> str:
+        """Queue export_fragment_image(seq, rows, out); returns the content key."""
+        cuts = _fragment_payload(seq, rows)
+        return self._add("fragments", {"seq": seq, "rows": cuts}, {"seq": seq, "cuts": cuts}, out)
+
+    def add_spectrum(self, avg_spec, rows, out, label_top_n: int = 9999, min_pct: float = 0.0) -> str:
+        """Queue export_annotated_spectrum(avg_spec, rows, out, ...); returns the content key."""
+        matched = _spectrum_payload(rows)
+        spec = [(float(m), float(i)) for m, i in avg_spec]
+        args = {"avg_spec": spec, "rows": matched, "label_top_n": label_top_n, "min_pct": min_pct}
+        return self._add("spectrum", args, {"rows": matched, "label_top_n": label_top_n, "min_pct": min_pct},
+                         out, spec)
+
+    def run(self) -> List[Dict]:
+        """
+        Render everything queued (the queue is emptied).
+        Returns one entry per output: {out, key, kind, status, seconds, over_budget, error}
+        with status "rendered", "copied" (duplicate of a rendered figure) or "failed".
+        """
+        jobs, self._jobs = self._jobs, {}
+        if not jobs:
+            return []
+        t0 = time.perf_counter()
+        outcomes = {}  # key -> (seconds, error)
+        if self.workers == 0 or len(jobs) == 1:
+            for key, job in jobs.items():
+                outcomes[key] = self._collect(lambda: _render(job["kind"], job["args"], str(job["outs"][0]), job["fmt"]))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs)),
+                                     initializer=_init_render_worker) as pool:
+                futures = {key: pool.submit(_render, job["kind"], job["args"], str(job["outs"][0]), job["fmt"])
+                           for key, job in jobs.items()}
+                for key, fut in futures.items():
+                    outcomes[key] = self._collect(fut.result)
+
+        report = []
+        for key, job in jobs.items():
+            seconds, error = outcomes[key]
+            over = self.budget_s is not None and seconds > self.budget_s
+            first, *dupes = job["outs"]
+            report.append({"out": first, "key": key, "kind": job["kind"], "status": "failed" if error else "rendered",
+                           "seconds": seconds, "over_budget": over, "error": error})
+            for out in dupes:
+                entry = {"out": out, "key": key, "kind": job["kind"], "status": "copied",
+                         "seconds": 0.0, "over_budget": False, "error": error}
+                if error is None:
+                    try:
+                        _copy_atomic(first, out)
+                    except OSError as e:
+                        entry.update(status="failed", error=f"{type(e).__name__}: {e}")
+                else:
+                    entry["status"] = "failed"
+                report.append(entry)
+        for r in report:
+            if r["status"] != "failed":
+                events.output(r["out"], r["kind"])
+        self._summarize(report, time.perf_counter() - t0)
+        return report
+
+    def _collect(self, call):
+        try:
+            seconds, _notes = call()
+            return seconds, None
+        except Exception as e:
+            return 0.0, f"{type(e).__name__}: {e}"
+
+    def _summarize(self, report, wall):
+        rendered = [r for r in report if r["status"] == "rendered"]
+        copied = sum(r["status"] == "copied" for r in report)
+        self.log_fn(f"Rendered {len(rendered)} figure(s) for {len(report)} output(s) "
+                    f"({copied} deduplicated) in {wall:.2f} s.")
+        for r in report:
+            if r["status"] == "failed":
+                self.log_fn(f"  failed: {r['out']}: {r['error']}")
+        if self.budget_s is not None:
+            slow = [r for r in rendered if r["over_budget"]]
+            if slow:
+                self.log_fn(f"  {len(slow)} figure(s) over the {self.budget_s:g} s budget:")
+                for r in sorted(slow, key=lambda r: -r["seconds"]):
+                    self.log_fn(f"    {r['seconds']:.2f} s  {r['out']}")
@@ -0,0 +1,288 @@
+"""
+Scan selections as bitsets over a file's MS2 scans, for gates that one precursor ± ppm and one
+RT window can't express (co-eluting species, isotopes, exclusions, charge filters).
+
+A ScanIndex is the header table of a file's MS2 scans (RT, precursor m/z/charge/intensity and
+spectrum id), read in one pass without decoding peaks. Its query methods return ScanSelections,
+bit-packed (np.packbits, 1 bit per scan), which compose with | & - ^ ~ without touching the file:
+
+    idx = ScanIndex.from_file("run.mzML")
+    sel = (idx.isotopes(721.876, z=2, n=2, ppm=10) | idx.precursor(733.31, 10)) & idx.rt(8, 14)
+    sel = sel - idx.rt(10.2, 10.4) - idx.charge(1)
+    for peaks in idx.peaks(sel):     # only the selected scans are decoded, once
+        ...
+
+Python binds - before &; use parentheses when mixing them. The RT and precursor tests match
+passes_ms2_gate(): scans without an RT pass RT windows, scans without a precursor m/z never
+pass a precursor test.
+"""
+from __future__ import annotations
+import hashlib
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+from . import events
+from .mzml_utils import (
+    ISOTOPE_SPACING, _ms2_record, open_reader, precursor_info_from_spec, spectrum_rt, tracked,
+)
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class ScanSelection:
+    """A set of MS2 scan ordinals (0..n-1) stored as a packed bitset."""
+
+    __slots__ = ("bits", "n")
+
+    def __init__(self, bits: np.ndarray, n: int):
+        self.bits = bits
+        self.n = int(n)
+
+    @classmethod
+    def from_mask(cls, mask) -> "ScanSelection":
+        mask = np.asarray(mask, dtype=bool)
+        return cls(np.packbits(mask), mask.size)
+
+    @classmethod
+    def from_indices(cls, indices, n: int) -> "ScanSelection":
+        mask = np.zeros(n, dtype=bool)
+        mask[np.asarray(indices, dtype=np.int64)] = True
+        return cls.from_mask(mask)
+
+    def mask(self) -> np.ndarray:
+        return np.unpackbits(self.bits, count=self.n).astype(bool)
+
+    def indices(self) -> np.ndarray:
+        """Selected scan ordinals, ascending (file order)."""
+        return np.flatnonzero(np.unpackbits(self.bits, count=self.n))
+
+    def key(self) -> str:
+        """Content hash, for caching results computed from a selection."""
+        return hashlib.sha1(self.bits.tobytes() + self.n.to_bytes(8, "little")).hexdigest()
+
+    def _check(self, other: "ScanSelection"):
+        if not isinstance(other, ScanSelection):
+            return NotImplemented
+        if other.n != self.n:
+            raise ValueError(f"selections over different scan tables ({self.n} vs {other.n} scans)")
+        return other
+
+    def __or__(self, other):
+        return ScanSelection(self.bits | self._check(other).bits, self.n)
+
+    def __and__(self, other):
+        return ScanSelection(self.bits & self._check(other).bits, self.n)
+
+    def __sub__(self, other):
+        return ScanSelection(self.bits & ~self._check(other).bits, self.n)
+
+    def __xor__(self, other):
+        return ScanSelection(self.bits ^ self._check(other).bits, self.n)
+
+    def __invert__(self):
+        # clear the pad bits of the last byte so counts stay exact
+        return ScanSelection(~self.bits & np.packbits(np.ones(self.n, dtype=bool)), self.n)
+
+    def __len__(self):
+        return int(_POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def __bool__(self):
+        return bool(self.bits.any())
+
+    def __eq__(self, other):
+        return isinstance(other, ScanSelection) and other.n == self.n and np.array_equal(other.bits, self.bits)
+
+    def __hash__(self):
+        return hash((self.n, self.bits.tobytes()))
+
+    def __repr__(self):
+        return f"ScanSelection({len(self)}/{self.n} scans)"
+
+
+class ScanIndex:
+    """
+    Header table of the MS2 scans of one file (file order). Arrays: rts, precursor_mzs
+    (NaN = none), charges (0 = unknown), intensities (NaN = unknown); ids are spectrum ids
+    for random access (None when the table was built from already-decoded scans, which
+    are then kept in .scans).
+    """
+
+    def __init__(self, ms_path: Path, rt, precursor_mz, charge, intensity, ids=None, scans=None):
+        self.ms_path = Path(ms_path)
+        self.rts = np.asarray(rt, dtype=float)
+        self.precursor_mzs = np.asarray(precursor_mz, dtype=float)
+        self.charges = np.asarray(charge, dtype=np.int64)
+        self.intensities = np.asarray(intensity, dtype=float)
+        self.ids = ids
+        self.scans = scans
+
+    def __len__(self):
+        return self.rts.size
+
+    @classmethod
+    def from_file(cls, ms_path: Path) -> "ScanIndex":
+        """One header pass (no peak arrays decoded)."""
+        ids, rts, pmzs, zs, intens = [], [], [], [], []
+        try:
+            reader = open_reader(ms_path, decode_binary=False)
+        except ImportError as e:
+            raise RuntimeError("pyteomics (and lxml) are required. Run:\n  py -m pip install pyteomics lxml") from e
+        with reader:
+            for spec in tracked(reader, "index", ms_path):
+                ms_level = spec.get('ms level') or spec.get('msLevel')
+                try:
+                    if int(ms_level) != 2:
+                        continue
+                except Exception:
+                    continue
+                pmz, z, inten = precursor_info_from_spec(spec)
+                ids.append(spec.get("id") or spec.get("num"))
+                rts.append(spectrum_rt(spec))
+                pmzs.append(pmz)
+                zs.append(z)
+                intens.append(inten)
+        nan = lambda vals: [np.nan if v is None else v for v in vals]
+        return cls(ms_path, nan(rts), nan(pmzs), [z or 0 for z in zs], nan(intens), ids=ids)
+
+    @classmethod
+    def from_scans(cls, ms_path: Path, scans: List[Dict]) -> "ScanIndex":
+        """From iter_ms2_scans() records already in memory (e.g. AnalysisCache.scans)."""
+        get = lambda k, fill: [fill if s.get(k) is None else s[k] for s in scans]
+        return cls(ms_path, get("rt", np.nan), get("precursor_mz", np.nan), get("precursor_charge", 0),
+                   get("precursor_intensity", np.nan), scans=scans)
+
+    # ---- primitives ----
+
+    def all(self) -> ScanSelection:
+        return ScanSelection.from_mask(np.ones(len(self), dtype=bool))
+
+    def none(self) -> ScanSelection:
+        return ScanSelection.from_mask(np.zeros(len(self), dtype=bool))
+
+    def where(self, mask) -> ScanSelection:
+        """Selection from a boolean mask over the scans (e.g. built from the index arrays)."""
+        mask = np.asarray(mask, dtype=bool)
+        if mask.size != len(self):
+            raise ValueError(f"mask has {mask.size} entries for {len(self)} scans")
+        return ScanSelection.from_mask(mask)
+
+    def precursors(self, mzs, ppm: float) -> ScanSelection:
+        """Scans whose precursor m/z is within ±ppm of any of mzs."""
+        mask = np.zeros(len(self), dtype=bool)
+        pmz = self.precursor_mzs
+        with np.errstate(invalid="ignore"):
+            for target in np.atleast_1d(np.asarray(mzs, dtype=float)):
+                mask |= np.abs(pmz - target) / target * 1e6 <= ppm
+        return ScanSelection.from_mask(mask)
+
+    def precursor(self, mz: float, ppm: float) -> ScanSelection:
+        return self.precursors([mz], ppm)
+
+    def isotopes(self, mz: float, z: int, n: int = 2, ppm: float = 10.0) -> ScanSelection:
+        """Scans isolating the monoisotopic precursor or one of its next n isotope peaks at charge z."""
+        return self.precursors(mz + np.arange(n + 1) * ISOTOPE_SPACING / int(z), ppm)
+
+    def rt(self, rt_min: float | None = None, rt_max: float | None = None) -> ScanSelection:
+        """Scans in [rt_min, rt_max] (either bound optional); scans without an RT are kept."""
+        rt = self.rts
+        mask = np.ones(len(self), dtype=bool)
+        with np.errstate(invalid="ignore"):
+            if rt_min is not None:
+                mask &= ~(rt < rt_min)
+            if rt_max is not None:
+                mask &= ~(rt > rt_max)
+        return ScanSelection.from_mask(mask)
+
+    def charge(self, *charges: int) -> ScanSelection:
+        """Scans whose precursor charge is one of charges (0 matches an unknown charge)."""
+        return ScanSelection.from_mask(np.isin(self.charges, [int(z) for z in charges]))
+
+    def min_intensity(self, value: float) -> ScanSelection:
+        with np.errstate(invalid="ignore"):
+            return ScanSelection.from_mask(self.intensities >= value)
+
+    def gate(self, precursor_mz: float | None, ppm_tol: float,
+             rt_min: float | None = None, rt_max: float | None = None) -> ScanSelection:
+        """The legacy single precursor/RT gate (same scans as passes_ms2_gate)."""
+        sel = self.rt(rt_min, rt_max)
+        return sel if precursor_mz is None else sel & self.precursor(precursor_mz, ppm_tol)
+
+    # ---- decoding ----
+
+    def _check(self, selection: ScanSelection):
+        if selection.n != len(self):
+            raise ValueError(f"selection over {selection.n} scans used with an index of {len(self)}")
+
+    def records(self, selection: ScanSelection, workers: int = 1, chunk_size: int = 256) -> Iterator[Dict]:
+        """
+        iter_ms2_scans() records of the selected scans, in file order; each decoded once.
+        Sparse selections jump to the spectra by id; dense ones (or files without usable ids)
+        are read sequentially, decoding only the selected peak arrays.
+        workers > 1 decodes chunks of selected ids in a process pool.
+        """
+        self._check(selection)
+        picked = selection.indices()
+        if self.scans is not None:
+            for i in picked.tolist():
+                yield self.scans[i]
+            return
+        progress = events.ticker("decode", len(picked), "scans", path=str(self.ms_path))
+        try:
+            if self.ids is not None and len(picked) and (workers > 1 or len(picked) < 0.25 * len(self)):
+                yield from self._records_by_id([self.ids[i] for i in picked.tolist()], workers, chunk_size,
+                                               progress)
+            elif len(picked):
+                yield from self._records_sequential(selection.mask(), progress)
+        finally:
+            progress.close()
+
+    def _records_by_id(self, ids, workers: int, chunk_size: int, progress):
+        if workers > 1 and len(ids) >= 4 * chunk_size:
+            import pickle
+            from collections import deque
+            from concurrent.futures import ProcessPoolExecutor
+            from .mzml_utils import _decode_chunk, _init_decode_worker
+            chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+            with open_reader(self.ms_path, decode_binary=False) as reader, \
+                    ProcessPoolExecutor(max_workers=workers, initializer=_init_decode_worker,
+                                        initargs=(pickle.dumps(reader),)) as pool:
+                pending, nxt = deque(), 0
+                while pending or nxt < len(chunks):
+                    while nxt < len(chunks) and len(pending) < 2 * workers:
+                        pending.append((len(chunks[nxt]), pool.submit(_decode_chunk, chunks[nxt], None)))
+                        nxt += 1
+                    n, fut = pending.popleft()
+                    records = fut.result()
+                    progress.tick(n)
+                    yield from records
+            return
+        with open_reader(self.ms_path, decode_binary=False) as reader:
+            for sid in ids:
+                rec = _ms2_record(reader.get_by_id(sid))
+                progress.tick()
+                if rec is not None:
+                    yield rec
+
+    def _records_sequential(self, mask: np.ndarray, progress):
+        i = 0
+        with open_reader(self.ms_path, decode_binary=False) as reader:
+            for spec in reader:
+                ms_level = spec.get('ms level') or spec.get('msLevel')
+                try:
+                    if int(ms_level) != 2:
+                        continue
+                except Exception:
+                    continue
+                if i >= mask.size:
+                    break
+                if mask[i]:
+                    progress.tick()
+                    yield _ms2_record(spec)
+                i += 1
+
+    def peaks(self, selection: ScanSelection, workers: int = 1) -> Iterator[List]:
+        """[(mz, inten)] per selected scan (the iter_filtered_ms2_peaks() format)."""
+        for rec in self.records(selection, workers=workers):
+            yield list(zip(rec["mz"].tolist(), rec["intensity"].tolist()))
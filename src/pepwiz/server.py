@@ -0,0 +1,209 @@
+"""
+Local PepWiz analysis service (HTTP/JSON on localhost).
+
+Keeps parsed scan tables, averaged spectra and fragment tables for recently used files in
+memory so repeated requests skip the file parse. Endpoints (POST a JSON body, or GET with
+query parameters):
+
+  GET  /health
+  POST /precursors  {"path", "dedup_ppm"?}                       -> {"clusters": [...]}
+  POST /match       {"path", "sequence", "charges", "ppm", "precursor_mz", ...}
+                                                                 -> {"rows": [...], ...}
+  POST /render      same as /match plus {"kind": "fragments"|"spectrum", "out"?}
+                                                                 -> SVG body, or {"written": out}
+
+/match rows are exactly what legacy_summary_from_spectrum() returns for the GUI settings.
+
+Run:  python -m pepwiz.server --port 8765 --workers 4
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qsl
+
+from .pipeline import AnalysisCache, analyze, analysis_kwargs
+
+MAX_BODY = 1 << 20
+_RENDER_LOCK = threading.Lock()  # pyplot state is process-global
+
+
+class RequestError(Exception):
+    """Bad request: reported to the client as HTTP 400."""
+
+
+def _path_arg(req: dict) -> Path:
+    p = req.get("path")
+    if not p:
+        raise RequestError("'path' is required")
+    p = Path(p).expanduser()
+    if not p.exists():
+        raise RequestError(f"file not found: {p}")
+    if p.suffix.lower() not in (".mzml", ".mzxml"):
+        raise RequestError("only .mzML/.mzXML files can be analyzed (convert RAW first)")
+    return p
+
+class AnalysisServer:
+    """asyncio HTTP front end; analyses run concurrently on a thread pool sharing one AnalysisCache."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765, workers: int = 4,
+                 cache_files: int = 4, decode_workers: int = 1, log_fn=print):
+        self.host, self.port = host, port
+        self.cache = AnalysisCache(max_files=cache_files, workers=decode_workers)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="pepwiz")
+        self.log_fn = log_fn
+        self._server = None
+
+    # ---- handlers (run on the worker pool) ----
+
+    def precursors(self, req: dict):
+        path = _path_arg(req)
+        clusters = self.cache.clusters(path, dedup_ppm=float(req.get("dedup_ppm", 10.0)))
+        return {"path": str(path), "clusters": clusters}
+
+    def _analyze(self, req: dict):
+        path = _path_arg(req)
+        kw = analysis_kwargs(req)
+        notes = []
+        result = analyze(path, kw.pop("seq"), kw.pop("charges"), kw.pop("ppm"), kw.pop("precursor_mz"),
+                         cache=self.cache, log_fn=notes.append, **kw)
+        return path, result, notes
+
+    def match(self, req: dict):
+        path, result, notes = self._analyze(req)
+        return {
+            "path": str(path),
+            "parent_mz": result["parent_mz"],
+            "snap_delta_ppm": result["snap_delta_ppm"],
+            "scans_count": result["scans_count"],
+            "rows": result["rows"],
+            "decoy_stats": result["decoy_stats"],
+            "deisotoped_max_z": result["deisotoped_max_z"],
+            "mass_shift": result["mass_shift"],
+            "log": notes,
+        }
+
+    def render(self, req: dict):
+        from .visualize import export_fragment_image, export_annotated_spectrum
+        kind = req.get("kind", "spectrum")
+        if kind not in ("fragments", "spectrum"):
+            raise RequestError("kind must be 'fragments' or 'spectrum'")
+        _path, result, notes = self._analyze(req)
+        if not result["rows"]:
+            raise RequestError("no matched fragments to render")
+        out = req.get("out")
+        target = Path(out) if out else io.BytesIO()
+        with _RENDER_LOCK:
+            if kind == "fragments":
+                export_fragment_image(req["sequence"].strip().upper(), result["rows"], target, log_fn=notes.append)
+            else:
+                export_annotated_spectrum(result["avg_spec"], result["rows"], target, log_fn=notes.append)
+        if out:
+            return {"written": str(target), "log": notes}
+        return target.getvalue()
+
+    # ---- HTTP plumbing ----
+
+    ROUTES = {"/precursors": "precursors", "/match": "match", "/render": "render"}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        status, ctype, body = 500, "application/json", b""
+        respond = True
+        try:
+            request_line = (await reader.readline()).decode("latin-1").strip()
+            if not request_line:
+                respond = False
+                return
+            method, target, _ = request_line.split(" ", 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1")
+                if line in ("\r\n", "\n", ""):
+                    break
+                k, _, v = line.partition(":")
+                headers[k.strip().lower()] = v.strip()
+            length = int(headers.get("content-length", "0") or 0)
+            if length > MAX_BODY:
+                raise RequestError("request body too large")
+            raw = await reader.readexactly(length) if length else b""
+
+            url = urlsplit(target)
+            req = dict(parse_qsl(url.query))
+            if raw:
+                body_req = json.loads(raw.decode("utf-8"))
+                if not isinstance(body_req, dict):
+                    raise RequestError("request body must be a JSON object")
+                req.update(body_req)
+
+            if url.path == "/health":
+                status, payload = 200, {"status": "ok", "cached_files": len(self.cache)}
+            elif url.path in self.ROUTES and method in ("GET", "POST"):
+                handler = getattr(self, self.ROUTES[url.path])
+                loop = asyncio.get_running_loop()
+                payload = await loop.run_in_executor(self.pool, handler, req)
+                status = 200
+            else:
+                status, payload = 404, {"error": f"no route for {method} {url.path}"}
+
+            if isinstance(payload, bytes):
+                ctype, body = "image/svg+xml", payload
+            else:
+                body = json.dumps(payload).encode("utf-8")
+        except (RequestError, ValueError) as e:
+            status, body = 400, json.dumps({"error": str(e)}).encode("utf-8")
+        except Exception as e:
+            status, body = 500, json.dumps({"error": f"{type(e).__name__}: {e}"}).encode("utf-8")
+        finally:
+            if respond:
+                reason = {200: "OK", 400: "Bad Request", 404: "Not Found"}.get(status, "Internal Server Error")
+                writer.write(
+                    f"HTTP/1.1 {status} {reason}\r\nContent-Type: {ctype}\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+                )
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.log_fn(f"PepWiz server listening on http://{self.host}:{self.port}")
+        return self._server
+
+    async def serve_forever(self):
+        server = self._server or await self.start()
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        self.pool.shutdown(wait=False)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="PepWiz local analysis server (HTTP/JSON, localhost).")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--workers", type=int, default=4, help="concurrent analyses")
+    ap.add_argument("--cache-files", type=int, default=4, help="files kept parsed in memory")
+    ap.add_argument("--decode-workers", type=int, default=1,
+                    help="processes used to decode one large file on first load")
+    args = ap.parse_args(argv)
+    srv = AnalysisServer(args.host, args.port, args.workers, args.cache_files, args.decode_workers)
+    try:
+        asyncio.run(srv.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Synthetic LC-MS/MS runs and a minimal mzML writer, for benchmarks and the stand-in converter.
+
+A synthetic "RAW" is a small JSON description (see write_raw_description) that
+fakeconvert turns into mzML the way msconvert turns a vendor file into mzML:
+
+    {"format": "pepwiz-synthetic", "cycles": 400, "ms2_per_cycle": 8, "seed": 1,
+     "peptides": [{"sequence": "PEPTIDEKLMNR", "charge": 2, "rt": [3.0, 5.0]}]}
+
+Peptides get MS2 scans of their b/y ions (plus noise) at their precursor m/z inside their RT
+window, so analyze() finds real matches in the converted file.
+"""
+from __future__ import annotations
+import base64
+import json
+import zlib
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+RAW_FORMAT = "pepwiz-synthetic"
+
+_CV = {
+    "zlib": ("MS:1000574", "zlib compression"),
+    "none": ("MS:1000576", "no compression"),
+    "linear": ("MS:1002312", "MS-Numpress linear prediction compression"),
+    "slof": ("MS:1002314", "MS-Numpress short logged float compression"),
+    "linear+zlib": ("MS:1002746", "MS-Numpress linear prediction compression followed by zlib compression"),
+    "slof+zlib": ("MS:1002748", "MS-Numpress short logged float compression followed by zlib compression"),
+}
+# msconvert profile -> ((m/z dtype, codec), (intensity dtype, codec))
+ENCODINGS = {
+    "default": (("f8", "zlib"), ("f8", "zlib")),
+    "compact": (("f8", "zlib"), ("f4", "zlib")),
+    "numpress": (("f8", "linear"), ("f8", "slof")),
+    "numpress-zlib": (("f8", "linear+zlib"), ("f8", "slof+zlib")),
+}
+
+
+def _peptide_spectrum(rng, seq: str, n_noise: int = 150):
+    from .composition import ion_table
+    frag = ion_table(seq, [1])["mz"]
+    mz = np.concatenate([frag, rng.uniform(100, 1800, n_noise)])
+    inten = np.concatenate([rng.lognormal(9, 0.5, frag.size), rng.lognormal(6, 1.5, n_noise)])
+    order = np.argsort(mz)
+    return mz[order], inten[order]
+
+
+def synthetic_run(n_cycles: int = 400, ms2_per_cycle: int = 8, seed: int = 1, peptides=None) -> List[Dict]:
+    """
+    [{level, rt, mz, intensity, precursor_mz, precursor_charge}] resembling a centroided DDA run.
+    peptides: [{"sequence", "charge", "rt": [lo, hi]}]; while a peptide elutes, one MS2 slot per
+    cycle fragments it.
+    """
+    from .composition import PROTON, peptide_mass
+    rng = np.random.default_rng(seed)
+    precursors = rng.uniform(400, 1200, 40)
+    peptides = [dict(p, precursor_mz=(peptide_mass(p["sequence"]) + int(p.get("charge", 2)) * PROTON)
+                     / int(p.get("charge", 2))) for p in peptides or []]
+    out = []
+    for c in range(n_cycles):
+        rt = 1 + c * 0.02
+        mz = np.sort(rng.uniform(300, 1600, 1500))
+        out.append({"level": 1, "rt": rt, "mz": mz, "intensity": rng.lognormal(8, 1.5, mz.size),
+                    "precursor_mz": None, "precursor_charge": None})
+        eluting = [p for p in peptides if p.get("rt") is None or p["rt"][0] <= rt <= p["rt"][1]]
+        for k in range(ms2_per_cycle):
+            if k < len(eluting):
+                p = eluting[k]
+                mz, inten = _peptide_spectrum(rng, p["sequence"])
+                pmz, pz = p["precursor_mz"], int(p.get("charge", 2))
+            else:
+                mz = np.sort(rng.uniform(100, 1800, 300))
+                inten = rng.lognormal(6, 1.5, mz.size)
+                pmz, pz = float(precursors[(c + k) % precursors.size]), None
+            out.append({"level": 2, "rt": rt + (k + 1) * 0.002, "mz": mz, "intensity": inten,
+                        "precursor_mz": pmz, "precursor_charge": pz})
+    return out
+
+
+def write_raw_description(path: Path, cycles: int = 400, ms2_per_cycle: int = 8, seed: int = 1,
+                          peptides=None) -> Path:
+    """Write a synthetic "RAW" (JSON description of a run) for fakeconvert."""
+    desc = {"format": RAW_FORMAT, "cycles": int(cycles), "ms2_per_cycle": int(ms2_per_cycle),
+            "seed": int(seed), "peptides": list(peptides or [])}
+    Path(path).write_text(json.dumps(desc, indent=1), encoding="utf-8")
+    return Path(path)
+
+
+def read_raw_description(path: Path) -> Dict:
+    try:
+        desc = json.loads(Path(path).read_text(encoding="utf-8"))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise RuntimeError(f"{Path(path).name} is not a synthetic RAW description ({e}).") from e
+    if not isinstance(desc, dict) or desc.get("format") != RAW_FORMAT:
+        raise RuntimeError(f"{Path(path).name} is not a synthetic RAW description (format != {RAW_FORMAT!r}).")
+    return desc
+
+
+def run_from_description(desc: Dict) -> List[Dict]:
+    return synthetic_run(desc.get("cycles", 400), desc.get("ms2_per_cycle", 8), desc.get("seed", 1),
+                         desc.get("peptides"))
+
+
+def _encode(values: np.ndarray, dtype: str, codec: str):
+    if codec.startswith(("linear", "slof")):
+        import pynumpress
+        v = np.ascontiguousarray(values, dtype=np.float64)
+        if codec.startswith("linear"):
+            raw = bytes(pynumpress.encode_linear(v, pynumpress.optimal_linear_fixed_point(v)))
+        else:
+            raw = bytes(pynumpress.encode_slof(v, pynumpress.optimal_slof_fixed_point(v)))
+        if codec.endswith("zlib"):
+            raw = zlib.compress(raw)
+    else:
+        raw = np.asarray(values, dtype="<" + dtype).tobytes()
+        if codec == "zlib":
+            raw = zlib.compress(raw)
+    return base64.b64encode(raw).decode("ascii")
+
+
+def write_mzml(spectra, path: Path, profile: str = "default", ms2_only: bool = False, encoding=None):
+    """Minimal mzML with the binary encoding of the given profile (or an explicit ENCODINGS-style tuple)."""
+    (mz_dt, mz_codec), (it_dt, it_codec) = encoding or ENCODINGS[profile]
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0"><run id="bench"><spectrumList count="0">']
+    i = 0
+    for s in spectra:
+        if ms2_only and s["level"] != 2:
+            continue
+        lines += [f'<spectrum index="{i}" id="scan={i + 1}" defaultArrayLength="{len(s["mz"])}">',
+                  f'<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{s["level"]}"/>',
+                  '<cvParam cvRef="MS" accession="MS:1000127" name="centroid spectrum" value=""/>',
+                  '<scanList count="1"><scan><cvParam cvRef="MS" accession="MS:1000016" name="scan start time"'
+                  f' value="{s["rt"]:.5f}" unitCvRef="UO" unitAccession="UO:0000031" unitName="minute"/></scan></scanList>']
+        if s["level"] == 2:
+            lines += ['<precursorList count="1"><precursor><selectedIonList count="1"><selectedIon>',
+                      f'<cvParam cvRef="MS" accession="MS:1000744" name="selected ion m/z" value="{s["precursor_mz"]:.6f}"/>']
+            if s.get("precursor_charge"):
+                lines.append(f'<cvParam cvRef="MS" accession="MS:1000041" name="charge state" value="{s["precursor_charge"]}"/>')
+            lines.append('</selectedIon></selectedIonList></precursor></precursorList>')
+        lines.append('<binaryDataArrayList count="2">')
+        for values, dtype, codec, acc, name in ((s["mz"], mz_dt, mz_codec, "MS:1000514", "m/z array"),
+                                                (s["intensity"], it_dt, it_codec, "MS:1000515", "intensity array")):
+            enc = _encode(values, dtype, codec)
+            bits = ("MS:1000523", "64-bit float") if dtype == "f8" else ("MS:1000521", "32-bit float")
+            lines += [f'<binaryDataArray encodedLength="{len(enc)}">',
+                      f'<cvParam cvRef="MS" accession="{bits[0]}" name="{bits[1]}" value=""/>',
+                      f'<cvParam cvRef="MS" accession="{_CV[codec][0]}" name="{_CV[codec][1]}" value=""/>',
+                      f'<cvParam cvRef="MS" accession="{acc}" name="{name}" value=""/>',
+                      f'<binary>{enc}</binary></binaryDataArray>']
+        lines.append('</binaryDataArrayList></spectrum>')
+        i += 1
+    lines.append('</spectrumList></run></mzML>')
+    Path(path).write_text("\n".join(lines), encoding="utf-8")
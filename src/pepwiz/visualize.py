@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from . import events
+
 def _ensure_matplotlib(log_fn=print):
  
     try:
@@ -25,9 +27,19 @@ def _ensure_matplotlib(log_fn=print):
         tb = traceback.format_exc(limit=3)
         log_fn(f"matplotlib import failed: {type(e).__name__}: {e}\n{tb}\nexe={sys.executable}")
         return False, None
+
+
+def _figure_format(target, fmt=None):
+    """Explicit fmt, else the output suffix (.svg/.png/.pdf); file objects default to SVG."""
+    if fmt:
+        return fmt
+    suffix = getattr(target, "suffix", None)
+    if suffix is None and isinstance(target, str):
+        suffix = target[target.rfind("."):] if "." in target else ""
+    return (suffix or ".svg").lstrip(".").lower() or "svg"
      
         
-def export_fragment_image(seq, matched_rows, out_svg, log_fn=print):
+def export_fragment_image(seq, matched_rows, out_svg, log_fn=print, fmt=None):
   
     ok, plt = _ensure_matplotlib(log_fn)
     if not ok:
@@ -104,8 +116,10 @@ def export_fragment_image(seq, matched_rows, out_svg, log_fn=print):
 
     fig.tight_layout()
     try:
-        fig.savefig(out_svg, format="svg", bbox_inches="tight", transparent=True)
-        log_fn(f"Saved fragment image SVG (editable): {out_svg}")
+        fmt = _figure_format(out_svg, fmt)
+        fig.savefig(out_svg, format=fmt, bbox_inches="tight", transparent=True)
+        events.output(out_svg, "fragments")
+        log_fn(f"Saved fragment image {fmt.upper()}{' (editable)' if fmt == 'svg' else ''}: {out_svg}")
     except Exception as e:
         log_fn(f"Failed to save fragment SVG: {e}")
     finally:
@@ -118,7 +132,8 @@ def export_annotated_spectrum(
     out_svg,
     label_top_n=9999,   # kept for signature compat
     min_pct=0.0,        # unused for matched; compat
-    log_fn=print
+    log_fn=print,
+    fmt=None,           # "svg"/"png"/...; default from the out_svg suffix
 ):
     ok, plt = _ensure_matplotlib(log_fn)
     if not ok:
@@ -131,22 +146,23 @@ def export_annotated_spectrum(
 
         from matplotlib.ticker import MultipleLocator
 
-        # --- data prep ---
-        mzs  = [p[0] for p in avg_spec]
-        ints = [p[1] for p in avg_spec]
-        base = max(ints) if ints else 1.0
-        norm = [i / base * 100.0 for i in ints]
+        import numpy as np
 
-        def ppm(a, b):  # a=obs, b=ref
-            return abs(a - b) / b * 1e6
+        # --- data prep ---
+        arr  = np.asarray([p[:2] for p in avg_spec], dtype=float)
+        arr  = arr[np.argsort(arr[:, 0], kind="stable")]
+        mzs  = arr[:, 0]
+        base = float(arr[:, 1].max()) or 1.0
+        norm = arr[:, 1] / base * 100.0
 
         tol_ppm = 10.0  # for matching observed m/z to a bar in the averaged spectrum
 
-        # Fast lookup for heights near an observed m/z
+        # Height of the lowest-m/z bar within tol_ppm of an observed m/z (binary search)
         def height_at(obs_mz, fallback_inten):
-            for x, y in zip(mzs, norm):
-                if ppm(x, obs_mz) <= tol_ppm:
-                    return y
+            d = obs_mz * tol_ppm * 1e-6
+            i = int(np.searchsorted(mzs, obs_mz - d, side="left"))
+            if i < len(mzs) and mzs[i] <= obs_mz + d:
+                return float(norm[i])
             return (fallback_inten / base * 100.0)
 
         # Collect matched ion m/z and per-ion color
@@ -163,13 +179,12 @@ def export_annotated_spectrum(
             matched_mzs.append(obs)
 
         # --- figure size ---
-        span = (max(mzs) - min(mzs)) if mzs else 0.0
+        span = float(mzs[-1] - mzs[0])
         width = max(8.0, min(16.0, span / 150.0 + 8.0))
         fig, ax = plt.subplots(figsize=(width, 4.2), dpi=150)
 
-        # 1) draw ALL bars as neutral gray first
-        for x, y in zip(mzs, norm):
-            ax.vlines(x, 0.0, y, color="#A0A0A0", linewidth=0.9)
+        # 1) draw ALL bars as neutral gray first (one collection)
+        ax.vlines(mzs, 0.0, norm, color="#A0A0A0", linewidth=0.9)
 
         # 2) overlay matched peaks with ion-specific colors
         #    (choose the bar height from the averaged spectrum)
@@ -210,16 +225,11 @@ def export_annotated_spectrum(
         if matched_mzs:
             lo, hi = min(matched_mzs), max(matched_mzs)
             x_min, x_max = lo - 50.0, hi + 100.0
-            if mzs:
-                x_min = max(min(mzs), x_min)
-                x_max = min(max(mzs), x_max)
+            x_min = max(float(mzs[0]), x_min)
+            x_max = min(float(mzs[-1]), x_max)
         else:
             # fallback: show whole spectrum ±50/100 if we somehow have no matches
-            if mzs:
-                lo, hi = min(mzs), max(mzs)
-                x_min, x_max = lo - 50.0, hi + 100.0
-            else:
-                x_min, x_max = 0.0, 1000.0
+            x_min, x_max = float(mzs[0]) - 50.0, float(mzs[-1]) + 100.0
 
         # Ensure non-zero width
         if x_max - x_min < 50:
@@ -239,12 +249,286 @@ def export_annotated_spectrum(
         ax.spines["right"].set_visible(False)
 
         fig.tight_layout()
-        fig.savefig(out_svg, format="svg", bbox_inches="tight", transparent=True)
-        log_fn(f"Saved annotated spectrum SVG (editable): {out_svg}")
+        fmt = _figure_format(out_svg, fmt)
+        fig.savefig(out_svg, format=fmt, bbox_inches="tight", transparent=True)
+        events.output(out_svg, "spectrum")
+        log_fn(f"Saved annotated spectrum {fmt.upper()}{' (editable)' if fmt == 'svg' else ''}: {out_svg}")
     except Exception as e:
         log_fn(f"Spectrum export failed: {type(e).__name__}: {e}")
     finally:
         try:
             plt.close(fig)
         except Exception:
-            pass
\ No newline at end of file
+            pass
+
+def export_xic(rt, traces, labels, out_svg, window=None, log_fn=print):
+    """
+    Plot one or more extracted-ion chromatograms (traces: n_traces x n_scans).
+    window: optional {"apex_rt", "rt_min", "rt_max"} from suggest_rt_window(), drawn as a shaded band.
+    """
+    ok, plt = _ensure_matplotlib(log_fn)
+    if not ok:
+        return
+
+    fig = None
+    try:
+        if len(rt) == 0:
+            log_fn("XIC export: no scans to plot.")
+            return
+
+        fig, ax = plt.subplots(figsize=(8.0, 3.6), dpi=150)
+        for trace, lbl in zip(traces, labels):
+            ax.plot(rt, trace, linewidth=1.0, label=lbl)
+
+        if window:
+            ax.axvspan(window["rt_min"], window["rt_max"], color="#6f8ea8", alpha=0.15, linewidth=0)
+            ax.axvline(window["apex_rt"], color="black", linestyle=":", linewidth=0.9)
+            ax.text(window["apex_rt"], ax.get_ylim()[1], f"{window['apex_rt']:.2f} min",
+                    ha="center", va="bottom", fontsize=9)
+
+        ax.set_xlabel("Retention time (min)")
+        ax.set_ylabel("Intensity")
+        if len(labels) > 1:
+            ax.legend(frameon=False, fontsize=8)
+        ax.spines["top"].set_visible(False)
+        ax.spines["right"].set_visible(False)
+
+        fig.tight_layout()
+        fig.savefig(out_svg, format="svg", bbox_inches="tight", transparent=True)
+        events.output(out_svg, "xic")
+        log_fn(f"Saved XIC SVG (editable): {out_svg}")
+    except Exception as e:
+        log_fn(f"XIC export failed: {type(e).__name__}: {e}")
+    finally:
+        if fig is not None:
+            plt.close(fig)
+
+
+def export_coverage_heatmap(cov, out_svg, log_fn=print):
+    """
+    One heatmap for a batch: rows = jobs (from coverage.coverage_tensor()), columns = backbone cuts.
+    Cells are none / b only / y only / b+y; cuts past a shorter peptide's end are left blank.
+    """
+    ok, plt = _ensure_matplotlib(log_fn)
+    if not ok:
+        return
+
+    fig = None
+    try:
+        import numpy as np
+        from matplotlib.colors import ListedColormap, BoundaryNorm
+        n_jobs, n_cuts = cov["valid"].shape
+        if n_jobs == 0:
+            log_fn("Coverage heatmap: no jobs to plot.")
+            return
+        m = cov["matched"]
+        state = m[:, :, 0].astype(float) + 2.0 * m[:, :, 1]          # 0 none, 1 b, 2 y, 3 both
+        state = np.ma.masked_where(~cov["valid"], state)
+        cmap = ListedColormap(["#EDEDED", "red", "blue", "#7A2E8E"])
+        cmap.set_bad((1, 1, 1, 0))
+
+        fig, ax = plt.subplots(figsize=(max(6.0, 0.28 * n_cuts + 3.0), max(2.0, 0.26 * n_jobs + 1.2)), dpi=150)
+        ax.pcolormesh(np.arange(n_cuts + 1) + 0.5, np.arange(n_jobs + 1) - 0.5, state,
+                      cmap=cmap, norm=BoundaryNorm([-0.5, 0.5, 1.5, 2.5, 3.5], cmap.N),
+                      edgecolors="white", linewidth=0.5)
+        ax.set_xlim(0.5, n_cuts + 0.5)
+        ax.set_ylim(n_jobs - 0.5, -0.5)
+        ax.set_yticks(range(n_jobs))
+        ax.set_yticklabels([f"{lbl} ({seq})" if len(set(cov["seqs"])) > 1 else lbl
+                            for lbl, seq in zip(cov["labels"], cov["seqs"])], fontsize=7)
+        step = max(1, n_cuts // 25)
+        ax.set_xticks(range(1, n_cuts + 1, step))
+        ax.set_xlabel("Cleavage site (bond after residue)")
+        if len(set(cov["seqs"])) == 1:
+            seq = cov["seqs"][0]
+            top = ax.secondary_xaxis("top")
+            top.set_xticks(range(1, n_cuts + 1))
+            top.set_xticklabels([f"{seq[c - 1]}|{seq[c]}" for c in range(1, n_cuts + 1)], fontsize=6, rotation=90)
+
+        from matplotlib.patches import Patch
+        ax.legend(handles=[Patch(color=c, label=l) for c, l in
+                           zip(cmap.colors, ("none", "b", "y", "b + y"))],
+                  loc="upper left", bbox_to_anchor=(1.01, 1.0), frameon=False, fontsize=7)
+
+        fig.tight_layout()
+        fmt = _figure_format(out_svg)
+        fig.savefig(out_svg, format=fmt, bbox_inches="tight", transparent=True)
+        events.output(out_svg, "coverage")
+        log_fn(f"Saved coverage heatmap {fmt.upper()}: {out_svg}")
+    except Exception as e:
+        log_fn(f"Coverage heatmap export failed: {type(e).__name__}: {e}")
+    finally:
+        if fig is not None:
+            plt.close(fig)
+
+
+def draw_precursor_map(ax, inventory, rt_bins=200, mz_bins=200, label_top_n=10, highlight=None):
+    """
+    RT x precursor m/z density of the MS2 scans (numpy histogram2d, log color scale) on ax, with
+    the label_top_n most-sampled precursors drawn as RT-range bars marked at their apex.
+    highlight: optional precursor m/z to mark (e.g. the current gate). Returns the image artist.
+    """
+    import numpy as np
+    from matplotlib.colors import LogNorm
+    from .mzml_utils import precursor_density
+
+    H, rt_edges, mz_edges = precursor_density(inventory, rt_bins, mz_bins)
+    img = None
+    if H.sum() > 0:
+        img = ax.imshow(np.ma.masked_equal(H.T, 0), origin="lower", aspect="auto", cmap="viridis",
+                        norm=LogNorm(vmin=1, vmax=max(1.0, H.max())), interpolation="nearest",
+                        extent=(rt_edges[0], rt_edges[-1], mz_edges[0], mz_edges[-1]))
+    for c in inventory["clusters"][:max(0, int(label_top_n))]:
+        if c.get("rt_min") is None:
+            continue
+        ax.plot([c["rt_min"], c["rt_max"]], [c["mz"], c["mz"]], color="#D04A02", lw=1.0)
+        if c.get("apex_rt") is not None:
+            ax.plot([c["apex_rt"]], [c["mz"]], marker="|", color="#D04A02", ms=7)
+        z = f" ({c['charge']}+)" if c.get("charge") else ""
+        ax.text(c["rt_max"], c["mz"], f" {c['mz']:.4f}{z}", fontsize=7, va="center", ha="left", color="#D04A02")
+    if highlight is not None:
+        ax.axhline(highlight, color="white", lw=0.8, linestyle=":")
+    ax.set_xlabel("Retention time (min)")
+    ax.set_ylabel("Precursor m/z")
+    return img
+
+
+def export_precursor_map(inventory, out_svg, highlight=None, rt_bins=200, mz_bins=200, log_fn=print):
+    """Precursor inventory as an RT x m/z density map (SVG, or PNG by suffix)."""
+    ok, plt = _ensure_matplotlib(log_fn)
+    if not ok:
+        return
+
+    fig = None
+    try:
+        if not len(inventory["scans"]["mz"]):
+            log_fn("Precursor map: no MS2 precursors to plot.")
+            return
+        fig, ax = plt.subplots(figsize=(8.0, 5.0), dpi=150)
+        img = draw_precursor_map(ax, inventory, rt_bins, mz_bins, highlight=highlight)
+        if img is not None:
+            fig.colorbar(img, ax=ax, label="MS2 scans per bin")
+        fig.tight_layout()
+        fmt = _figure_format(out_svg)
+        fig.savefig(out_svg, format=fmt, bbox_inches="tight")
+        events.output(out_svg, "precursor_map")
+        log_fn(f"Saved precursor map {fmt.upper()}: {out_svg}")
+    except Exception as e:
+        log_fn(f"Precursor map export failed: {type(e).__name__}: {e}")
+    finally:
+        if fig is not None:
+            plt.close(fig)
+
+
+def decimate_peaks(mz, inten, x_min, x_max, n_bins):
+    """
+    Level-of-detail reduction for stick plots: of the peaks inside [x_min, x_max], keep only the
+    most intense one per pixel column (n_bins columns). Input m/z must be sorted; returns arrays.
+    """
+    import numpy as np
+    mz = np.asarray(mz, dtype=np.float64)
+    inten = np.asarray(inten, dtype=np.float64)
+    lo = int(np.searchsorted(mz, x_min, side="left"))
+    hi = int(np.searchsorted(mz, x_max, side="right"))
+    mz, inten = mz[lo:hi], inten[lo:hi]
+    n_bins = max(1, int(n_bins))
+    if mz.size <= n_bins or x_max <= x_min:
+        return mz, inten
+    col = np.minimum(((mz - x_min) * (n_bins / (x_max - x_min))).astype(np.int64), n_bins - 1)
+    # columns ascend with m/z, so each column is one contiguous run
+    starts = np.flatnonzero(np.r_[True, col[1:] != col[:-1]])
+    group_max = np.maximum.reduceat(inten, starts)
+    tallest = np.flatnonzero(inten == np.repeat(group_max, np.diff(np.r_[starts, col.size])))
+    group = np.searchsorted(starts, tallest, side="right")
+    keep = tallest[np.r_[True, group[1:] != group[:-1]]]  # first tallest peak per column
+    return mz[keep], inten[keep]
+
+
+class SpectrumView:
+    """
+    Averaged spectrum + matched ions on an existing matplotlib Figure (no pyplot), for embedding
+    in a GUI canvas. Sticks are re-decimated to the visible m/z range whenever the view is zoomed
+    or panned; set_matches() only replaces the annotation artists, so a new tolerance or charge
+    set redraws without touching the spectrum.
+    """
+
+    ION_COLORS = {"b": "red", "y": "blue"}
+
+    def __init__(self, figure, label_top_n: int = 30):
+        from matplotlib.collections import LineCollection
+        self.figure = figure
+        self.ax = figure.add_subplot(111)
+        self.label_top_n = label_top_n
+        self._mz = self._norm = None
+        self._matched = []
+        self._labels = []
+        self._sticks = LineCollection([], colors="#A0A0A0", linewidths=0.9)
+        self._hits = LineCollection([], linewidths=1.2)
+        self.ax.add_collection(self._sticks)
+        self.ax.add_collection(self._hits)
+        self.ax.set_xlabel("m/z")
+        self.ax.set_ylabel("Relative intensity (%)")
+        self.ax.spines["top"].set_visible(False)
+        self.ax.spines["right"].set_visible(False)
+        self._updating = False
+        self.ax.callbacks.connect("xlim_changed", lambda _ax: self.refresh())
+
+    def set_spectrum(self, avg_spec):
+        import numpy as np
+        arr = np.asarray(avg_spec, dtype=np.float64).reshape(-1, 2)
+        arr = arr[np.argsort(arr[:, 0], kind="stable")]
+        base = arr[:, 1].max() if len(arr) else 1.0
+        self._mz, self._norm = arr[:, 0], arr[:, 1] / (base or 1.0) * 100.0
+        lo, hi = (arr[0, 0], arr[-1, 0]) if len(arr) else (0.0, 1000.0)
+        pad = max(10.0, (hi - lo) * 0.02)
+        self.ax.set_ylim(0.0, 115.0)
+        self.ax.set_xlim(lo - pad, hi + pad)  # triggers refresh()
+
+    def set_matches(self, rows):
+        """Replace the annotated ions (rows from legacy_summary_from_spectrum)."""
+        import numpy as np
+        self._matched = []
+        for r in rows or ():
+            obs, it = r.get("obs"), r.get("itype")
+            if obs is None or it not in self.ION_COLORS or not r.get("idx") or not r.get("z"):
+                continue
+            h = 0.0
+            if self._mz is not None and self._mz.size:
+                # bar height of the nearest averaged peak
+                i = int(np.searchsorted(self._mz, obs))
+                near = [k for k in (i - 1, i) if 0 <= k < self._mz.size]
+                h = float(self._norm[min(near, key=lambda k: abs(self._mz[k] - obs))])
+            self._matched.append((float(obs), it, r["idx"], r["z"], h))
+        self._draw_matches()
+
+    def refresh(self):
+        """Re-decimate the sticks and labels for the current x-range."""
+        if self._updating or self._mz is None:
+            return
+        self._updating = True
+        try:
+            x_min, x_max = self.ax.get_xlim()
+            n_px = max(50, int(self.ax.bbox.width))
+            mz, h = decimate_peaks(self._mz, self._norm, x_min, x_max, n_px)
+            self._sticks.set_segments([((x, 0.0), (x, y)) for x, y in zip(mz.tolist(), h.tolist())])
+            self._draw_labels(x_min, x_max)
+        finally:
+            self._updating = False
+
+    def _draw_matches(self):
+        self._hits.set_segments([((x, 0.0), (x, h)) for x, _it, _i, _z, h in self._matched])
+        self._hits.set_color([self.ION_COLORS[it] for _x, it, _i, _z, _h in self._matched])
+        x_min, x_max = self.ax.get_xlim()
+        self._draw_labels(x_min, x_max)
+
+    def _draw_labels(self, x_min, x_max):
+        for t in self._labels:
+            t.remove()
+        self._labels = []
+        visible = [m for m in self._matched if x_min <= m[0] <= x_max]
+        # label the tallest matches in view; zooming in reveals the rest
+        visible.sort(key=lambda m: -m[4])
+        for x, it, idx, z, h in visible[:max(0, int(self.label_top_n))]:
+            self._labels.append(self.ax.text(
+                x, h + 1.5, f"${it}_{{{idx}}}^{{{z}+}}$\n{x:.4f}", color=self.ION_COLORS[it],
+                ha="center", va="bottom", fontsize=8))